@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+End-to-end throughput benchmark of the stats pipeline.
+
+Starts fake_graphite.py, generates metric yaml with given number of series
+and runs get_stats_from_grafana.py (twice, for two intervals, so there are
+runs to work with), get_safe_bounds.py and compare_stats_from_grafana.py
+against it. Wall time, peak RSS and series per second of every step are
+saved as JSON, results of other commit can be given with --baseline to see
+the change.
+
+Cold-start time of every script is measured too (on the smallest size):
+median wall time of running the script, of running it as satmon.py
+subcommand, and time per command when all of them run in one satmon.py
+batch.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import tempfile
+import statistics
+import subprocess
+import tabulate
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Fake Graphite did not start listening on port %s" % port)
+
+
+def run(command):
+    """
+    Run command, return (wall time in seconds, peak RSS in MB).
+    """
+    logging.debug("Running %s" % ' '.join(command))
+    started = time.monotonic()
+    p = subprocess.Popen(command, cwd=HERE, stdout=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(p.pid, 0)
+    wall = time.monotonic() - started
+    if status != 0:
+        raise RuntimeError("Command %s failed with status %s" % (' '.join(command), status))
+    return wall, rusage.ru_maxrss / 1024.0
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_size(size, args, port, directory):
+    metrics_file = os.path.join(directory, 'metrics-%s.yaml' % size)
+    with open(metrics_file, 'w') as fp:
+        for i in range(size):
+            fp.write("-\n  - $Cloud.$Node.series-%s.value\n  - Series %s\n" % (i, i))
+
+    fetch_args = [
+        '--graphite', '127.0.0.1', '--port', str(port),
+        '--prefix', 'bench', '--node', 'node',
+        '--metrices', metrics_file, '--csv'] + args.fetch_args.split()
+    stats = [os.path.join(directory, 'stats-%s-%s.json' % (size, i)) for i in range(2)]
+    steps = []
+    for i, stats_file in enumerate(stats):
+        from_ts = args.from_ts + i * args.duration
+        steps.append(('get_stats_from_grafana.py', [
+            sys.executable, 'get_stats_from_grafana.py', str(from_ts), str(from_ts + args.duration),
+            '--file', stats_file] + fetch_args))
+    steps.append(('get_safe_bounds.py', [
+        sys.executable, 'get_safe_bounds.py', '--csv', '--file', os.path.join(directory, 'bounds-%s.json' % size)] + stats))
+    steps.append(('compare_stats_from_grafana.py', [
+        sys.executable, 'compare_stats_from_grafana.py', '--csv'] + stats))
+
+    out = []
+    for i, (script, command) in enumerate(steps):
+        wall, rss = run(command)
+        out.append({
+            'step': "%s%s" % (script, ' #2' if i == 1 else ''),
+            'series': size,
+            'wall': round(wall, 3),
+            'max_rss_mb': round(rss, 1),
+            'series_per_sec': round(size / wall, 1),
+        })
+        logging.info("%s with %s series: %.2fs, %.1f MB" % (out[-1]['step'], size, wall, rss))
+    return out
+
+
+def benchmark_startup(size, args, port, directory):
+    """
+    Cold-start times of the scripts with stats files of `benchmark_size`.
+    """
+    stats = [os.path.join(directory, 'stats-%s-%s.json' % (size, i)) for i in range(2)]
+    bounds = os.path.join(directory, 'bounds-%s.json' % size)
+    metrics_file = os.path.join(directory, 'metrics-%s.yaml' % size)
+    commands = [
+        ('fetch', 'get_stats_from_grafana.py', [
+            str(args.from_ts), str(args.from_ts + args.duration), '--file', os.path.join(directory, 'startup-%s.json' % size),
+            '--graphite', '127.0.0.1', '--port', str(port), '--prefix', 'bench', '--node', 'node',
+            '--metrices', metrics_file, '--csv']),
+        ('compare', 'compare_stats_from_grafana.py', ['--csv'] + stats),
+        ('bounds', 'get_safe_bounds.py', ['--csv', '--file', os.path.join(directory, 'startup-bounds-%s.json' % size)] + stats),
+        ('check', 'check_safe_bounds.py', ['--csv', '--stats', stats[1], '--bounds', bounds]),
+        ('progress', 'show_stats_from_grafana_progress.py', ['--csv'] + stats),
+    ]
+
+    def result(step, runs):
+        wall = statistics.median([r[0] for r in runs])
+        out.append({
+            'step': step,
+            'series': size,
+            'wall': round(wall, 3),
+            'max_rss_mb': round(max(r[1] for r in runs), 1),
+            'series_per_sec': round(size / wall, 1),
+        })
+        logging.info("%s with %s series: %.3fs, %.1f MB" % (step, size, wall, out[-1]['max_rss_mb']))
+
+    out = []
+    for command, script, command_args in commands:
+        result("startup: %s" % script, [run([sys.executable, script] + command_args) for _ in range(args.startup_repeats)])
+        result("startup: satmon.py %s" % command, [run([sys.executable, 'satmon.py', command] + command_args) for _ in range(args.startup_repeats)])
+    batch_file = os.path.join(directory, 'batch-%s.txt' % size)
+    with open(batch_file, 'w') as fp:
+        for _ in range(args.startup_repeats):
+            for command, script, command_args in commands:
+                fp.write(' '.join([command] + command_args) + '\n')
+    wall, rss = run([sys.executable, 'satmon.py', 'batch', batch_file])
+    result("startup: satmon.py batch (per command)", [(wall / (len(commands) * args.startup_repeats), rss)])
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark stats scripts against local fake Graphite')
+    parser.add_argument('--sizes', default='100,1000,10000,100000',
+                        help='Coma separated numbers of series to benchmark with')
+    parser.add_argument('--from-ts', type=int, default=1600000000,
+                        help='Start of the first fetched interval')
+    parser.add_argument('--duration', type=int, default=3600,
+                        help='Length of fetched intervals in seconds')
+    parser.add_argument('--step', type=int, default=60,
+                        help='Seconds between datapoints of fake series (payload size)')
+    parser.add_argument('--nulls', type=float, default=0.05,
+                        help='Fraction of null datapoints in fake series')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Fake Graphite response latency in seconds')
+    parser.add_argument('--fetch-args', default='',
+                        help='Extra arguments for get_stats_from_grafana.py (e.g. "--stream --parallel 8")')
+    parser.add_argument('--startup-repeats', type=int, default=5,
+                        help='How many times to run every script to measure its cold-start time (0 to skip it)')
+    parser.add_argument('--output', default='/tmp/benchmark.json',
+                        help='Save results to this file')
+    parser.add_argument('--baseline', type=argparse.FileType('r'), default=None,
+                        help='Results file from other commit to compare with')
+    parser.add_argument('--debug', action='store_true',
+                        help='Debug mode')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    logging.debug("Arguments: %s" % args)
+
+    sizes = [int(i) for i in args.sizes.split(',')]
+    port = free_port()
+    server = subprocess.Popen([
+        sys.executable, 'fake_graphite.py', '--port', str(port),
+        '--step', str(args.step), '--nulls', str(args.nulls), '--latency', str(args.latency),
+        '--series', str(max(sizes))], cwd=HERE)
+    results = []
+    try:
+        wait_for_port(port)
+        with tempfile.TemporaryDirectory() as directory:
+            for size in sizes:
+                results += benchmark_size(size, args, port, directory)
+            if args.startup_repeats > 0:
+                results += benchmark_startup(min(sizes), args, port, directory)
+    finally:
+        server.terminate()
+        server.wait()
+
+    doc = {
+        'commit': git_commit(),
+        'time': int(time.time()),
+        'settings': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline', 'debug')},
+        'results': results,
+    }
+    with open(args.output, 'w') as fp:
+        json.dump(doc, fp, indent=4)
+        logging.info("Results saved into %s" % args.output)
+
+    table_header = ['step', 'series', 'wall', 'max_rss_mb', 'series_per_sec']
+    baseline = {}
+    if args.baseline is not None:
+        baseline = {(r['step'], r['series']): r for r in json.load(args.baseline)['results']}
+        table_header += ['wall change [%]', 'max_rss_mb change [%]']
+    table_data = []
+    for r in results:
+        row = [r[column] for column in table_header[:5]]
+        if args.baseline is not None:
+            old = baseline.get((r['step'], r['series']))
+            for column in ('wall', 'max_rss_mb'):
+                row.append((r[column] - old[column]) / old[column] * 100 if old and old[column] else None)
+        table_data.append(row)
+    print(tabulate.tabulate(table_data, headers=table_header, floatfmt='.2f'))
+
+
+if __name__ == '__main__':
+    main()
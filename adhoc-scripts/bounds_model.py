@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Persistent model of safe bounds which can be updated run by run.
+
+For every metric -> factor the model keeps exponentially weighted running
+moments (weight, mean, M2 as in Welford's algorithm), running minimum and
+maximum and optionally a ring buffer with values from last `window` runs.
+Adding a run costs O(metrics x factors), history is never reloaded.
+
+With a window, bounds are computed from values in the window exactly as
+get_safe_bounds.py does it from the files (trimmed mean and pstdev, or min
+and max). Without it, running moments are used (mean is not trimmed) and
+with `decay` older runs weight less and less, so runs of old Satellite
+versions stop affecting the bounds (minimum and maximum are all-time ones
+unless window is used).
+"""
+
+import os
+import logging
+import tempfile
+import warnings
+import numpy
+
+
+def trim_mean(values, proportiontocut):
+    """
+    Same as `scipy.stats.trim_mean(values, proportiontocut)` along first
+    axis, but ignoring NaNs (so every metric -> factor can have different
+    number of runs).
+    """
+    values = numpy.sort(values, axis=0)   # NaNs are sorted to the end
+    nobs = numpy.count_nonzero(~numpy.isnan(values), axis=0)
+    lowercut = (proportiontocut * nobs).astype(int)
+    uppercut = nobs - lowercut
+    position = numpy.arange(values.shape[0]).reshape((-1,) + (1,) * (values.ndim - 1))
+    mask = (position >= lowercut) & (position < uppercut)
+    with numpy.errstate(invalid='ignore'):
+        return numpy.where(mask, values, 0.0).sum(axis=0) / mask.sum(axis=0)
+
+
+class BoundsModel(object):
+
+    ARRAYS = ['weight', 'mean', 'm2', 'min', 'max', 'window']
+
+    def __init__(self, window=None, decay=None):
+        self.window_size = window or 0
+        self.decay = decay   # half-life in runs
+        self.metrics = []
+        self.factors = []
+        self.runs = []
+        self.window_pos = 0
+        self.weight = numpy.zeros((0, 0))
+        self.mean = numpy.zeros((0, 0))
+        self.m2 = numpy.zeros((0, 0))
+        self.min = numpy.zeros((0, 0))
+        self.max = numpy.zeros((0, 0))
+        self.window = numpy.zeros((self.window_size, 0, 0))
+
+    @classmethod
+    def load(cls, path):
+        with numpy.load(path, allow_pickle=False) as data:
+            model = cls(window=int(data['window_size']), decay=float(data['decay']) or None)
+            model.metrics = data['metrics'].tolist()
+            model.factors = data['factors'].tolist()
+            model.runs = data['runs'].tolist()
+            model.window_pos = int(data['window_pos'])
+            for name in cls.ARRAYS:
+                setattr(model, name, data[name])
+        return model
+
+    def save(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            numpy.savez(
+                fp,
+                window_size=self.window_size, decay=self.decay or 0.0,
+                metrics=numpy.array(self.metrics, dtype=str), factors=numpy.array(self.factors, dtype=str),
+                runs=numpy.array(self.runs, dtype=str), window_pos=self.window_pos,
+                **{name: getattr(self, name) for name in self.ARRAYS})
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+
+    def _extend(self, metrics, factors):
+        """
+        Make room for metrics and factors model does not know yet.
+        """
+        known = set(self.metrics)
+        new_metrics = self.metrics + [m for m in metrics if m not in known]
+        new_factors = self.factors + [f for f in factors if f not in self.factors]
+        if new_metrics == self.metrics and new_factors == self.factors:
+            return
+        shape = (len(new_metrics), len(new_factors))
+        index = numpy.ix_(range(len(self.metrics)), range(len(self.factors)))
+        for name, fill in (('weight', 0.0), ('mean', 0.0), ('m2', 0.0), ('min', numpy.nan), ('max', numpy.nan)):
+            array = numpy.full(shape, fill)
+            array[index] = getattr(self, name)
+            setattr(self, name, array)
+        window = numpy.full((self.window_size,) + shape, numpy.nan)
+        window[:, :len(self.metrics), :len(self.factors)] = self.window
+        self.window = window
+        self.metrics = new_metrics
+        self.factors = new_factors
+
+    def update(self, run, metrics, factors, values):
+        """
+        Add one run given as metrics x factors array of values (NaN where
+        missing). Runs already in the model are skipped.
+        """
+        if run in self.runs:
+            logging.info("Run %s already in the model, skipping it" % run)
+            return
+        self._extend(metrics, factors)
+        x = numpy.full((len(self.metrics), len(self.factors)), numpy.nan)
+        position = {m: i for i, m in enumerate(self.metrics)}
+        x[numpy.ix_([position[m] for m in metrics], [self.factors.index(f) for f in factors])] = values
+        present = ~numpy.isnan(x)
+
+        if self.decay:
+            d = 0.5 ** (1.0 / self.decay)
+            self.weight *= d
+            self.m2 *= d
+        weight = self.weight + present
+        delta = numpy.where(present, x - self.mean, 0.0)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean = numpy.where(present, self.mean + delta / weight, self.mean)
+        self.m2 = self.m2 + numpy.where(present, delta * (x - mean), 0.0)
+        self.weight = weight
+        self.mean = mean
+        self.min = numpy.fmin(self.min, x)
+        self.max = numpy.fmax(self.max, x)
+
+        if self.window_size:
+            self.window[self.window_pos] = x
+            self.window_pos = (self.window_pos + 1) % self.window_size
+        self.runs.append(run)
+
+    def bounds(self, strategy, proportiontocut, boost):
+        """
+        Returns (lower, upper) arrays metrics x factors.
+        """
+        with numpy.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)   # all-NaN metric -> factor
+            if strategy == 'meanpstdev':
+                if self.window_size:
+                    mean = trim_mean(self.window, proportiontocut)
+                    pstdev = numpy.nanstd(self.window, axis=0)
+                else:
+                    mean = numpy.where(self.weight > 0, self.mean, numpy.nan)
+                    pstdev = numpy.sqrt(self.m2 / self.weight)
+                return mean - pstdev * boost, mean + pstdev * boost
+            if strategy == 'minmax':
+                if self.window_size:
+                    return numpy.nanmin(self.window, axis=0), numpy.nanmax(self.window, axis=0)
+                return self.min, self.max
+        raise Exception("Unknown safe zone generation strategy %s" % strategy)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Watch mode of check_safe_bounds.py: instead of checking finished stats
+file, keep polling the render API and check stats of the run so far
+against safe bounds, so e.g. a leak is reported within one poll interval
+and not hours later.
+
+First poll fetches the run so far, every next one only datapoints newer
+than the last one seen (plus one interval of overlap so perSecond targets
+have previous point), bounded by `max_lookback`. New points are folded into
+running stats of every metric (count, mean and variance by Welford/Chan,
+min, max, trapezoid integral and a quantile sketch), so the cost of a poll
+does not grow with the length of the run.
+
+Bounds are learned from finished runs, while stats of a run so far are
+not final yet: running `max` only grows and `min` only falls, the others
+(quantiles too) wander till the run is over. Until the run is as long as
+the shortest finished run (low bound of its `duration`), only the side
+which can not be undone is checked: `max` against high bound and `min`
+against low bound. All the factors are checked against both bounds once
+the run covers that duration (or when watching ends).
+
+Stats are kept per alias, the way bounds are. Target returning several
+series under one alias (e.g. wildcard) can not be watched and is dropped.
+"""
+
+import sys
+import time
+import logging
+import collections
+import numpy
+import quantile_sketch
+
+# Factors which can be checked while the run is going on (duration and
+# datapoints only make sense for finished run)
+WATCHED = ['min', 'max', 'mean', 'median', 'int_per_dur', 'pstdev', 'pvariance'] + list(quantile_sketch.QUANTILES)
+
+# Side of bounds which is meaningful before the run is complete
+EARLY_SIDE = {'min': 'low', 'max': 'high'}
+
+
+class RunningStats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = numpy.inf
+        self.max = -numpy.inf
+        self.integral = 0.0
+        self.last = None   # (timestamp, value) of the last point
+        self.sketch = quantile_sketch.QuantileSketch()
+
+    def update(self, values, timestamps):
+        """
+        Add new points (1-D arrays without NaNs, sorted by time).
+        """
+        if len(values) == 0:
+            return
+        count = len(values)
+        mean = values.mean()
+        m2 = ((values - mean) ** 2).sum()
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        if self.last is not None:
+            values = numpy.concatenate(([self.last[1]], values))
+            timestamps = numpy.concatenate(([self.last[0]], timestamps))
+        self.integral += numpy.sum((values[1:] + values[:-1]) / 2 * numpy.diff(timestamps))
+        self.last = (timestamps[-1], values[-1])
+        self.sketch.merge(quantile_sketch.sketch_rows(values[-count:].reshape(1, -1))[0])
+
+    def factor(self, name, duration):
+        if name == 'min':
+            return float(self.min)
+        if name == 'max':
+            return float(self.max)
+        if name == 'mean':
+            return self.mean
+        if name == 'pvariance':
+            return self.m2 / self.count
+        if name == 'pstdev':
+            return (self.m2 / self.count) ** 0.5
+        if name == 'int_per_dur':
+            return self.integral / duration if duration > 0 else 0.0
+        if name == 'median':
+            return self.sketch.quantile(0.5)
+        return self.sketch.quantile(quantile_sketch.quantile_of_factor(name))
+
+
+def series_arrays(series):
+    """
+    (values, timestamps) arrays of Graphite series dict.
+    """
+    points = numpy.array(series['datapoints'], dtype=float).reshape(-1, 2)   # None becomes NaN
+    return points[:, 0], points[:, 1]
+
+
+class BoundsWatcher(object):
+
+    def __init__(self, render, targets, bounds, from_ts, factors=None,
+                 min_datapoints=5, interval=10, max_lookback=300):
+        self.render = render   # callable (list of (target, alias), from_ts, to_ts) -> list of series
+        self.targets = targets
+        self.bounds = bounds
+        self.from_ts = from_ts
+        self.factors = factors or WATCHED
+        self.min_datapoints = min_datapoints
+        self.interval = interval
+        self.max_lookback = max_lookback
+        self.stats = {alias: RunningStats() for target, alias in targets}
+        self.seen = {alias: from_ts for target, alias in targets}   # timestamp of the last consumed point
+        self.polled = False
+        self.lagging = set()   # aliases with points older than the fetched window not consumed
+        self.unsafe = set()   # (metric, factor) currently out of safe zone
+        self.violations = 0
+
+    def poll(self, now):
+        """
+        Fetch new points, update stats and return list of changes as
+        (metric, factor, safe zone, value, is safe) tuples.
+        """
+        if not self.polled:   # catch up with the run started before we did
+            fetch_from = self.from_ts
+        else:
+            fetch_from = max(min(list(self.seen.values()) or [now]) - self.interval, now - self.max_lookback, self.from_ts)
+            lagging = set(alias for alias, seen in self.seen.items() if seen < fetch_from)
+            for alias in sorted(lagging - self.lagging):
+                logging.warning("%s lags more than %s s behind (last point at %s, fetching from %s), its points before are skipped"
+                                % (alias, self.max_lookback, int(self.seen[alias]), int(fetch_from)))
+            self.lagging = lagging
+        self.polled = True
+        data = self.render(self.targets, int(fetch_from), int(now))
+        counts = collections.Counter(series['target'] for series in data)
+        for alias in sorted(alias for alias, count in counts.items() if count > 1 and alias in self.stats):
+            self.drop(alias, "it returned %s series" % counts[alias])
+        for series in data:
+            alias = series['target']
+            if alias not in self.stats:
+                continue
+            values, timestamps = series_arrays(series)
+            new = (timestamps > self.seen[alias]) & ~numpy.isnan(values)
+            if new.any():
+                self.stats[alias].update(values[new], timestamps[new])
+                self.seen[alias] = timestamps[new][-1]
+        return self.check(now)
+
+    def drop(self, alias, reason):
+        """
+        Stop watching given metric.
+        """
+        logging.warning("Not watching %s, %s" % (alias, reason))
+        del self.stats[alias]
+        del self.seen[alias]
+        self.lagging.discard(alias)
+        self.unsafe = set(key for key in self.unsafe if key[0] != alias)
+
+    def complete(self, alias, stats):
+        """
+        Is the run long enough to check both sides of all the factors.
+        """
+        duration = self.bounds[alias].get('duration')
+        return duration is not None and stats.last[0] - self.from_ts >= duration[0]
+
+    def check(self, now, final=False):
+        """
+        Check stats so far against bounds, `final` means the run is over.
+        """
+        out = []
+        for alias, stats in self.stats.items():
+            if alias not in self.bounds or stats.count < self.min_datapoints:
+                continue
+            complete = final or self.complete(alias, stats)
+            for factor in self.factors:
+                if factor not in self.bounds[alias]:
+                    continue
+                if not complete and factor not in EARLY_SIDE:
+                    continue
+                value = stats.factor(factor, stats.last[0] - self.from_ts)
+                low, high = self.bounds[alias][factor]
+                if complete:
+                    is_safe = low <= value <= high
+                elif EARLY_SIDE[factor] == 'high':
+                    is_safe = value <= high
+                else:
+                    is_safe = value >= low
+                key = (alias, factor)
+                if not is_safe and key not in self.unsafe:
+                    self.unsafe.add(key)
+                    self.violations += 1
+                    out.append((alias, factor, [low, high], value, False))
+                elif is_safe and key in self.unsafe:
+                    self.unsafe.discard(key)
+                    out.append((alias, factor, [low, high], value, True))
+        return out
+
+    def run(self, until=None, report=None):
+        """
+        Poll every `interval` seconds till `until` (forever if None), call
+        `report` with changes found by every poll.
+        """
+        next_poll = time.time()
+        while until is None or next_poll <= until:
+            started = time.time()
+            changes = self.poll(started)
+            logging.debug("Poll took %.3f s" % (time.time() - started))
+            if changes and report is not None:
+                report(started, changes)
+            next_poll += self.interval
+            time.sleep(max(0, next_poll - time.time()))
+        changes = self.check(time.time(), final=True)   # run is over, check both sides
+        if changes and report is not None:
+            report(time.time(), changes)
+
+
+def print_changes(now, changes):
+    for metric, factor, bounds, value, is_safe in changes:
+        if not is_safe:
+            logging.warning("%s -> %s with safe zone %s and value %s is not safe!" % (metric, factor, bounds, value))
+        print("%s\t%s\t%s\t%s\t%.2f\t%s" % (int(now), metric, factor, bounds, value, 'safe' if is_safe else 'NOT SAFE'))
+        sys.stdout.flush()
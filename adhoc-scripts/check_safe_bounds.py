@@ -4,29 +4,97 @@
 import sys
 import argparse
 import logging
-import tabulate
 import json
 import csv
+import time
+import stats_store
+import bounds_watch
 
 parser = argparse.ArgumentParser(description='Check that stats falls into safe bounds')
-parser.add_argument('--stats', required=True, type=argparse.FileType('r'),
-                    help='Stats file to check')
+parser.add_argument('--stats', default=None,
+                    help='Stats file to check (JSON stats file, FILE#PHASE or STORE_DIR#RUN)')
 parser.add_argument('--bounds', default='/tmp/get_safe_bounds.json', type=argparse.FileType('r'),
                     help='Safe bounds file with acceptable min and max for each metric->factor')
 parser.add_argument('--csv', action='store_true',
                     help='Results table to stdout in csv (defauts to table)')
+parser.add_argument('--watch', action='store_true',
+                    help='Instead of --stats file, keep polling render API and report metrics->factors leaving safe zone as the run goes')
+parser.add_argument('--watch-from', type=int, default=None,
+                    help='Timestamp (UTC) the watched run started at (defaults to now)')
+parser.add_argument('--watch-until', type=int, default=None,
+                    help='Timestamp (UTC) to stop watching at (defaults to never)')
+parser.add_argument('--interval', type=int, default=10,
+                    help='Seconds between polls in watch mode (collection interval)')
+parser.add_argument('--max-lookback', type=int, default=300,
+                    help='Never fetch more than this many seconds in one poll')
+parser.add_argument('--min-datapoints', type=int, default=5,
+                    help='Do not check metric before it has this many datapoints')
+parser.add_argument('--factors', default=None,
+                    help='Coma separated factors to watch (defaults to %s)' % ','.join(bounds_watch.WATCHED))
+parser.add_argument('--graphite', default=None,
+                    help='Grafana host for watch mode')
+parser.add_argument('--port', type=int, default=11202,
+                    help='Grafana port')
+parser.add_argument('--datasource', type=int, default=1,
+                    help='Graphite datasource ID in Grafana')
+parser.add_argument('--token', default=None,
+                    help='Authorization token without the "Bearer: " part')
+parser.add_argument('--prefix', default='satellite62',
+                    help='Prefix for data in Graphite')
+parser.add_argument('--node', default='satellite_satperf_local',
+                    help='Monitored host node name in Graphite')
+parser.add_argument('--interface', default='interface-em1',
+                    help='Network interface for network stats')
+parser.add_argument('--metrices', nargs='+', type=argparse.FileType('r'), default=None,
+                    help='yaml files with metrices to watch (as used to get the stats bounds were computed from)')
 parser.add_argument('--debug', action='store_true',
                     help='Debug mode')
 args = parser.parse_args()
 
+if args.watch and (args.graphite is None or args.metrices is None):
+    parser.error('--graphite and --metrices are required with --watch')
+if not args.watch and args.stats is None:
+    parser.error('--stats is required unless --watch is used')
+
 if args.debug:
     logging.basicConfig(level=logging.DEBUG)
 
 logging.debug("Arguments: %s" % args)
 
-data_stats = json.load(args.stats)
 data_bounds = json.load(args.bounds)
 
+if args.watch:
+    import metric_index   # needed (with yaml and requests) only in watch mode
+    import graphite_render
+    try:
+        targets = metric_index.read_metric_files(args.metrices)
+    except ValueError as e:
+        parser.error(str(e))
+    targets = [(k.replace('$Cloud', args.prefix).replace('$Node', args.node).replace('$Interface', args.interface), v)
+               for k, v in targets]
+    client = graphite_render.RenderClient(args.graphite, args.port, args.datasource, token=args.token)
+    targets = metric_index.MetricIndex(client.find).expand(targets)
+    missing = [v for k, v in targets if v not in data_bounds]
+    if missing:
+        logging.warning("No safe bounds for %s metrics, they are not checked: %s" % (len(missing), ', '.join(missing)))
+    watcher = bounds_watch.BoundsWatcher(
+        lambda pairs, from_ts, to_ts: client.render(["alias(%s, '%s')" % (k, v) for k, v in pairs], from_ts, to_ts),
+        targets, data_bounds,
+        args.watch_from if args.watch_from is not None else int(time.time()),
+        factors=args.factors.split(',') if args.factors is not None else None,
+        min_datapoints=args.min_datapoints, interval=args.interval, max_lookback=args.max_lookback)
+    print("time\tmetric\tfactor\tsafe zone\tvalue\tsafe?")
+    try:
+        watcher.run(until=args.watch_until, report=bounds_watch.print_changes)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+    print("\n%s metrics->factors left safe zone, %s still out of it" % (watcher.violations, len(watcher.unsafe)))
+    sys.exit(1 if watcher.violations > 0 else 0)
+
+data_stats = stats_store.load_one(args.stats)
+
 table_header = ['metric', 'factor', 'safe zone', 'value', 'safe?']
 table_data = []
 
@@ -38,6 +106,8 @@ for metric_key, metric_value in data_stats.items():
             continue
         if factor_key == 'histogram':
             continue
+        if factor_key == 'sketch':
+            continue
         is_safe = True
         if factor_value < data_bounds[metric_key][factor_key][0] \
             or factor_value > data_bounds[metric_key][factor_key][1]:
@@ -51,6 +121,7 @@ if args.csv:
     spamwriter.writerow(table_header)
     spamwriter.writerows(table_data)
 else:
+    import tabulate   # slow to import, not needed for csv
     print(tabulate.tabulate(table_data, headers=table_header, floatfmt='.2f'))
 
 print("\n%s of %s metrics->factors found out of safe zone (i.e. %.1f%%)" % (is_unsafe_counter, len(table_data), float(is_unsafe_counter)/len(table_data)*100))
@@ -4,16 +4,23 @@
 import sys
 import argparse
 import logging
-import tabulate
-import json
 import csv
-import scipy.stats
+import warnings
+import numpy
+import stats_store
+import quantile_sketch
 
 parser = argparse.ArgumentParser(description='Compare stats files from Graphite/Grafana')
-parser.add_argument('first_file', type=argparse.FileType('r'),
-                    help='first file with stats, baseline for a comparision')
-parser.add_argument('second_file', type=argparse.FileType('r'),
-                    help='second stats file to compare to baseline')
+parser.add_argument('first_file',
+                    help='first file with stats, baseline for a comparision (JSON stats file, FILE#PHASE or STORE_DIR#RUN)')
+parser.add_argument('second_file', nargs='+',
+                    help='stats files to compare to baseline (JSON stats files, FILE#PHASE, stats store directories or STORE_DIR#RUN)')
+parser.add_argument('--all-pairs', action='store_true',
+                    help='Compare all pairs of given runs instead of comparing each to the baseline')
+parser.add_argument('--merge-baseline', action='store_true',
+                    help='Baseline can have more runs (e.g. store directory), merge their quantile sketches (other factors are averaged) and compare to that')
+parser.add_argument('--factors', default='max,mean,median,duration,histogram',
+                    help='Coma separated factors to compare ("histogram" means correlation of histograms, quantiles like "p99" or "p99.9" are read from quantile sketches if present)')
 parser.add_argument('--csv', action='store_true',
                     help='Output comparasion table to stdout in csv (defauts to table)')
 parser.add_argument('--debug', action='store_true',
@@ -25,11 +32,84 @@ if args.debug:
 
 logging.debug("Arguments: %s" % args)
 
-data_first = json.load(args.first_file)
-data_second = json.load(args.second_file)
+baseline_count = len(stats_store.load_values([args.first_file])[0])
+if not args.all_pairs and not args.merge_baseline and baseline_count != 1:
+    parser.error('baseline has more runs, use STORE_DIR#RUN or FILE#PHASE to pick one or --merge-baseline')
+if args.merge_baseline and 'histogram' in args.factors.split(','):
+    parser.error('histograms can not be merged, use quantiles (e.g. p95,p99) with --merge-baseline')
+
+paths = [args.first_file] + args.second_file
+runs, metrics, factors, values = stats_store.load_values(paths)
+for factor in args.factors.split(','):
+    if factor != 'histogram' and factor not in factors and quantile_sketch.quantile_of_factor(factor) is None:
+        parser.error('%s is not in %s (columns approximated with --max-datapoints are not saved)' % (factor, args.first_file))
+sketches = stats_store.load_sketches(paths, metrics)
+if 'histogram' in args.factors.split(','):
+    hist_counts, hist_edges = stats_store.load_histograms(paths, metrics)
+logging.debug("Loaded runs: %s" % runs)
+
+if args.merge_baseline:
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)   # all-NaN metric -> factor
+        values = numpy.concatenate([numpy.nanmean(values[:baseline_count], axis=0, keepdims=True), values[baseline_count:]])
+    sketches = [[quantile_sketch.merged(s) for s in zip(*sketches[:baseline_count])]] + sketches[baseline_count:]
+    runs = ["%s (%s runs merged)" % (args.first_file, baseline_count)] + runs[baseline_count:]
+    logging.debug("Merged %s baseline runs" % baseline_count)
+
+
+def fill_histograms(counts, edges):
+    """
+    Histograms of different runs might have different number of bins
+    (padded with NaNs). Make missing bins empty and zero-width at the end.
+    """
+    counts = numpy.nan_to_num(counts)
+    valid = ~numpy.isnan(edges)
+    last_valid = numpy.maximum.accumulate(numpy.where(valid, numpy.arange(edges.shape[-1]), 0), axis=-1)
+    edges = numpy.take_along_axis(numpy.where(valid, edges, 0.0), last_valid, axis=-1)
+    return counts, edges
+
+
+def rebin(counts, edges, new_edges):
+    """
+    Redistribute histogram counts into new bins proportionally to how much
+    of each old bin overlaps with each new bin. Works on any leading
+    dimensions: counts (..., k), edges (..., k+1), new_edges (..., n+1).
+    Zero-width old bins fall into new bin they are in.
+    """
+    old_from = edges[..., :-1, None]
+    old_to = edges[..., 1:, None]
+    new_from = new_edges[..., None, :-1]
+    new_to = new_edges[..., None, 1:]
+    width = old_to - old_from
+    overlap = numpy.clip(numpy.minimum(old_to, new_to) - numpy.maximum(old_from, new_from), 0.0, None)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        weights = numpy.where(width > 0, overlap / width, 0.0)
+    last = numpy.arange(new_edges.shape[-1] - 1) == new_edges.shape[-1] - 2
+    inside = (old_from >= new_from) & ((old_from < new_to) | (last & (old_from <= new_to)))
+    weights = numpy.where(width > 0, weights, inside)
+    return (counts[..., :, None] * weights).sum(axis=-2)
+
+
+def factor_values(factor):
+    """
+    Return runs x metrics array of given factor. Quantiles are read from
+    sketches where runs have them, so they can be any quantile and work for
+    merged baseline as well.
+    """
+    q = quantile_sketch.quantile_of_factor(factor)
+    if factor in factors:
+        out = values[:, :, factors.index(factor)]
+    elif q is not None:
+        out = numpy.full(values.shape[:2], numpy.nan)
+    else:
+        raise KeyError("Unknown factor %s" % factor)
+    if q is not None:
+        from_sketches = quantile_sketch.quantile_matrix(sketches, [q])[:, :, 0]
+        out = numpy.where(numpy.isnan(from_sketches), out, from_sketches)
+    return out
 
 
-def count_correlation(hist1, hist2):
+def count_correlation(counts1, edges1, counts2, edges2):
     """
     To be able to cound correlation, we need to get same set of bins first.
 
@@ -54,107 +134,78 @@ def count_correlation(hist1, hist2):
 
     and so on. Now when we have normalized `hist1_new` and `hist2_new` values,
     we can compute correlation coeficient and return it.
+
+    All arguments are arrays with histograms in the last dimension (counts
+    have `bins` items, edges `bins + 1`), any leading dimensions (e.g.
+    pairs x metrics) are computed at once. Returns array of correlations,
+    NaN where one of the rebinned histograms is flat (e.g. series without
+    data), as correlation is not defined for zero variance.
+    """
+    bins_count = counts1.shape[-1]
+    bins_start = numpy.minimum(edges1[..., 0], edges2[..., 0])
+    bins_end = numpy.maximum(edges1[..., -1], edges2[..., -1])
+    new_edges = bins_start[..., None] + (bins_end - bins_start)[..., None] * numpy.arange(bins_count + 1) / bins_count
+    hist1_new = rebin(counts1, edges1, new_edges)
+    hist2_new = rebin(counts2, edges2, new_edges)
+
+    x = hist1_new - hist1_new.mean(axis=-1, keepdims=True)
+    y = hist2_new - hist2_new.mean(axis=-1, keepdims=True)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return (x * y).sum(axis=-1) / numpy.sqrt((x * x).sum(axis=-1) * (y * y).sum(axis=-1))
+
+
+def format_value(value):
+    """
+    Format table cell, same for table and CSV: infinite change (from zero)
+    is "Err", undefined value (e.g. correlation of flat histogram) "nan".
     """
-    assert len(hist1) == len(hist2)
-    hist1_bins = [i[0] for i in hist1]
-    hist1_counts = [i[1] for i in hist1]
-    hist2_bins = [i[0] for i in hist2]
-    hist2_counts = [i[1] for i in hist2]
-    ###print("Hist1 bins: ", hist1_bins)
-    ###print("Hist1 counts: ", hist1_counts)
-    ###print("Hist2 bins: ", hist2_bins)
-    ###print("Hist2 counts: ", hist2_counts)
-    bins_count = len(hist1)
-    bins_start = min(hist1_bins[0][0], hist2_bins[0][0])
-    bins_end = max(hist1_bins[-1][1], hist2_bins[-1][1])
-    bins_size = (bins_end - bins_start) / bins_count
-    ###print("Bins info: ", bins_count, bins_start, bins_end, bins_size)
-    bins_new = []
-    hist1_new = []
-    hist2_new = []
-
-    def _overlap(interval1, interval2):
-        """
-        Given [0, 4] and [1, 10] returns [1, 4]
-        """
-        if interval2[0] <= interval1[0] <= interval2[1]:
-            start = interval1[0]
-        elif interval1[0] <= interval2[0] <= interval1[1]:
-            start = interval2[0]
-        else:
-            ###print("Comparing intervals %s and %s => start not matched" % (interval1, interval2))
-            raise Exception("Intervals are not overlapping")
-        if interval2[0] <= interval1[1] <= interval2[1]:
-            end = interval1[1]
-        elif interval1[0] <= interval2[1] <= interval1[1]:
-            end = interval2[1]
-        else:
-            ###print("Comparing intervals %s and %s => end not matched" % (interval1, interval2))
-            raise Exception("Intervals are not overlapping")
-        ###print("Comparing intervals %s and %s => %s" % (interval1, interval2, (start, end)))
-        return (start, end)
-
-    def _percentage_overlap(interval1, interval2):
-        """
-        Given [0, 4] and [1, 10] returns 0.75
-        """
-        try:
-            overlap = _overlap(interval1, interval2)
-        except Exception:
-            return 0.0
-        return (overlap[1] - overlap[0]) / (interval1[1] - interval1[0])
-
-    for new_bin_id in range(bins_count):
-        h_bin_new = (bins_start + bins_size * new_bin_id, bins_start + bins_size * (new_bin_id + 1))
-        h1_new = 0.0
-        h2_new = 0.0
-        for old_bin_id in range(bins_count):
-            ###print("%s -> %s: %s" % (new_bin_id, old_bin_id, h_bin_new))
-            ###print("    h1_new += %s * %s" % (hist1_counts[old_bin_id], _percentage_overlap(hist1_bins[old_bin_id], h_bin_new)))
-            ###print("    h2_new += %s * %s" % (hist2_counts[old_bin_id], _percentage_overlap(hist2_bins[old_bin_id], h_bin_new)))
-            h1_new += hist1_counts[old_bin_id] * _percentage_overlap(hist1_bins[old_bin_id], h_bin_new)
-            h2_new += hist2_counts[old_bin_id] * _percentage_overlap(hist2_bins[old_bin_id], h_bin_new)
-        bins_new.append(h_bin_new)
-        hist1_new.append(h1_new)
-        hist2_new.append(h2_new)
-
-    correlation = scipy.stats.linregress(hist1_new, hist2_new)[2]
-    ###print('New bins: ', bins_new)
-    ###print('New counts1: ', hist1_new)
-    ###print('New counts2: ', hist2_new)
-    ###print('Correlation: ', correlation)
-    return correlation
+    if numpy.isnan(value):
+        return 'nan'
+    if numpy.isinf(value):
+        return 'Err'
+    return "%.1f" % value
 
 
+if args.all_pairs:
+    pairs = [(i, j) for i in range(len(runs)) for j in range(i + 1, len(runs))]
+    labels = ["%s vs %s" % (runs[i], runs[j]) for i, j in pairs]
+else:
+    pairs = [(0, j) for j in range(1, len(runs))]
+    labels = [runs[j] for i, j in pairs]
+first = numpy.array([i for i, j in pairs], dtype=int)
+second = numpy.array([j for i, j in pairs], dtype=int)
+
 # Some stats are useless
 ###table_header = ['metric', 'min', 'max', 'mean', 'median', 'int_per_dur', 'pstdev', 'pvariance', 'duration']
 table_header_metric = ['metric']
-table_header_items = ['max', 'mean', 'median', 'duration', 'histogram']
+table_header_items = args.factors.split(',')
 table_header = table_header_metric
+columns = []   # list of (header, pairs x metrics array of values)
 for factor in table_header_items:
     if factor == 'histogram':
-        table_header.append("correlation")
+        counts, edges = fill_histograms(numpy.asarray(hist_counts), numpy.asarray(hist_edges))
+        correlation = count_correlation(counts[first], edges[first], counts[second], edges[second])
+        columns.append(("correlation", correlation))
     else:
-        table_header.append("%s change" % factor)
-        table_header.append("%s change [%%]" % factor)
+        factor_value = factor_values(factor)
+        value_first = factor_value[first]
+        value_diff = factor_value[second] - value_first
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            value_pct = numpy.where(value_first != 0, value_diff / value_first * 100, numpy.inf)
+        columns.append(("%s change" % factor, value_diff))
+        columns.append(("%s change [%%]" % factor, value_pct))
+
+for p, label in enumerate(labels):
+    for header, _ in columns:
+        table_header.append(header if len(labels) == 1 else "%s: %s" % (label, header))
 
 table_data = []
-for metric in data_first:
+for m, metric in enumerate(metrics):
     table_row = [metric]
-    for factor in table_header_items:
-        logging.debug("Processing %s -> %s" % (metric, factor))
-        value_first = data_first[metric][factor]
-        value_second = data_second[metric][factor]
-        if factor == 'histogram':
-            correlation = count_correlation(value_first, value_second)
-            table_row.append("%.1f" % correlation)
-        else:
-            value_diff = float(value_second - value_first)
-            table_row.append("%.1f" % value_diff)
-            try:
-                table_row.append("%.1f" % (value_diff / value_first * 100))
-            except ZeroDivisionError:
-                table_row.append('Err')
+    for p in range(len(labels)):
+        for header, column in columns:
+            logging.debug("Processing %s -> %s -> %s" % (labels[p], metric, header))
+            table_row.append(format_value(column[p, m]))
     table_data.append(table_row)
 
 if args.csv:
@@ -162,4 +213,5 @@ if args.csv:
     spamwriter.writerow(table_header)
     spamwriter.writerows(table_data)
 else:
+    import tabulate   # slow to import, not needed for csv
     print(tabulate.tabulate(table_data, headers=table_header, floatfmt='.2f'))
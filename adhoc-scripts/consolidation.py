@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Stats computed from series consolidated on Graphite side.
+
+Instead of downloading every datapoint, each metric is requested several
+times wrapped in `consolidateBy()` and Graphite is asked to return at most
+`maxDataPoints` points per series. Some statistics survive consolidation
+exactly (minimum of per-bucket minimums is the minimum, sum of per-bucket
+sums divided by sum of per-bucket non-null counts is the mean, ...), the rest
+(median, quantiles, histogram, integral) can only be approximated from per-bucket
+averages and need full resolution data to be exact.
+
+Consolidated series of one target can not be told apart once aliased, so
+targets returning several series (wildcards) are left out and have to be
+fetched in full resolution (see `multi_series`). So are targets evaluated
+locally (see derived_series), as their per-bucket aggregates can not be
+computed from per-bucket aggregates of their leaves.
+
+Variance is not computed from sum of squares (it cancels catastrophically
+for big values with small spread), but from sum of squared deviations
+from the mean, asked for in a second request once the means are known.
+"""
+
+import numpy
+import series_stats
+
+# How to ask Graphite for given per-bucket aggregate of a target
+QUERIES = {
+    'min': "consolidateBy(%s, 'min')",
+    'max': "consolidateBy(%s, 'max')",
+    'sum': "consolidateBy(%s, 'sum')",
+    'count': "consolidateBy(isNonNull(%s), 'sum')",
+    'average': "consolidateBy(%s, 'average')",
+}
+
+# Per-bucket sum of squared deviations from given mean
+DEVIATION_QUERY = "consolidateBy(pow(offset(%s, %s), 2), 'sum')"
+
+# Columns computed exactly from consolidated series
+EXACT = ['min', 'max', 'mean', 'pstdev', 'pvariance', 'datapoints']
+
+# Columns which need full resolution data to be exact
+FULL_RESOLUTION = ['median', 'p90', 'p95', 'p99', 'int_per_dur', 'histogram']
+
+
+def consolidated_targets(targets):
+    """
+    Given list of sanitized targets, return list of target expressions to
+    fetch. Series are aliased "<index of target>:<query>". Targets which
+    are None (left to full resolution) are skipped.
+    """
+    out = []
+    for i, target in enumerate(targets):
+        if target is None:
+            continue
+        for query, expression in sorted(QUERIES.items()):
+            out.append("alias(%s, '%s:%s')" % (expression % target, i, query))
+    return out
+
+
+def deviation_targets(targets, means):
+    """
+    Given list of sanitized targets and their means (from `compute_means`),
+    return list of target expressions with per-bucket sums of squared
+    deviations, aliased "<index of target>:sqdev". Targets without data
+    are skipped.
+    """
+    out = []
+    for i, (target, mean) in enumerate(zip(targets, means)):
+        if numpy.isfinite(mean):
+            out.append("alias(%s, '%s:sqdev')" % (DEVIATION_QUERY % (target, repr(-float(mean))), i))
+    return out
+
+
+def group_series(data, count):
+    """
+    Sort consolidated series by query and target index. Returns dict query
+    -> list of series (one per target), set of indexes of targets Graphite
+    returned some series for and set of indexes of targets it returned
+    more series for.
+    """
+    by_query = {query: [{'datapoints': []} for _ in range(count)] for query in list(QUERIES) + ['sqdev']}
+    returned = set()
+    multi = set()
+    seen = set()
+    for d in data:
+        index, query = d['target'].split(':', 1)
+        index = int(index)
+        if (query, index) in seen:
+            multi.add(index)
+        seen.add((query, index))
+        by_query[query][index] = d
+        returned.add(index)
+    return by_query, returned, multi
+
+
+def multi_series(data):
+    """
+    Return set of indexes of targets with several consolidated series.
+    """
+    return group_series(data, 1 + max([int(d['target'].split(':', 1)[0]) for d in data], default=-1))[2]
+
+
+def _counts_means(count_matrix, sum_matrix):
+    counts = numpy.nansum(count_matrix, axis=1)
+    sums = numpy.nansum(sum_matrix, axis=1)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return counts, numpy.where(counts > 0, sums / counts, numpy.nan)
+
+
+def compute_means(data, count):
+    """
+    Return array of means of `count` targets from consolidated series, NaN
+    for targets without data or with several series.
+    """
+    by_query, returned, multi = group_series(data, count)
+    means = _counts_means(series_stats.series_matrix(by_query['count'])[0],
+                          series_stats.series_matrix(by_query['sum'])[0])[1]
+    means[list(multi)] = numpy.nan
+    return means
+
+
+def compute_stats(data, aliases, duration, full=None):
+    """
+    Compute stats table columns from consolidated series (as returned for
+    targets from `consolidated_targets` and `deviation_targets`). Returns
+    list of (alias, stats dict) for all targets Graphite returned exactly
+    one series for. `full` is dict target index -> list of (alias, stats
+    dict) computed from full resolution data, put in place of these
+    targets (it has to cover targets with several series).
+    """
+    full = full or {}
+    by_query, returned, multi = group_series(data, len(aliases))
+    matrices = {query: series_stats.series_matrix(series)[0] for query, series in by_query.items()}
+    counts, means = _counts_means(matrices['count'], matrices['sum'])
+    has_data = counts > 0
+    means = numpy.where(has_data, means, 0.0)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        sqdevs = numpy.nansum(matrices['sqdev'], axis=1)
+        pvariances = numpy.where(has_data, sqdevs / counts, 0.0)
+        mins = numpy.where(has_data, numpy.nanmin(numpy.where(has_data[:, None], matrices['min'], 0.0), axis=1), 0.0)
+        maxs = numpy.where(has_data, numpy.nanmax(numpy.where(has_data[:, None], matrices['max'], 0.0), axis=1), 0.0)
+
+    # Whatever can not be exact is approximated from per-bucket averages
+    values, timestamps = series_stats.series_matrix(by_query['average'])
+    approx = series_stats.compute_stats(values, timestamps, duration)
+
+    out = []
+    for i, alias in enumerate(aliases):
+        if i in full:
+            out += full[i]
+            continue
+        if i not in returned or i in multi:
+            continue
+        out.append((alias, {
+            'min': mins[i],
+            'max': maxs[i],
+            'mean': means[i],
+            'median': approx['median'][i],
+            'p90': approx['p90'][i],
+            'p95': approx['p95'][i],
+            'p99': approx['p99'][i],
+            'int_per_dur': approx['int_per_dur'][i],
+            'pstdev': numpy.sqrt(pvariances[i]),
+            'pvariance': pvariances[i],
+            'histogram': approx['histogram'][i],
+            'sketch': approx['sketch'][i],
+            'datapoints': int(counts[i]),
+        }))
+    return out
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Estimate how expensive it is for graphite-web to render the dashboard.
+
+Every panel target is taken with template variables resolved (current
+values of the dashboard or --var overrides, "All" becomes the glob of the
+variable query) and references to other queries of the panel (`#A`)
+inlined. Metric paths in it are resolved with Graphite `find`, so we know
+how many series each target reads and, with storage retentions, how many
+datapoints over the given range. Reported are the most expensive panels
+and targets, queries which are repeated across panels and wildcards which
+fan out into many series and should rather be aggregated server side.
+"""
+
+import re
+import json
+import time
+import logging
+import argparse
+import tabulate
+import graphite_render
+import whisper_backend
+import metric_index
+import get_metrices_from_config
+
+_variable_re = re.compile(r'\$\{(\w+)(?::\w+)?\}|\[\[(\w+)\]\]|\$(\w+)')
+_alias_re = re.compile(r"^alias\((.*),\s*'[^']*'\)$|^alias\((.*),\s*\"[^\"]*\"\)$", re.S)
+_aggregate_re = re.compile(r'\b(sum|sumSeries|avg|averageSeries|maxSeries|minSeries|multiplySeries|diffSeries|group)\(')
+_units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7*86400, 'y': 365*86400}
+
+
+def parse_duration(text):
+    match = re.match(r'^(\d+)([smhdwy]?)$', text)
+    if match is None:
+        raise ValueError("Can not parse duration %s" % text)
+    return int(match.group(1)) * _units[match.group(2) or 's']
+
+
+def points_per_series(retentions, from_ts, to_ts, now):
+    """
+    Number of datapoints graphite-web reads for one series: it uses the
+    first (most precise) archive which still covers from_ts.
+    """
+    archives = []
+    for archive in retentions.split(','):
+        precision, retention = archive.split(':')
+        archives.append((parse_duration(precision), parse_duration(retention)))
+    for precision, retention in archives:
+        if now - retention <= from_ts:
+            break
+    return -(-(to_ts - from_ts) // precision)
+
+
+def strip_alias(expression):
+    expression = re.sub(r'\s+', '', expression)
+    match = _alias_re.match(expression)
+    while match is not None:
+        expression = match.group(1) or match.group(2)
+        match = _alias_re.match(expression)
+    return expression
+
+
+class DashboardVariables(object):
+
+    def __init__(self, dashboard, overrides):
+        self.variables = {}
+        for variable in dashboard.get('templating', {}).get('list', []):
+            self.variables[variable['name']] = variable
+        self.overrides = overrides
+
+    def value(self, name, seen=()):
+        """
+        Glob the variable stands for in metric paths.
+        """
+        if name in self.overrides:
+            return self.overrides[name]
+        variable = self.variables.get(name)
+        if variable is None or name in seen:
+            logging.warning("Variable %s can not be resolved" % name)
+            return '*'
+        current = variable.get('current', {}).get('value', '')
+        if not isinstance(current, list):
+            current = [current]
+        if '$__all' in current or not current or current == ['']:
+            # "All" with glob format is the last node of the variable query
+            query = self.resolve(variable.get('query', '*'), seen + (name,))
+            return variable.get('allValue') or query.split('.')[-1]
+        if len(current) == 1:
+            return current[0]
+        return '{%s}' % ','.join(current)
+
+    def query(self, name):
+        """
+        Resolved metric query of the variable (to count its values).
+        """
+        return self.resolve(self.variables[name].get('query', '*'), (name,))
+
+    def resolve(self, text, seen=()):
+        return _variable_re.sub(lambda m: self.value(m.group(1) or m.group(2) or m.group(3), seen), text)
+
+
+def panel_targets(panel, variables):
+    """
+    Return list of (refId, resolved target) of visible targets of the panel.
+    """
+    return [(ref, variables.resolve(target)) for ref, target in get_metrices_from_config.panel_targets(panel)]
+
+
+def analyse(dashboard, variables, find, points, fanout):
+    """
+    Return list of target dicts with their cost and list of fan-out dicts.
+    """
+    targets = []
+    for row_title, panel in get_metrices_from_config.dashboard_panels(dashboard):
+        title = variables.resolve(panel.get('title', ''))
+        repeat = panel.get('repeat')
+        for ref, expression in panel_targets(panel, variables):
+            targets.append({
+                'row': row_title, 'panel': title, 'panel_id': panel.get('id'), 'repeat': repeat,
+                'ref': ref, 'target': expression, 'paths': metric_index.metric_paths(expression)})
+
+    patterns = set(p for t in targets for p in t['paths'])
+    patterns |= set(variables.query(t['repeat']) for t in targets if t['repeat'] in variables.variables)
+    found = find(sorted(patterns))
+
+    fanouts = []
+    for t in targets:
+        t['series_by_path'] = {p: len(found[p]) for p in t['paths']}
+        t['series'] = sum(len(found[p]) for p in t['paths'])
+        t['datapoints'] = t['series'] * points
+        t['repeats'] = len(found[variables.query(t['repeat'])]) if t['repeat'] in variables.variables else 1
+        for path in t['paths']:
+            if metric_index.wildcard_path(path) is not None and len(found[path]) >= fanout:
+                aggregated = _aggregate_re.search(t['target']) is not None
+                fanouts.append({
+                    'panel': t['panel'], 'ref': t['ref'], 'path': path, 'series': len(found[path]),
+                    'hint': 'pre-aggregate with carbon-aggregator rule' if aggregated
+                            else 'aggregate (sumSeries/averageSeries) or narrow the wildcard'})
+    return targets, fanouts
+
+
+def panel_costs(targets):
+    panels = {}
+    for t in targets:
+        key = (t['row'], t['panel'], t['panel_id'])
+        p = panels.setdefault(key, {'row': t['row'], 'panel': t['panel'], 'targets': 0, 'series': 0, 'datapoints': 0, 'repeats': t['repeats']})
+        p['targets'] += 1
+        p['series'] += t['series']
+        p['datapoints'] += t['datapoints']
+    return sorted(panels.values(), key=lambda p: p['datapoints'], reverse=True)
+
+
+def duplicates(targets, points):
+    """
+    Queries (ignoring their alias) used in more than one panel and metric
+    paths read more than once (e.g. inlined `#A` reference in every target
+    of the panel). Every repeated read is wasted work for graphite-web.
+    """
+    out = []
+    groups = {}
+    for t in targets:
+        groups.setdefault(strip_alias(t['target']), []).append(t)
+    for query, group in groups.items():
+        if len(set(t['panel_id'] for t in group)) > 1:
+            out.append({'kind': 'query', 'query': query, 'count': len(group),
+                        'panels': sorted(set(t['panel'] for t in group)),
+                        'wasted_datapoints': sum(t['datapoints'] for t in group[1:])})
+    paths = {}
+    for t in targets:
+        for path in t['paths']:
+            paths.setdefault(path, []).append(t)
+    for path, group in paths.items():
+        if len(group) > 1:
+            series = group[0]['series_by_path'][path]
+            out.append({'kind': 'path', 'query': path, 'count': len(group),
+                        'panels': sorted(set(t['panel'] for t in group)),
+                        'wasted_datapoints': series * points * (len(group) - 1)})
+    return sorted(out, key=lambda d: d['wasted_datapoints'], reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Estimate Graphite query cost of dashboard panels',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('from_ts', type=int,
+                        help='Timestamp (UTC) to start the range at')
+    parser.add_argument('to_ts', type=int,
+                        help='Timestamp (UTC) to end the range at')
+    parser.add_argument('--dashboard', default=get_metrices_from_config.DASHBOARD,
+                        help='Dashboard JSON to analyse')
+    parser.add_argument('--var', action='append', default=[],
+                        help='Override dashboard variable, NAME=VALUE (e.g. Node=satellite_example_com)')
+    parser.add_argument('--graphite', default=None,
+                        help='Grafana host')
+    parser.add_argument('--backend', choices=['grafana', 'whisper'], default='grafana',
+                        help='Find metrics through Grafana datasource proxy or in local Whisper files')
+    parser.add_argument('--storage-dir', default='/var/lib/carbon/whisper',
+                        help='Whisper storage directory for whisper backend')
+    parser.add_argument('--port', type=int, default=11202,
+                        help='Grafana port')
+    parser.add_argument('--datasource', type=int, default=1,
+                        help='Graphite datasource ID in Grafana')
+    parser.add_argument('--token', default=None,
+                        help='Authorization token without the "Bearer: " part')
+    parser.add_argument('--parallel', type=int, default=4,
+                        help='Number of concurrent find requests')
+    parser.add_argument('--find-cache', default='/tmp/get_stats_from_grafana-find.json',
+                        help='File to cache metrics/find results in')
+    parser.add_argument('--find-cache-ttl', type=int, default=3600,
+                        help='Seconds for which cached metrics/find results are used')
+    parser.add_argument('--retentions', default='10s:7d,60s:90d,1h:180d',
+                        help='Carbon storage retentions of the metrics (see storage-schemas.conf)')
+    parser.add_argument('--fanout', type=int, default=10,
+                        help='Flag wildcards matching at least this many series')
+    parser.add_argument('--top', type=int, default=10,
+                        help='Number of most expensive panels and targets to show')
+    parser.add_argument('--file', default='/tmp/dashboard_cost.json',
+                        help='Save full report into this file')
+    parser.add_argument('--debug', action='store_true',
+                        help='Debug mode')
+    args = parser.parse_args()
+
+    if args.backend == 'grafana' and args.graphite is None:
+        parser.error('--graphite is required with grafana backend')
+    overrides = {}
+    for item in args.var:
+        if '=' not in item:
+            parser.error('--var has to be NAME=VALUE')
+        name, value = item.split('=', 1)
+        overrides[name.lstrip('$')] = value
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    dashboard = get_metrices_from_config.load_dashboard(args.dashboard)
+    variables = DashboardVariables(dashboard, overrides)
+    points = points_per_series(args.retentions, args.from_ts, args.to_ts, time.time())
+    logging.debug("Datapoints per series: %s" % points)
+
+    client = None
+    if args.backend == 'whisper':
+        storage = whisper_backend.WhisperStorage(args.storage_dir)
+        index = metric_index.MetricIndex(lambda pattern: [m for m, f in storage.find(pattern)], parallel=args.parallel)
+    else:
+        client = graphite_render.RenderClient(args.graphite, args.port, args.datasource, token=args.token, parallel=args.parallel)
+        index = metric_index.MetricIndex(
+            client.find, cache_file=args.find_cache, ttl=args.find_cache_ttl,
+            parallel=args.parallel, cache_key=client.find_url)
+    try:
+        targets, fanouts = analyse(dashboard, variables, index.lookup, points, args.fanout)
+    finally:
+        if client is not None:
+            client.close()
+    panels = panel_costs(targets)
+    dups = duplicates(targets, points)
+
+    total_series = sum(t['series'] for t in targets)
+    print("%s panels, %s targets, %s series, %s datapoints (%s per series)\n" % (
+        len(panels), len(targets), total_series, total_series * points, points))
+    print(tabulate.tabulate(
+        [[p['row'], p['panel'] + (" (x%s)" % p['repeats'] if p['repeats'] > 1 else ''), p['targets'], p['series'], p['datapoints']] for p in panels[:args.top]],
+        headers=['row', 'panel', 'targets', 'series', 'datapoints']))
+    print()
+    print(tabulate.tabulate(
+        [[t['panel'], t['ref'], t['target'], t['series'], t['datapoints']]
+         for t in sorted(targets, key=lambda t: t['datapoints'], reverse=True)[:args.top]],
+        headers=['panel', 'ref', 'target', 'series', 'datapoints']))
+    if dups:
+        print("\nQueries repeated across panels and metric paths read repeatedly:")
+        print(tabulate.tabulate(
+            [[d['kind'], d['query'], d['count'], len(d['panels']), d['wasted_datapoints']] for d in dups[:args.top]],
+            headers=['kind', 'query', 'count', 'panels', 'wasted datapoints']))
+    if fanouts:
+        print("\nWildcards fanning out into %s or more series:" % args.fanout)
+        print(tabulate.tabulate(
+            [[f['panel'], f['ref'], f['path'], f['series'], f['hint']] for f in sorted(fanouts, key=lambda f: f['series'], reverse=True)[:args.top]],
+            headers=['panel', 'ref', 'path', 'series', 'hint']))
+
+    with open(args.file, 'w') as fp:
+        json.dump({'points_per_series': points, 'panels': panels, 'targets': targets,
+                   'duplicates': dups, 'fanouts': fanouts}, fp, indent=4)
+        logging.info("Report saved into %s" % args.file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Local evaluation of derived targets (e.g. dashboard panels showing process
+CPU time as a share of all cores) so Graphite does not compute them again
+from base series we download anyway.
+
+Targets are parsed into expression trees. Those which combine series
+(`divideSeries`, `asPercent`) or turn counters into rates (`perSecond`) and
+use only functions implemented here are evaluated locally: metric paths in
+their leaves are fetched once (every leaf is shared by all targets using
+it) and common sub-expressions are evaluated once too. Other targets are
+left to Graphite as before - e.g. plain `sum($Cloud.$Node.*.disk_octets.read)`
+is cheaper to aggregate on the server than to download all its series.
+
+Supported functions: alias, scale, offset, perSecond, sum/sumSeries,
+avg/averageSeries, divideSeries and asPercent. Series with different
+resolution are averaged onto the coarsest one before they are combined.
+
+Entries of metric yaml files marked as counters (third item "counter") are
+wrapped in perSecond, so stats describe their rate and not the growing
+counter, without making graphite-web compute the derivative.
+"""
+
+import re
+import numpy
+import warnings
+import whisper_backend
+
+FUNCTIONS = ('alias', 'scale', 'offset', 'perSecond', 'sum', 'sumSeries', 'avg', 'averageSeries', 'divideSeries', 'asPercent')
+DERIVING = ('divideSeries', 'asPercent', 'perSecond')
+
+
+class DerivedError(Exception):
+    pass
+
+
+def parse(expression):
+    """
+    Parse target expression into tree of tuples: ('call', function, args),
+    ('path', path), ('number', value) and ('string', text).
+    """
+    expression = expression.strip()
+    match = re.match(r'^(\w+)\((.*)\)$', expression, re.S)
+    if match is not None:
+        return ('call', match.group(1), [parse(arg) for arg in whisper_backend.split_args(match.group(2))])
+    if expression[:1] in ('"', "'"):
+        return ('string', expression[1:-1])
+    try:
+        return ('number', float(expression))
+    except ValueError:
+        return ('path', expression)
+
+
+def key(tree):
+    """
+    Canonical text of the tree, used to share common sub-expressions.
+    """
+    if tree[0] == 'call':
+        return "%s(%s)" % (tree[1], ','.join(key(arg) for arg in tree[2]))
+    if tree[0] == 'string':
+        return "'%s'" % tree[1]
+    return str(tree[1])
+
+
+def calls(tree):
+    if tree[0] != 'call':
+        return []
+    return [tree[1]] + [c for arg in tree[2] for c in calls(arg)]
+
+
+def leaf_paths(tree):
+    if tree[0] == 'path':
+        return [tree[1]]
+    if tree[0] == 'call':
+        return [p for arg in tree[2] for p in leaf_paths(arg)]
+    return []
+
+
+def is_local(tree):
+    functions = calls(tree)
+    return all(f in FUNCTIONS for f in functions) and any(f in DERIVING for f in functions)
+
+
+def _arrays(series):
+    """
+    (values, timestamps) arrays of Graphite series dict.
+    """
+    if 'values' in series:
+        return numpy.asarray(series['values'], dtype=float), numpy.asarray(series['timestamps'], dtype=float)
+    points = numpy.array(series['datapoints'], dtype=float).reshape(-1, 2)   # None becomes NaN
+    return numpy.ascontiguousarray(points[:, 0]), numpy.ascontiguousarray(points[:, 1])
+
+
+def _step(timestamps):
+    return numpy.median(numpy.diff(timestamps)) if len(timestamps) > 1 else 0.0
+
+
+def align(series):
+    """
+    Return (timestamps, 2-D values) of series on one time grid. Series with
+    finer resolution are averaged into buckets of the coarsest one, bucket
+    is labelled by its start as Graphite labels consolidated points (point
+    at `t` falls into bucket `grid[i] <= t < grid[i] + step`).
+    """
+    grids = [s['timestamps'] for s in series if len(s['timestamps'])]
+    if not grids:
+        return numpy.zeros(0), numpy.zeros((len(series), 0))
+    if all(len(g) == len(grids[0]) and numpy.array_equal(g, grids[0]) for g in grids) and len(grids) == len(series):
+        return grids[0], numpy.vstack([s['values'] for s in series])
+    grid = max(grids, key=_step)
+    step = _step(grid)
+    out = numpy.full((len(series), len(grid)), numpy.nan)
+    for row, s in enumerate(series):
+        bucket = numpy.searchsorted(grid, s['timestamps'], side='right') - 1
+        valid = (bucket >= 0) & (s['timestamps'] < grid[-1] + step) & ~numpy.isnan(s['values'])
+        bucket[~valid] = 0
+        counts = numpy.bincount(bucket[valid], minlength=len(grid))
+        sums = numpy.bincount(bucket[valid], weights=s['values'][valid], minlength=len(grid))
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            out[row] = numpy.where(counts > 0, sums / counts, numpy.nan)
+    return grid, out
+
+
+def _divide(values, divisor):
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return numpy.where(divisor != 0, values / divisor, numpy.nan)
+
+
+def _combine(name, series, function):
+    if not series:
+        return []
+    timestamps, values = align(series)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)   # mean of all-NaN column
+        combined = function(values)
+    combined[numpy.isnan(values).all(axis=0)] = numpy.nan   # all None gives None as in Graphite
+    return [{'name': name, 'values': combined, 'timestamps': timestamps}]
+
+
+def counter_rates(values, timestamps, max_value=None):
+    """
+    Per second rates of cumulative counter given as 1-D arrays (NaN for
+    nulls), the way Graphite perSecond computes them: rate at every point
+    is its increase since the previous point divided by the time between
+    them, null point or the first point after nulls gives NaN (gaps are
+    not bridged), decrease means the counter was reset (or wrapped over
+    `max_value`) and gives NaN.
+    """
+    out = numpy.full(len(values), numpy.nan)
+    valid = ~numpy.isnan(values)
+    has_previous = numpy.zeros(len(values), dtype=bool)
+    has_previous[1:] = valid[1:] & valid[:-1]
+    previous = numpy.nonzero(has_previous)[0] - 1
+    current = values[has_previous]
+    before = values[previous]
+    delta = current - before
+    if max_value is not None:
+        wrapped = (delta < 0) & (current <= max_value)
+        delta[wrapped] = max_value - before[wrapped] + current[wrapped] + 1
+    delta[delta < 0] = numpy.nan
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        out[has_previous] = delta / (timestamps[has_previous] - timestamps[previous])
+    return out
+
+
+def counter_target(target):
+    """
+    Target giving per second rate of counter target (evaluated locally).
+    """
+    return "perSecond(%s)" % target
+
+
+def evaluate(tree, leaves, memo):
+    """
+    Evaluate tree into list of series dicts with 'name', 'values' and
+    'timestamps'. `leaves` maps metric paths to their fetched series,
+    `memo` keeps results of evaluated sub-expressions. Returned series are
+    never modified, so they can be shared.
+    """
+    k = key(tree)
+    if k in memo:
+        return memo[k]
+    kind = tree[0]
+    if kind == 'path':
+        out = leaves.get(tree[1], [])
+    elif kind != 'call':
+        raise DerivedError("Unexpected %s %s where series were expected" % (kind, tree[1]))
+    else:
+        function, args = tree[1], tree[2]
+        if function == 'alias':
+            out = [dict(s, name=args[1][1]) for s in evaluate(args[0], leaves, memo)]
+        elif function in ('scale', 'offset'):
+            factor = args[1][1]
+            out = [{'name': "%s(%s,%s)" % (function, s['name'], factor),
+                    'values': s['values'] * factor if function == 'scale' else s['values'] + factor,
+                    'timestamps': s['timestamps']} for s in evaluate(args[0], leaves, memo)]
+        elif function == 'perSecond':
+            max_value = args[1][1] if len(args) > 1 else None
+            out = [{'name': "perSecond(%s)" % s['name'], 'values': counter_rates(s['values'], s['timestamps'], max_value), 'timestamps': s['timestamps']}
+                   for s in evaluate(args[0], leaves, memo)]
+        elif function in ('sum', 'sumSeries', 'avg', 'averageSeries'):
+            series = [s for arg in args for s in evaluate(arg, leaves, memo)]
+            reduce = numpy.nansum if function in ('sum', 'sumSeries') else numpy.nanmean
+            out = _combine("%s(%s)" % (function, ','.join(key(arg) for arg in args)), series,
+                           lambda values: reduce(values, axis=0))
+        elif function == 'divideSeries':
+            dividends = evaluate(args[0], leaves, memo)
+            divisor = evaluate(args[1], leaves, memo)
+            if len(divisor) != 1:
+                raise DerivedError("divideSeries second argument must reference exactly 1 series (got %s)" % len(divisor))
+            out = []
+            for s in dividends:
+                timestamps, values = align([s, divisor[0]])
+                out.append({'name': "divideSeries(%s,%s)" % (s['name'], divisor[0]['name']),
+                            'values': _divide(values[0], values[1]), 'timestamps': timestamps})
+        elif function == 'asPercent':
+            series = evaluate(args[0], leaves, memo)
+            if len(args) > 1 and args[1][0] == 'number':
+                out = [{'name': "asPercent(%s,%s)" % (s['name'], args[1][1]), 'values': s['values'] / args[1][1] * 100,
+                        'timestamps': s['timestamps']} for s in series]
+            else:
+                if len(args) > 1:
+                    total = evaluate(args[1], leaves, memo)
+                else:
+                    total = _combine("sumSeries(%s)" % key(args[0]), series, lambda values: numpy.nansum(values, axis=0))
+                if len(total) == 1:
+                    total = total * len(series)
+                elif len(total) != len(series):
+                    raise DerivedError("asPercent total must be 1 series or as many as the series (got %s and %s)" % (len(total), len(series)))
+                out = []
+                for s, t in zip(series, total):
+                    timestamps, values = align([s, t])
+                    out.append({'name': "asPercent(%s,%s)" % (s['name'], t['name']),
+                                'values': _divide(values[0], values[1]) * 100, 'timestamps': timestamps})
+        else:
+            raise DerivedError("Function %s can not be evaluated locally" % function)
+    memo[k] = out
+    return out
+
+
+class DerivedTargets(object):
+    """
+    Split (sanitized target, alias) pairs into those left to Graphite and
+    those evaluated locally from shared leaf series.
+    """
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.trees = {}   # index of target -> its tree, for targets evaluated locally
+        for i, (target, alias) in enumerate(targets):
+            tree = parse(target)
+            if is_local(tree):
+                self.trees[i] = tree
+        self.leaves = sorted(set(p for tree in self.trees.values() for p in leaf_paths(tree)))
+
+    def remote(self):
+        return [pair for i, pair in enumerate(self.targets) if i not in self.trees]
+
+    def leaf_targets(self):
+        """
+        (metric path, alias) pairs to fetch the leaves with.
+        """
+        return [(path, "leaf:%s" % i) for i, path in enumerate(self.leaves)]
+
+    def evaluate(self, leaf_data):
+        """
+        Evaluate local targets from series fetched for `leaf_targets`. Returns
+        dict index of target -> list of series dicts with 'target' (alias),
+        'values' and 'timestamps'.
+        """
+        return dict(self.evaluate_each(leaf_data))
+
+    def evaluate_each(self, leaf_data):
+        """
+        Generate (index of target, list of series dicts) for local targets
+        in their order. Leaves are dropped as soon as no remaining target
+        needs them (and sub-expression results with them), so when results
+        are summarised right away, memory holds only leaves still in use.
+        """
+        leaves = {path: [] for path in self.leaves}
+        for d in leaf_data:
+            path = self.leaves[int(d['target'].split(':')[1])]
+            values, timestamps = _arrays(d)
+            leaves[path].append({'name': path, 'values': values, 'timestamps': timestamps})
+        del leaf_data
+        last_use = {}
+        for i, tree in sorted(self.trees.items()):
+            for path in leaf_paths(tree):
+                last_use[path] = i
+        memo = {}
+        for i, tree in sorted(self.trees.items()):
+            alias = self.targets[i][1]
+            yield i, [{'target': alias, 'values': s['values'], 'timestamps': s['timestamps']}
+                      for s in evaluate(tree, leaves, memo)]
+            done = [path for path in leaf_paths(tree) if last_use[path] == i and path in leaves]
+            if done:
+                for path in done:
+                    del leaves[path]
+                memo = {}   # results computed from dropped leaves
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Local stand-in for Graphite render and find API behind Grafana datasource
+proxy (`/api/datasources/proxy/<id>/render` and `.../metrics/find`), so the
+scripts can be tried and benchmarked without live Grafana/Graphite.
+
+Every metric path is a deterministic synthetic series: value at given
+timestamp depends only on the path and the timestamp (so overlapping
+intervals, caches and phases see the same data), some points are nulls.
+Metric tree used by find and wildcards is:
+
+    <prefix>.<node>.series-<i>.value       for i in 0 .. series - 1
+
+Supported functions: alias, aliasByNode, aliasSub, consolidateBy, isNonNull,
+offset, pow, scale, sum/sumSeries and maxDataPoints consolidation.
+"""
+
+import re
+import json
+import time
+import zlib
+import logging
+import argparse
+import http.server
+import urllib.parse
+import numpy
+import metric_index
+import whisper_backend
+
+
+class SeriesGenerator(object):
+
+    def __init__(self, step=10, nulls=0.05, series=1000, prefix='bench', node='node', seed=0):
+        self.step = step
+        self.nulls = nulls
+        self.series = series
+        self.prefix = prefix
+        self.node = node
+        self.seed = seed
+
+    def metrics(self):
+        return ["%s.%s.series-%s.value" % (self.prefix, self.node, i) for i in range(self.series)]
+
+    def find(self, pattern):
+        if not metric_index.wildcard_path(pattern):
+            return [pattern]
+        regex = metric_index.pattern_regex(pattern)
+        return [m for m in self.metrics() if regex.match(m)]
+
+    @staticmethod
+    def _uniform(seed, timestamps, salt):
+        """
+        Deterministic pseudo-random numbers from 0 to 1 for given timestamps.
+        """
+        x = (timestamps.astype(numpy.uint64) * numpy.uint64(2654435761) + numpy.uint64(seed) + numpy.uint64(salt)) & numpy.uint64(0xffffffff)
+        x ^= x >> numpy.uint64(16)
+        x = (x * numpy.uint64(0x45d9f3b)) & numpy.uint64(0xffffffff)
+        x ^= x >> numpy.uint64(16)
+        return x.astype(float) / 0xffffffff
+
+    def fetch(self, path, from_ts, until_ts):
+        """
+        Return (timestamps, values) of metric in (from_ts, until_ts].
+        """
+        start = from_ts - from_ts % self.step + self.step
+        timestamps = numpy.arange(start, until_ts + 1, self.step, dtype=numpy.int64)
+        seed = zlib.crc32(path.encode('utf-8')) + self.seed
+        level = seed % 1000
+        values = level + 100 * self._uniform(seed, timestamps, 1) + 50 * numpy.sin(timestamps / 3600.0 + seed)
+        values[self._uniform(seed, timestamps, 2) < self.nulls] = numpy.nan
+        return timestamps, values
+
+    def evaluate(self, expression, from_ts, until_ts):
+        """
+        Evaluate target expression into list of series dicts with 'name',
+        'timestamps', 'values' and 'consolidate'.
+        """
+        expression = expression.strip()
+        match = re.match(r'^(\w+)\((.*)\)$', expression, re.S)
+        if match is None:
+            out = []
+            for path in self.find(expression):
+                timestamps, values = self.fetch(path, from_ts, until_ts)
+                out.append({'name': path, 'timestamps': timestamps, 'values': values, 'consolidate': 'average'})
+            return out
+
+        function, args = match.group(1), whisper_backend.split_args(match.group(2))
+        if function in ('sum', 'sumSeries'):
+            series = []
+            for arg in args:
+                series += self.evaluate(arg, from_ts, until_ts)
+            if not series:
+                return []
+            stacked = numpy.vstack([s['values'] for s in series])
+            values = numpy.nansum(stacked, axis=0)
+            values[numpy.isnan(stacked).all(axis=0)] = numpy.nan
+            return [{'name': "sumSeries(%s)" % ','.join(args), 'timestamps': series[0]['timestamps'], 'values': values, 'consolidate': 'average'}]
+        series = self.evaluate(args[0], from_ts, until_ts)
+        for s in series:
+            if function == 'alias':
+                s['name'] = args[1].strip('\'"')
+            elif function == 'aliasByNode':
+                nodes = s['name'].split('.')
+                s['name'] = '.'.join(nodes[int(i)] for i in args[1:])
+            elif function == 'aliasSub':
+                s['name'] = re.sub(args[1].strip('\'"'), args[2].strip('\'"'), s['name'])
+            elif function == 'consolidateBy':
+                s['consolidate'] = args[1].strip('\'"')
+            elif function == 'isNonNull':
+                s['values'] = (~numpy.isnan(s['values'])).astype(float)
+            elif function == 'offset':
+                s['values'] = s['values'] + float(args[1])
+            elif function == 'pow':
+                s['values'] = s['values'] ** float(args[1])
+            elif function == 'scale':
+                s['values'] = s['values'] * float(args[1])
+            else:
+                raise ValueError("Function %s is not supported" % function)
+            if function not in ('alias', 'aliasByNode', 'aliasSub', 'consolidateBy'):
+                s['name'] = "%s(%s)" % (function, ','.join([s['name']] + args[1:]))
+        return series
+
+    @staticmethod
+    def consolidate(series, max_datapoints):
+        """
+        Consolidate series to at most `max_datapoints` points as Graphite does.
+        """
+        length = len(series['values'])
+        if not max_datapoints or length <= max_datapoints:
+            return series['timestamps'], series['values']
+        per_point = -(-length // max_datapoints)
+        buckets = -(-length // per_point)
+        values = numpy.full(buckets * per_point, numpy.nan)
+        values[:length] = series['values']
+        values = values.reshape(buckets, per_point)
+        has_data = ~numpy.isnan(values).all(axis=1)
+        filled = numpy.where(has_data[:, None], values, 0.0)
+        function = {
+            'average': numpy.nanmean, 'avg': numpy.nanmean, 'sum': numpy.nansum,
+            'min': numpy.nanmin, 'max': numpy.nanmax,
+            'first': lambda v, axis: v[:, 0], 'last': lambda v, axis: v[:, -1],
+        }[series['consolidate']]
+        out = numpy.where(has_data, function(filled, axis=1), numpy.nan)
+        return series['timestamps'][::per_point], out
+
+
+def series_json(name, timestamps, values):
+    points = ','.join(
+        "[%s,%d]" % ('null' if v != v else repr(v), t)
+        for v, t in zip(values.tolist(), timestamps.tolist()))
+    return '{"target":%s,"datapoints":[%s]}' % (json.dumps(name), points)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    generator = None
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def _send(self, status, body):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        time.sleep(self.latency)
+        try:
+            if re.match(r'^/api/datasources/proxy/\d+/render$', url.path):
+                from_ts = int(params['from'][0])
+                until_ts = int(params['until'][0])
+                max_datapoints = int(params.get('maxDataPoints', ['0'])[0])
+                out = []
+                for target in params.get('target', []):
+                    for s in self.generator.evaluate(target, from_ts, until_ts):
+                        timestamps, values = self.generator.consolidate(s, max_datapoints)
+                        out.append(series_json(s['name'], timestamps, values))
+                self._send(200, '[%s]' % ','.join(out))
+            elif re.match(r'^/api/datasources/proxy/\d+/metrics/find$', url.path):
+                found = self.generator.find(params['query'][0])
+                self._send(200, json.dumps([{'id': m, 'text': m.split('.')[-1], 'leaf': 1, 'expandable': 0} for m in found]))
+            else:
+                self._send(404, json.dumps({'message': 'Not found'}))
+        except (KeyError, ValueError) as e:
+            self._send(400, json.dumps({'message': str(e)}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Graphite render API behind Grafana datasource proxy with synthetic series')
+    parser.add_argument('--port', type=int, default=11202,
+                        help='Port to listen on')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on')
+    parser.add_argument('--step', type=int, default=10,
+                        help='Seconds between datapoints (sets payload size for given interval)')
+    parser.add_argument('--nulls', type=float, default=0.05,
+                        help='Fraction of datapoints which are null')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds to wait before answering each request')
+    parser.add_argument('--series', type=int, default=1000,
+                        help='Number of metrics in the tree for find and wildcards')
+    parser.add_argument('--prefix', default='bench',
+                        help='Prefix of metrics in the tree')
+    parser.add_argument('--node', default='node',
+                        help='Node name of metrics in the tree')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Change to get different data')
+    parser.add_argument('--debug', action='store_true',
+                        help='Debug mode')
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    Handler.generator = SeriesGenerator(
+        step=args.step, nulls=args.nulls, series=args.series,
+        prefix=args.prefix, node=args.node, seed=args.seed)
+    Handler.latency = args.latency
+    server = http.server.ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    logging.info("Listening on %s:%s" % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
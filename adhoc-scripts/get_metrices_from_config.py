@@ -1,24 +1,73 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
+import re
 import json
 
-with open('../ansible/roles/dashboard-generic/templates/satellite6_general_system_performance.json.j2', 'r') as fp:
-    data = json.load(fp)
+DASHBOARD = '../ansible/roles/dashboard-generic/templates/satellite6_general_system_performance.json.j2'
 
-for metric in data['dashboard']['rows']:
-    metric_title = metric['title']
-    for panel in metric['panels']:
+
+def load_dashboard(path=DASHBOARD):
+    with open(path, 'r') as fp:
+        data = json.load(fp)
+    return data.get('dashboard', data)   # older exports wrap it
+
+
+def dashboard_panels(dashboard):
+    """
+    Yield (row title, panel) for every panel with targets, both for old
+    dashboards with "rows" and for new ones where rows are panels of type
+    "row" (collapsed rows hold their panels inside).
+    """
+    if 'rows' in dashboard:
+        for row in dashboard['rows']:
+            for panel in row['panels']:
+                yield row['title'], panel
+        return
+    row_title = None
+    for panel in dashboard.get('panels', []):
+        if panel.get('type') == 'row':
+            row_title = panel.get('title')
+            for inner in panel.get('panels', []):
+                yield row_title, inner
+        else:
+            yield row_title, panel
+
+
+def panel_targets(panel):
+    """
+    Return list of (refId, target) of visible targets of the panel with
+    references to other queries of the panel (`#A`) inlined, as Grafana
+    sends them to Graphite.
+    """
+    by_ref = {t.get('refId'): t['target'] for t in panel.get('targets', []) if 'target' in t}
+
+    def inline(target, seen):
+        def replace(match):
+            ref = match.group(1)
+            if ref not in by_ref or ref in seen:
+                return match.group(0)
+            return inline(by_ref[ref], seen | set([ref]))
+        return re.sub(r'#([A-Z]+)\b', replace, target)
+
+    out = []
+    for target in panel.get('targets', []):
+        if 'target' not in target or target.get('hide'):
+            continue
+        out.append((target.get('refId'), inline(target['target'], set([target.get('refId')]))))
+    return out
+
+
+if __name__ == '__main__':
+    for metric_title, panel in dashboard_panels(load_dashboard()):
         panel_title = panel['title']
         panel_title = panel_title.replace('$Cloud - $Node', 'C/N')
-        for target in panel['targets']:
-            target_string = target['target']
-            if 'asPercent' in target_string \
-                or 'divideSeries' in target_string \
-                or 'sumSeries' in target_string:
-                continue
-            if target_string.startswith('alias('):
-                target_nickname = target_string.split("'")[1]
+        # Derived targets (asPercent, divideSeries, ...) are evaluated
+        # locally by get_stats_from_grafana.py from shared base series
+        for ref, target_string in panel_targets(panel):
+            alias = re.match(r"^alias\(.*,\s*'([^']*)'\)$", target_string, re.S)
+            if alias is not None:
+                target_nickname = alias.group(1)
             else:
                 target_nickname = target_string
             print("    (\"%s\", \"%s -> %s -> %s\")," % (target_string, metric_title, panel_title, target_nickname))
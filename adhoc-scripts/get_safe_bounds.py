@@ -1,24 +1,35 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
+import os
 import sys
 import argparse
 import logging
-import tabulate
 import json
 import csv
-import scipy.stats
-import statistics
+import warnings
+import numpy
+import stats_store
+import bounds_model
+import quantile_sketch
 
 # Constants for "meanpstdev" strategy
 PROPORTIONCUT = 0.1   # ignore 10% of biggest and smallest data when creating mean
 SAFEBOUNDARYBOOST = 3.0   # safe zone is +- X % more than what we determine in the code
 
 parser = argparse.ArgumentParser(description='Determine safe bounds (minimum and maximum) for stats - if given stat is out of these bounds, it might indicate a problem')
-parser.add_argument('files', type=argparse.FileType('r'), nargs='+',
-                    help='List of files to load historical stats from')
+parser.add_argument('files', nargs='+',
+                    help='List of files to load historical stats from (JSON stats files, FILE#PHASE, stats store directories or STORE_DIR#RUN)')
 parser.add_argument('--strategy', default='meanpstdev',
                     help='Strategy to compute safe zone. Should be dafeult all the time, meant only for experimenting')
+parser.add_argument('--quantiles', default=None,
+                    help='Coma separated extra quantile factors (e.g. p75,p99.9) to compute from quantile sketches of the runs')
+parser.add_argument('--model', default=None,
+                    help='Persistent bounds model file (.npz) to update with given files (only new runs need to be given) and compute bounds from')
+parser.add_argument('--window', type=int, default=None,
+                    help='When creating model, compute bounds only from this many latest runs')
+parser.add_argument('--decay', type=float, default=None,
+                    help='When creating model, weight of a run halves after this many newer runs (for running moments)')
 parser.add_argument('--file', default='/tmp/get_safe_bounds.json',
                     help='Output file to store safe bounds in')
 parser.add_argument('--csv', action='store_true',
@@ -32,45 +43,62 @@ if args.debug:
 
 logging.debug("Arguments: %s" % args)
 
-data = {}
-for f in args.files:
-    data[f.name] = json.load(f)
+runs, metrics, factors, values = stats_store.load_values(args.files)
+logging.debug("Loaded runs: %s" % runs)
 
-some_snap = next(iter(data.values()))
-metrics = some_snap.keys()
+if args.quantiles is not None:
+    extra = [f for f in args.quantiles.split(',') if f not in factors]
+    for factor in extra:
+        if quantile_sketch.quantile_of_factor(factor) is None:
+            parser.error('%s is not a quantile, use e.g. p99.9' % factor)
+    sketches = stats_store.load_sketches(args.files, metrics)
+    extra_values = quantile_sketch.quantile_matrix(sketches, [quantile_sketch.quantile_of_factor(f) for f in extra])
+    values = numpy.concatenate([values, extra_values], axis=2)
+    factors = factors + extra
 logging.debug("Going to process metrics: %s" % metrics)
-some_snap_metric = next(iter(some_snap.values()))
-factors = [i for i in some_snap_metric.keys() if i != 'metric']
 logging.debug("Going to process factors: %s" % factors)
 
-table_header = ['metric'] + factors
-table_data = []
-
-data_per_factor = {}
-for metric in metrics:
-    data_per_factor[metric] = {}
-    table_data_row = [metric]
-    for factor in factors:
-        if factor == 'histogram':
-            continue
-        data_tmp = []
-        for snap_data in data.values():
-            data_tmp.append(snap_data[metric][factor])
-        logging.debug("Counting trimmed mean for %s -> %s for values: %s" % (metric, factor, ','.join([str(i) for i in data_tmp])))
 
+if args.model is not None:
+    # Update persistent model with given runs and get bounds from it
+    if os.path.exists(args.model):
+        model = bounds_model.BoundsModel.load(args.model)
+        if (args.window or 0) != model.window_size or args.decay != model.decay:
+            logging.warning("Model %s uses window %s and decay %s, ignoring --window and --decay" % (args.model, model.window_size, model.decay))
+    else:
+        model = bounds_model.BoundsModel(window=args.window, decay=args.decay)
+    for r, run in enumerate(runs):
+        model.update(run, metrics, factors, values[r])
+    model.save(args.model)
+    logging.info("Model with %s runs saved into %s" % (len(model.runs), args.model))
+    metrics = model.metrics
+    factors = model.factors
+    lower, upper = model.bounds(args.strategy, PROPORTIONCUT, SAFEBOUNDARYBOOST)
+else:
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)   # all-NaN metric -> factor
         if args.strategy == 'meanpstdev':
             # Determine safe zone based on mean and pstdev margin
-            mean = scipy.stats.trim_mean(data_tmp, PROPORTIONCUT)
-            pstdev = statistics.pstdev(data_tmp)
-            data_per_factor[metric][factor] = (mean-pstdev*SAFEBOUNDARYBOOST, mean+pstdev*SAFEBOUNDARYBOOST)
+            mean = bounds_model.trim_mean(values, PROPORTIONCUT)
+            pstdev = numpy.nanstd(values, axis=0)
+            lower = mean - pstdev * SAFEBOUNDARYBOOST
+            upper = mean + pstdev * SAFEBOUNDARYBOOST
         elif args.strategy == 'minmax':
             # Determine safe zone based on min and max values
-            tmp_max = max(data_tmp)
-            tmp_min = min(data_tmp)
-            data_per_factor[metric][factor] = (tmp_min, tmp_max)
+            lower = numpy.nanmin(values, axis=0)
+            upper = numpy.nanmax(values, axis=0)
         else:
             raise Exception("Unknown safe zone generation strategy %s" % args.strategy)
 
+table_header = ['metric'] + factors
+table_data = []
+
+data_per_factor = {}
+for m, metric in enumerate(metrics):
+    data_per_factor[metric] = {}
+    table_data_row = [metric]
+    for f, factor in enumerate(factors):
+        data_per_factor[metric][factor] = (float(lower[m, f]), float(upper[m, f]))
         table_data_row += [' - '.join(['%.2f' % i for i in data_per_factor[metric][factor]])]
     table_data.append(table_data_row)
 
@@ -79,6 +107,7 @@ if args.csv:
     spamwriter.writerow(table_header)
     spamwriter.writerows(table_data)
 else:
+    import tabulate   # slow to import, not needed for csv
     print(tabulate.tabulate(table_data, headers=table_header, floatfmt='.1f'))
 
 with open(args.file, 'w') as fp:
@@ -1,17 +1,22 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
+import os
 import sys
 import argparse
 import logging
-import requests
-import statistics
-import scipy.integrate
-import numpy
-import tabulate
 import json
 import yaml
 import csv
+import series_stats
+import consolidation
+import quantile_sketch
+import whisper_backend
+import stats_store
+import metric_index
+import inventory
+import derived_series
+import profiling
 
 _si_prefixes = [
     ('T', 1e12),   # tera
@@ -29,10 +34,44 @@ parser.add_argument('from_ts', type=int,
                     help='timestamp (UTC) of start of the interval')
 parser.add_argument('to_ts', type=int,
                     help='timestamp (UTC) of end of the interval')
-parser.add_argument('--graphite', required=True,
-                    help='Graphite server to talk to')
+parser.add_argument('--graphite', default=None,
+                    help='Graphite server to talk to (required with grafana backend)')
+parser.add_argument('--backend', choices=['grafana', 'whisper', 'pcp'], default='grafana',
+                    help='Get data through Grafana datasource proxy, read Whisper files directly or read CSV exports of PCP archives')
+parser.add_argument('--storage-dir', default='/var/lib/carbon/whisper',
+                    help='Whisper files directory for whisper backend')
+parser.add_argument('--pcp-csv', nargs='+', default=None,
+                    help='CSV exports of PCP archives of the node (pmrep -o csv or pmdumptext -d,) for pcp backend')
+parser.add_argument('--pcp-map', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pcp_map.yaml'),
+                    help='yaml file mapping PCP metrics to collectd metric paths for pcp backend (defaults to pcp_map.yaml next to this script)')
+parser.add_argument('--pcp-time-format', default=None,
+                    help='strptime format of time column of PCP exports (defaults to Unix timestamp or ISO date and time, in UTC)')
 parser.add_argument('--chunk_size', type=int, default=10,
-                    help='How many metrices to obtain from Grafana at one request')
+                    help='How many metrices to obtain from Grafana at one request (initial value, adapted to response time)')
+parser.add_argument('--max-chunk-size', type=int, default=None,
+                    help='Upper limit for adapted chunk size (defaults to 10 times --chunk_size)')
+parser.add_argument('--target-latency', type=float, default=5.0,
+                    help='Grow chunks while Grafana answers faster than this many seconds, shrink them when slower')
+parser.add_argument('--parallel', type=int, default=4,
+                    help='How many requests to Grafana to run concurrently')
+parser.add_argument('--retries', type=int, default=3,
+                    help='How many times to retry request failed with 5xx status or connection error')
+parser.add_argument('--cache-dir', default=None,
+                    help='Cache fetched series in this directory and only fetch time ranges not cached yet')
+parser.add_argument('--cache-max-size', type=int, default=1024,
+                    help='Maximal size of the cache in MB, least recently used entries are evicted')
+parser.add_argument('--cache-max-age', type=int, default=30,
+                    help='Evict cache entries not used for this many days')
+parser.add_argument('--find-cache', default='/tmp/get_stats_from_grafana-find.json',
+                    help='Cache metrics found for wildcard targets (with "{1}" like placeholders in alias) in this file')
+parser.add_argument('--find-cache-ttl', type=int, default=3600,
+                    help='Look metrics for wildcard targets up again after this many seconds')
+parser.add_argument('--stream', action='store_true',
+                    help='Parse responses as they arrive and summarise series one by one to keep memory usage low')
+parser.add_argument('--max-datapoints', type=int, default=None,
+                    help='Let Graphite consolidate series to at most this many datapoints (min/max/mean/pstdev/pvariance stay exact, full resolution is fetched only for other columns requested by --only, approximated columns are not saved)')
+parser.add_argument('--phases', type=argparse.FileType('r'), default=None,
+                    help='yaml file with list of phases (name, from_ts and to_ts) within the interval, interval is fetched once and stats are computed for every phase')
 parser.add_argument('--port', type=int, default=11202,
                     help='Port Grafana is listening on')
 parser.add_argument('--prefix', default='satellite62',
@@ -43,10 +82,22 @@ parser.add_argument('--token', default=None,
                     help='Authorization token without the "Bearer: " part')
 parser.add_argument('--node', default='satellite_satperf_local',
                     help='Monitored host node name in Graphite')
+parser.add_argument('--nodes', nargs='+', default=None,
+                    help='Get stats for all these nodes (host names or node names in Graphite) at once, with fleet aggregates (overrides --node)')
+parser.add_argument('--inventory', default=None,
+                    help='Also get stats for hosts of --inventory-group in this Ansible inventory (conf/hosts.ini format)')
+parser.add_argument('--inventory-group', default='capsules',
+                    help='Inventory group with hosts to get stats for')
 parser.add_argument('--interface', default='interface-em1',
                     help='Monitored host network interface name in Graphite')
 parser.add_argument('--file', default='/tmp/get_stats_from_grafana.json',
                     help='Save stats to this file')
+parser.add_argument('--store', default=None,
+                    help='Also append stats as a run into this stats store directory')
+parser.add_argument('--run-name', default=None,
+                    help='Name of the run in stats store (defaults to --file)')
+parser.add_argument('--run-version', default=None,
+                    help='Satellite version to record for the run in stats store index')
 parser.add_argument('--metrices', nargs='+', type=argparse.FileType('r'),
                     default='get_stats_from_grafana-Minimal.yaml',
                     help='yaml files with metrices to display')
@@ -58,56 +109,175 @@ parser.add_argument('--only', default=None,
                     help='Only print these (coma separated) columns')
 parser.add_argument('--csv', action='store_true',
                     help='Output data table to stdout in csv (defauts to table)')
+parser.add_argument('--profile', default=None,
+                    help='Save timings of stages and requests, peak memory, etc. into this JSON file')
+parser.add_argument('--profile-carbon', default=None,
+                    help='Send profile summary to carbon plaintext port (HOST[:PORT], defaults to 2003)')
+parser.add_argument('--profile-statsd', default=None,
+                    help='Send profile summary as gauges to statsd (HOST[:PORT], defaults to 8125)')
+parser.add_argument('--profile-prefix', default='get_stats_from_grafana',
+                    help='Prefix of profile metric names sent to carbon/statsd')
 parser.add_argument('--debug', action='store_true',
                     help='Debug mode')
 args = parser.parse_args()
 
+if args.stream and args.cache_dir is not None:
+    parser.error('--stream can not be combined with --cache-dir')
+if args.backend == 'grafana' and args.graphite is None:
+    parser.error('--graphite is required with grafana backend')
+if args.backend == 'whisper' and (args.cache_dir is not None or args.max_datapoints is not None):
+    parser.error('--cache-dir and --max-datapoints can not be used with whisper backend')
+if args.backend == 'pcp' and args.pcp_csv is None:
+    parser.error('--pcp-csv is required with pcp backend')
+if args.backend == 'pcp' and (args.cache_dir is not None or args.max_datapoints is not None):
+    parser.error('--cache-dir and --max-datapoints can not be used with pcp backend')
+if args.backend == 'pcp' and (args.nodes is not None or args.inventory is not None):
+    parser.error('--nodes and --inventory can not be used with pcp backend (exports are of one node)')
+if args.phases is not None and args.max_datapoints is not None:
+    parser.error('--phases can not be combined with --max-datapoints')
+
+nodes = None
+if args.nodes is not None or args.inventory is not None:
+    hosts = list(args.nodes or [])
+    if args.inventory is not None:
+        hosts += inventory.order_hosts(inventory.read_group(args.inventory, args.inventory_group))
+    nodes = []
+    for host in hosts:
+        if inventory.node_name(host) not in nodes:
+            nodes.append(inventory.node_name(host))
+    if not nodes:
+        parser.error('no nodes to get stats for')
+
+phases = None
+if args.phases is not None:
+    phases = yaml.load(args.phases, Loader=yaml.SafeLoader)
+    for phase in phases:
+        if not args.from_ts <= phase['from_ts'] < phase['to_ts'] <= args.to_ts:
+            parser.error('phase %s is not within the interval' % phase['name'])
+
 if args.debug:
     logging.basicConfig(level=logging.DEBUG)
 
 logging.debug("Arguments: %s" % args)
 
-# Metrics we are interested in and their aliases
-targets = []
-for fp in args.metrices:
-    targets += yaml.load(fp, Loader=yaml.SafeLoader)
+profile = profiling.Profile()
+
+# Metrics we are interested in and their aliases, optional third item
+# "counter" marks cumulative counters we want stats of per second rate of
+try:
+    targets = metric_index.read_metric_files(args.metrices)
+except ValueError as e:
+    parser.error(str(e))
 logging.debug("Metrics: %s" % targets)
 
-def sanitize_target(target):
+def sanitize_target(target, node=None):
     target = target.replace('$Cloud', args.prefix)
-    target = target.replace('$Node', args.node)
+    target = target.replace('$Node', node or args.node)
     target = target.replace('$Interface', args.interface)
     return target
 
-def get_data(targets, args):
-    data = []
-    for i in range(0, len(targets), args.chunk_size):
-        targets_chunk = targets[i:i+args.chunk_size]
-
-        # Metadata for the request
-        headers = {
-            'Accept': 'application/json, text/plain, */*',
-        }
-        if args.token is not None:
-            headers['Authorization'] = 'Bearer %s' % args.token
-        params = {
-            'target': ["alias(%s, '%s')" % (sanitize_target(k), v) for k,v in targets_chunk],
-            'from': args.from_ts,
-            'until': args.to_ts,
-            'format': 'json',
-        }
-        url = "http://%s:%s/api/datasources/proxy/%s/render" % (args.graphite, args.port, args.datasource)
-
-        r = requests.get(url=url, headers=headers, params=params)
-        if not r.ok:
-            logging.error("URL = %s" % r.url)
-            logging.error("headers = %s" % r.headers)
-            logging.error("status code = %s" % r.status_code)
-            logging.error("text = %s" % r.text)
-            raise Exception("Request failed")
-        logging.debug("Response: %s" % r.json())
-        data += r.json()
-    return data
+def get_client(args):
+    import graphite_render   # requests is slow to import, not needed for whisper backend
+    return graphite_render.RenderClient(
+        args.graphite, args.port, args.datasource, token=args.token,
+        parallel=args.parallel, chunk_size=args.chunk_size,
+        max_chunk_size=args.max_chunk_size, target_latency=args.target_latency,
+        retries=args.retries, profile=profile)
+
+pcp_storage = None
+
+def get_storage(args):
+    """
+    Storage of whisper or pcp backend, PCP exports are mapped only once.
+    """
+    global pcp_storage
+    if args.backend == 'whisper':
+        return whisper_backend.WhisperStorage(args.storage_dir)
+    if pcp_storage is None:
+        import pcp_backend
+        try:
+            with open(args.pcp_map, 'r') as fp:
+                rules = pcp_backend.read_map(fp)
+            pcp_storage = pcp_backend.PcpStorage(
+                args.pcp_csv, rules, "%s.%s" % (args.prefix, args.node), args.pcp_time_format)
+        except (pcp_backend.PcpError, OSError) as e:
+            logging.error("Can not read PCP exports: %s" % e)
+            sys.exit(1)
+    return pcp_storage
+
+def expand_targets(targets, args):
+    """
+    Expand wildcard targets with alias templates into target per metric.
+    """
+    targets = [(sanitize_target(k), v) for k,v in targets]
+    if not any(metric_index.is_template(k, v) for k,v in targets):
+        return targets
+    if args.backend in ('whisper', 'pcp'):
+        storage = get_storage(args)
+        index = metric_index.MetricIndex(lambda pattern: [m for m, f in storage.find(pattern)])
+        return index.expand(targets)
+    client = get_client(args)
+    try:
+        index = metric_index.MetricIndex(
+            client.find, cache_file=args.find_cache, ttl=args.find_cache_ttl,
+            parallel=args.parallel, cache_key=client.find_url)
+        return index.expand(targets)
+    finally:
+        client.close()
+
+def fetch_data(targets, args, summarise=None):
+    """
+    Fetch series of sanitized (target, alias) pairs, named by the alias.
+    """
+    if not targets:
+        return []
+    if args.backend == 'pcp':
+        # All targets at once, so every export is read only once
+        data = get_storage(args).render(["alias(%s, '%s')" % (k, v) for k,v in targets], args.from_ts, args.to_ts)
+        return data if summarise is None else [summarise(d) for d in data]
+    if args.backend == 'whisper':
+        storage = whisper_backend.WhisperStorage(args.storage_dir)
+        data = []
+        for k,v in targets:
+            series = storage.render(["alias(%s, '%s')" % (k, v)], args.from_ts, args.to_ts)
+            data += series if summarise is None else [summarise(d) for d in series]
+        return data
+    client = get_client(args)
+    try:
+        if args.cache_dir is not None:
+            import render_cache
+            cache = render_cache.RenderCache(
+                args.cache_dir, max_size=args.cache_max_size*1024*1024,
+                max_age=args.cache_max_age*24*3600)
+            data = cache.render(client, targets, args.from_ts, args.to_ts)
+            return data if summarise is None else [summarise(d) for d in data]
+        return client.render(
+            ["alias(%s, '%s')" % (k, v) for k,v in targets],
+            args.from_ts, args.to_ts, summarise=summarise)
+    finally:
+        client.close()
+
+def get_data(targets, args, summarise=None):
+    """
+    Fetch series (or results of `summarise` for them) for all the targets
+    in their order. Derived targets are evaluated locally from leaf series
+    fetched once, see derived_series. Series are matched to targets by
+    index, so targets can share an alias.
+    """
+    targets = [(sanitize_target(k), v) for k,v in targets]
+    derived = derived_series.DerivedTargets(targets)
+    results = {}   # index of target -> list of series or summaries
+    remote = [(k, "target:%s" % i) for i, (k, v) in enumerate(targets) if i not in derived.trees]
+    for d in fetch_data(remote, args, summarise):
+        i = int((d[0] if summarise is not None else d['target']).split(':', 1)[1])
+        alias = targets[i][1]
+        results.setdefault(i, []).append((alias,) + tuple(d[1:]) if summarise is not None else dict(d, target=alias))
+    if derived.trees:
+        logging.debug("Evaluating %s derived targets from %s leaves" % (len(derived.trees), len(derived.leaves)))
+        # In stream mode leaves are parsed one by one too (into compact arrays)
+        for i, series in derived.evaluate_each(fetch_data(derived.leaf_targets(), args, (lambda series: series) if summarise is not None else None)):
+            results[i] = series if summarise is None else [summarise(d) for d in series]
+    return [d for i in range(len(targets)) for d in results.get(i, [])]
 
 def reformat_number_list(data):
     if not args.beauty:
@@ -127,15 +297,6 @@ def reformat_number_list(data):
             out.append(i)
     return out
 
-def get_hist(data):
-    hist_counts, hist_borders = numpy.histogram(data)
-    hist_counts = [float(i) for i in hist_counts]
-    hist_borders = [float(i) for i in hist_borders]
-    out = []
-    for i in range(len(hist_counts)):
-        out.append(((hist_borders[i], hist_borders[i+1]), hist_counts[i]))
-    return out
-
 def reformat_hist(data):
     #return ','.join(["%.2f-%.2f:%d" % (i[0][0], i[0][1], i[1]) for i in data])
     if not args.beauty_hist:
@@ -162,63 +323,235 @@ def reformat_hist_in_data_for_json(data, hist_id):
     data[hist_id] = {str("%s - %s" % k): "%.02f" % v for k, v in data[hist_id]}
     return data
 
-data = get_data(targets, args)
+def summarise(series):
+    if phases is not None:
+        return series['target'], series_stats.summarise_series_phases(
+            series['values'], series['timestamps'], [(p['from_ts'], p['to_ts']) for p in phases])
+    return series['target'], series_stats.summarise_series(series['values'], series['timestamps'], d_duration)
+
+def get_stats(targets, args):
+    """
+    Fetch full resolution data and return list of (metric, stats) pairs.
+    """
+    if args.stream:
+        with profile.stage('fetch_statistics'):   # series are summarised as they arrive
+            return get_data(targets, args, summarise=summarise)
+    with profile.stage('fetch'):
+        data = get_data(targets, args)
+    with profile.stage('statistics'):
+        values, timestamps = series_stats.series_matrix(data)
+        stats = series_stats.compute_stats(values, timestamps, d_duration)
+        return list(zip([d['target'] for d in data], series_stats.split_stats(stats)))
+
+def get_stats_phases(targets, args):
+    """
+    Fetch full resolution data for the whole interval once and return list
+    of (phase name, duration, list of (metric, stats) pairs), one per phase.
+    """
+    if args.stream:
+        with profile.stage('fetch_statistics'):
+            data = get_data(targets, args, summarise=summarise)
+        return [(p['name'], p['to_ts'] - p['from_ts'], [(metric, stats[i]) for metric, stats in data])
+                for i, p in enumerate(phases)]
+    with profile.stage('fetch'):
+        data = get_data(targets, args)
+    with profile.stage('statistics'):
+        values, timestamps = series_stats.series_matrix(data)
+        phase_stats = series_stats.compute_phase_stats(values, timestamps, [(p['from_ts'], p['to_ts']) for p in phases])
+    return [(p['name'], p['to_ts'] - p['from_ts'], list(zip([d['target'] for d in data], series_stats.split_stats(stats))))
+            for p, stats in zip(phases, phase_stats)]
+
+FLEET_AGGREGATES = [
+    ('fleet-sum', sum),
+    ('fleet-max', max),
+    ('fleet-mean', lambda values: sum(values) / len(values)),
+]
+FLEET_COLUMNS = ['min', 'max', 'mean', 'median', 'p90', 'p95', 'p99', 'int_per_dur', 'pstdev', 'pvariance', 'datapoints']
+
+def node_targets(targets, nodes):
+    """
+    Targets for all the nodes, aliases are prefixed by "<index of node>:".
+    """
+    return [(sanitize_target(k, node), "%s:%s" % (n, v)) for n, node in enumerate(nodes) for k,v in targets]
+
+def split_nodes(data):
+    """
+    Split list of (metric, stats) pairs for targets from `node_targets`
+    into list of (node, list of (metric, stats) pairs), followed by fleet
+    aggregates of every column over nodes which have given metric.
+    """
+    per_node = [[] for _ in nodes]
+    by_metric = {}
+    for metric, stats in data:
+        n, metric = metric.split(':', 1)
+        per_node[int(n)].append((metric, stats))
+        by_metric.setdefault(metric, []).append(stats)
+    out = list(zip(nodes, per_node))
+    for name, function in FLEET_AGGREGATES:
+        fleet = []
+        for metric, stats_list in by_metric.items():
+            fleet_stats = {column: function([s[column] for s in stats_list]) for column in FLEET_COLUMNS}
+            fleet_stats['histogram'] = {(0, 0): 0}
+            fleet.append((metric, fleet_stats))
+        out.append((name, fleet))
+    return out
+
+def get_stats_consolidated(targets, args, columns):
+    """
+    Fetch consolidated data and return list of (metric, stats) pairs and
+    list of columns which are exact. Full resolution data are fetched only
+    if some of the (explicitly requested) columns needs them.
+    """
+    sanitized = [sanitize_target(k) for k,v in targets]
+    # Derived and counter targets are evaluated locally from full resolution leaves
+    local = sorted(derived_series.DerivedTargets(list(zip(sanitized, [v for k,v in targets]))).trees)
+    if local:
+        logging.info("Fetching full resolution data for targets evaluated locally: %s" % ', '.join(targets[i][1] for i in local))
+    client = get_client(args)
+    try:
+        with profile.stage('fetch'):
+            data = client.render(
+                consolidation.consolidated_targets([None if i in local else k for i, k in enumerate(sanitized)]),
+                args.from_ts, args.to_ts, extra_params={'maxDataPoints': args.max_datapoints})
+            # Variance needs the means first, see consolidation
+            means = consolidation.compute_means(data, len(targets))
+            data += client.render(
+                consolidation.deviation_targets(sanitized, means),
+                args.from_ts, args.to_ts, extra_params={'maxDataPoints': args.max_datapoints})
+    finally:
+        client.close()
+    # Consolidated series of wildcard targets can not be told apart
+    multi = sorted(consolidation.multi_series(data))
+    if multi:
+        logging.warning("Fetching full resolution data for targets with several series: %s" % ', '.join(targets[i][1] for i in multi))
+    full_columns = [c for c in consolidation.FULL_RESOLUTION if c in columns]
+    if full_columns:
+        logging.info("Fetching full resolution data for %s" % ', '.join(full_columns))
+    full_indexes = sorted(set(multi) | set(local))
+    full_by_alias = {}
+    if full_columns or full_indexes:
+        for metric, metric_stats in get_stats(targets if full_columns else [targets[i] for i in full_indexes], args):
+            full_by_alias.setdefault(metric, []).append((metric, metric_stats))
+    full = {i: full_by_alias.pop(targets[i][1], []) for i in full_indexes}
+    with profile.stage('statistics'):
+        stats = consolidation.compute_stats(data, [v for k,v in targets], d_duration, full)
+    exact = consolidation.EXACT[:]
+    if full_columns:
+        copy_columns = full_columns[:]
+        if set(full_columns) & set(quantile_sketch.QUANTILES):
+            copy_columns.append('sketch')   # quantile columns are read from it
+        for metric, metric_stats in stats:
+            if metric in full_by_alias:   # targets with several series and local ones have full stats already
+                for column in copy_columns:
+                    metric_stats[column] = full_by_alias[metric][0][1][column]
+        exact += full_columns
+    return stats, exact
+
+if nodes is not None:
+    targets = node_targets(targets, nodes)
+with profile.stage('expand'):
+    targets = expand_targets(targets, args)
+logging.debug("Expanded metrics: %s" % targets)
+profile.count('targets', len(targets))
 
-table_header = ['metric', 'min', 'max', 'mean', 'median', 'int_per_dur', 'pstdev', 'pvariance', 'histogram', 'duration', 'datapoints']
+d_duration = args.to_ts - args.from_ts
+if phases is not None:
+    phase_data = get_stats_phases(targets, args)
+    exact_columns = None
+elif args.max_datapoints is None:
+    phase_data = [(None, d_duration, get_stats(targets, args))]
+    exact_columns = None
+else:
+    data, exact_columns = get_stats_consolidated(
+        targets, args,
+        args.only.split(',') if args.only is not None else [])
+    phase_data = [(None, d_duration, data)]
+
+table_header = ['metric', 'min', 'max', 'mean', 'median', 'p90', 'p95', 'p99', 'int_per_dur', 'pstdev', 'pvariance', 'histogram', 'duration', 'datapoints']
 table_data = []
-file_data = {}
-for d in data:
-    d_plain = [i[0] for i in d['datapoints'] if i[0] is not None]
-    d_timestamps = [i[1] for i in d['datapoints'] if i[0] is not None]
-    d_duration = args.to_ts - args.from_ts
-    d_len = len(d_plain)
-    if d_len < 5:
-        logging.warning('Very low number of datapoints returned for %s: %s' % (d['target'], d_len))
-    if len(d_plain) > 0:
-        d_min = min(d_plain)
-        d_max = max(d_plain)
-        d_mean = statistics.mean(d_plain)
-        d_median = statistics.median(d_plain)
-        d_integral = scipy.integrate.simps(d_plain, d_timestamps) / d_duration
-        d_pstdev = statistics.pstdev(d_plain)
-        d_pvariance = statistics.pvariance(d_plain)
-        d_hist = get_hist(d_plain)
-    else:
-        d_min = 0
-        d_max = 0
-        d_mean = 0
-        d_median = 0
-        d_integral = 0
-        d_pstdev = 0
-        d_pvariance = 0
-        d_hist = {(0, 0): 0}
-    table_row_data = [d_min, d_max, d_mean, d_median, d_integral, d_pstdev, d_pvariance, d_hist, d_duration, d_len]
-    file_row = [d['target']] + reformat_hist_in_data_for_json(table_row_data, 7)
-    table_row = [d['target']] + reformat_number_list(table_row_data)
-    table_data.append(table_row)
-    file_data[d['target']] = {table_header[i]:file_row[i] for i in range(len(table_header))}
+# With phases or nodes, stats are grouped by "phase", "node" or "phase/node"
+group_columns = (['phase'] if phases is not None else []) + (['node'] if nodes is not None else [])
+groups = []
+for d_phase, d_phase_duration, data in phase_data:
+    for d_node, node_data in (split_nodes(data) if nodes is not None else [(None, data)]):
+        labels = [i for i in (d_phase, d_node) if i is not None]
+        groups.append((labels, d_phase_duration, node_data))
+
+# Columns approximated from consolidated data are shown, but not saved, so
+# they are never compared or merged with exact stats of other runs
+approximate_columns = []
+if exact_columns is not None:
+    approximate_columns = [c for c in consolidation.EXACT + consolidation.FULL_RESOLUTION if c not in exact_columns]
+    if not set(quantile_sketch.QUANTILES) & set(exact_columns):   # sketch is copied from full resolution stats with them
+        approximate_columns.append('sketch')
+
+file_data = {}   # with groups it is keyed by group name first
+for d_labels, d_phase_duration, data in groups:
+    phase_file_data = file_data.setdefault('/'.join(d_labels), {}) if d_labels else file_data
+    for d_target, d_stats in data:
+        d_len = int(d_stats['datapoints'])
+        if d_len < 5:
+            logging.warning('Very low number of datapoints returned for %s: %s' % (d_target, d_len))
+        table_row_data = [float(d_stats[column]) for column in ('min', 'max', 'mean', 'median', 'p90', 'p95', 'p99', 'int_per_dur', 'pstdev', 'pvariance')] \
+            + [d_stats['histogram'], d_phase_duration, d_len]
+        file_row = [d_target] + reformat_hist_in_data_for_json(table_row_data, 10)
+        table_row = [d_target] + reformat_number_list(table_row_data)
+        table_row = d_labels + table_row
+        table_data.append(table_row)
+        phase_file_data[d_target] = {table_header[i]:file_row[i] for i in range(len(table_header)) if table_header[i] not in approximate_columns}
+        if 'sketch' in d_stats and 'sketch' not in approximate_columns:   # fleet aggregates do not have it
+            phase_file_data[d_target]['sketch'] = d_stats['sketch'].to_json()
+table_header = group_columns + table_header
 
 # Remove columns we do not want to show
 if args.only is not None:
     only_columns = args.only.split(',')
-    show_columns = set(table_header) - set(only_columns)
+    show_columns = set(table_header) - set(only_columns) - set(group_columns)
     for column in show_columns:
         column_id = table_header.index(column)
         table_header.remove(column)
         for row in table_data:
             del(row[column_id])
 
-if args.csv:
-    spamwriter = csv.writer(sys.stdout)
-    spamwriter.writerow(table_header)
-    spamwriter.writerows(table_data)
-else:
-    if 'histogram' in table_header:
-        hist_id = table_header.index('histogram')
-        for row in table_data:
-            row[hist_id] = reformat_hist(row[hist_id])
-    print(tabulate.tabulate(table_data, headers=table_header, floatfmt='.2f'))
+with profile.stage('output'):
+    if args.csv:
+        spamwriter = csv.writer(sys.stdout)
+        spamwriter.writerow(table_header)
+        spamwriter.writerows(table_data)
+    else:
+        if 'histogram' in table_header:
+            hist_id = table_header.index('histogram')
+            for row in table_data:
+                row[hist_id] = reformat_hist(row[hist_id])
+        import tabulate   # slow to import, not needed for csv
+        print(tabulate.tabulate(table_data, headers=table_header, floatfmt='.2f'))
+
+if exact_columns is not None:
+    shown = [c for c in approximate_columns if c != 'sketch']
+    note = "Exact columns: %s; approximate columns (not saved): %s" % (', '.join(exact_columns), ', '.join(shown) or 'none')
+    if args.csv:
+        logging.warning(note)
+    else:
+        print("\n%s" % note)
+
+with profile.stage('save'):
+    with open(args.file, 'w') as fp:
+        json.dump(file_data, fp, indent=4)
+        logging.info("Stats saved into %s" % args.file)
+
+if args.store is not None:
+    with profile.stage('store'):
+        store = stats_store.StatsStore(args.store)
+        if not group_columns:
+            store.append(args.run_name or args.file, file_data, time=args.from_ts, version=args.run_version)
+        else:
+            for group in file_data:
+                store.append("%s#%s" % (args.run_name or args.file, group), file_data[group], time=args.from_ts, version=args.run_version)
+    logging.info("Stats appended into store %s" % args.store)
 
-with open(args.file, 'w') as fp:
-    json.dump(file_data, fp, indent=4)
-    logging.info("Stats saved into %s" % args.file)
+if args.profile is not None:
+    profile.save(args.profile)
+if args.profile_carbon is not None:
+    profile.send_carbon(args.profile_carbon, args.profile_prefix)
+if args.profile_statsd is not None:
+    profile.send_statsd(args.profile_statsd, args.profile_prefix)
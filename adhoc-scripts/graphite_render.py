@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Client for Graphite render API reached through Grafana datasource proxy.
+
+Targets are fetched in chunks by a bounded pool of worker threads sharing
+one `requests.Session` (so connections are kept alive and reused). Chunk
+size is adapted to the time proxy needs to answer and failed requests
+(HTTP 5xx or connection errors) are retried with exponential backoff.
+Results are always returned in the order of the targets.
+
+In streaming mode responses are not decoded into Python lists at all, they
+are parsed as they arrive into compact arrays one series at a time and every
+series is handed to a callback (which summarises it) and dropped.
+"""
+
+import re
+import json
+import time
+import array
+import codecs
+import logging
+import concurrent.futures
+import requests
+import requests.adapters
+
+
+class RenderError(Exception):
+    pass
+
+
+class SeriesStreamParser(object):
+    """
+    Incremental parser of Graphite render JSON response:
+
+        [{"target": "...", "datapoints": [[1.0, 1500000010], [null, 1500000020], ...]}, ...]
+
+    Feed it with pieces of response text, it returns series completed so far
+    as dicts with 'target' and 'values' and 'timestamps' as `array('d')`
+    (NaN for nulls). Only the series being parsed is held in memory.
+    """
+
+    _ws_re = re.compile(r'[\s,]*')
+    _point_re = re.compile(r'[\s,]*\[\s*(null|[-+0-9.eE]+)\s*,\s*([-+0-9.eE]+)\s*\]')
+
+    def __init__(self):
+        self.buf = ''
+        self.pos = 0
+        self.state = 'start'
+        self.series = None
+        self.key = None
+        self.decoder = json.JSONDecoder()
+
+    def _skip(self):
+        self.pos = self._ws_re.match(self.buf, self.pos).end()
+        return self.buf[self.pos] if self.pos < len(self.buf) else None
+
+    def feed(self, text):
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+        out = []
+        while True:
+            char = self._skip()
+            if char is None:
+                break
+            if self.state == 'start':
+                if char != '[':
+                    raise RenderError("Unexpected response, expected '[' at the beginning")
+                self.pos += 1
+                self.state = 'series'
+            elif self.state == 'series':
+                if char == ']':
+                    self.pos += 1
+                    self.state = 'end'
+                elif char == '{':
+                    self.pos += 1
+                    self.series = {'target': None, 'values': array.array('d'), 'timestamps': array.array('d')}
+                    self.state = 'key'
+                else:
+                    raise RenderError("Unexpected response, expected series at %s" % self.pos)
+            elif self.state == 'key':
+                if char == '}':
+                    self.pos += 1
+                    out.append(self.series)
+                    self.series = None
+                    self.state = 'series'
+                    continue
+                try:
+                    key, end = self.decoder.raw_decode(self.buf, self.pos)
+                except ValueError:
+                    break   # incomplete, wait for more data
+                colon = self.buf.find(':', end)
+                if colon == -1:
+                    break
+                self.key = key
+                self.pos = colon + 1
+                self.state = 'value'
+            elif self.state == 'value':
+                if self.key == 'datapoints':
+                    if char != '[':
+                        raise RenderError("Unexpected response, expected datapoints list at %s" % self.pos)
+                    self.pos += 1
+                    self.state = 'datapoints'
+                    continue
+                try:
+                    value, end = self.decoder.raw_decode(self.buf, self.pos)
+                except ValueError:
+                    break
+                if end >= len(self.buf):
+                    break   # number might continue in next piece of data
+                self.pos = end
+                if self.key == 'target':
+                    self.series['target'] = value
+                self.state = 'key'
+            elif self.state == 'datapoints':
+                values = self.series['values']
+                timestamps = self.series['timestamps']
+                match = self._point_re.match(self.buf, self.pos)
+                while match:
+                    value = match.group(1)
+                    values.append(float('nan') if value == 'null' else float(value))
+                    timestamps.append(float(match.group(2)))
+                    self.pos = match.end()
+                    match = self._point_re.match(self.buf, self.pos)
+                char = self._skip()
+                if char == ']':
+                    self.pos += 1
+                    self.state = 'key'
+                elif char is not None and self.buf.find(']', self.pos) != -1 and char != '[':
+                    raise RenderError("Unexpected response, can not parse datapoints at %s" % self.pos)
+                else:
+                    break
+            else:
+                raise RenderError("Unexpected data after end of response")
+        return out
+
+    def close(self):
+        if self.state != 'end':
+            raise RenderError("Response ended prematurely")
+
+
+class RenderClient(object):
+
+    def __init__(self, graphite, port, datasource, token=None,
+                 parallel=4, chunk_size=10, max_chunk_size=None,
+                 target_latency=5.0, retries=3, backoff=0.5, timeout=300, profile=None):
+        self.url = "http://%s:%s/api/datasources/proxy/%s/render" % (graphite, port, datasource)
+        self.find_url = "http://%s:%s/api/datasources/proxy/%s/metrics/find" % (graphite, port, datasource)
+        self.parallel = max(1, parallel)
+        self.chunk_size = max(1, chunk_size)
+        self.min_chunk_size = 1
+        self.max_chunk_size = max_chunk_size if max_chunk_size is not None else self.chunk_size * 10
+        self.target_latency = target_latency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.profile = profile   # profiling.Profile to record requests into
+
+        self.headers = {
+            'Accept': 'application/json, text/plain, */*',
+        }
+        if token is not None:
+            self.headers['Authorization'] = 'Bearer %s' % token
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.parallel)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def get(self, url, params, stream=False):
+        """
+        GET given URL, retrying on server side errors. Returns response and
+        `time.monotonic()` when its attempt started, so callers can measure
+        latency of the request without retries and backoff sleeps.
+        """
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                r = self.session.get(url=url, headers=self.headers, params=params, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.retries:
+                    raise RenderError("Request failed: %s" % e)
+                logging.warning("Request failed (%s), retrying" % e)
+            else:
+                if r.ok:
+                    return r, started
+                # Read (small) error body of streamed response, so closing
+                # it returns the connection to the pool
+                r.content
+                r.close()
+                if r.status_code < 500 or attempt >= self.retries:
+                    logging.error("URL = %s" % r.url)
+                    logging.error("headers = %s" % r.headers)
+                    logging.error("status code = %s" % r.status_code)
+                    logging.error("text = %s" % r.text)
+                    raise RenderError("Request failed")
+                logging.warning("Request returned %s, retrying" % r.status_code)
+            if self.profile is not None:
+                self.profile.count('retries')
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    def find(self, query):
+        """
+        Return list of metric paths (leaves) matching given Graphite pattern.
+        """
+        r, started = self.get(self.find_url, {'query': query})
+        data = r.json()
+        if self.profile is not None:
+            self.profile.request('find', time.monotonic() - started, len(r.content), series=len(data))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Find response for %s: %s" % (query, data))
+        return [i['id'] for i in data if i.get('leaf')]
+
+    def render_chunk(self, targets, from_ts, to_ts, extra_params=None):
+        """
+        Fetch one chunk of targets with one request. Returns list of series
+        and latency (of the last attempt, including decoding).
+        """
+        params = {
+            'target': targets,
+            'from': from_ts,
+            'until': to_ts,
+            'format': 'json',
+        }
+        params.update(extra_params or {})
+        r, started = self.get(self.url, params)
+        latency = time.monotonic() - started
+        data = r.json()
+        if self.profile is not None:
+            self.profile.request('render', latency, len(r.content), series=len(data),
+                                 decode=time.monotonic() - started - latency)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):   # formatting whole response is expensive
+            logging.debug("Response for %s: %s" % (targets, data))
+        return data, time.monotonic() - started
+
+    def render_chunk_stream(self, targets, from_ts, to_ts, summarise, extra_params=None):
+        """
+        Fetch one chunk of targets with one request, parsing response as it
+        arrives. Returns list of `summarise(series)` results and latency (of
+        the last attempt, including parsing and summarising).
+        """
+        params = {
+            'target': targets,
+            'from': from_ts,
+            'until': to_ts,
+            'format': 'json',
+        }
+        params.update(extra_params or {})
+        out = []
+        size = 0
+        r, started = self.get(self.url, params, stream=True)
+        with r:
+            latency = time.monotonic() - started
+            decoder = codecs.getincrementaldecoder(r.encoding or 'utf-8')(errors='replace')
+            parser = SeriesStreamParser()
+            for chunk in r.iter_content(chunk_size=64*1024):
+                size += len(chunk)
+                for series in parser.feed(decoder.decode(chunk)):
+                    logging.debug("Parsed %s datapoints for %s" % (len(series['values']), series['target']))
+                    out.append(summarise(series))
+            parser.feed(decoder.decode(b'', final=True))
+            parser.close()
+        if self.profile is not None:
+            # decode time includes summarising of the series
+            self.profile.request('render', latency, size, series=len(out),
+                                 decode=time.monotonic() - started - latency)
+        return out, time.monotonic() - started
+
+    def _adapt_chunk_size(self, latency):
+        """
+        Grow chunk while proxy answers quickly, halve it when it is slow.
+        """
+        if latency > self.target_latency:
+            self.chunk_size = max(self.min_chunk_size, self.chunk_size // 2)
+        elif latency < self.target_latency / 2:
+            self.chunk_size = min(self.max_chunk_size, self.chunk_size + max(1, self.chunk_size // 2))
+        logging.debug("Chunk answered in %.2fs, chunk size is now %s" % (latency, self.chunk_size))
+
+    def _render_chunk(self, targets, from_ts, to_ts, summarise, extra_params):
+        if summarise is None:
+            return self.render_chunk(targets, from_ts, to_ts, extra_params)
+        return self.render_chunk_stream(targets, from_ts, to_ts, summarise, extra_params)
+
+    def render(self, targets, from_ts, to_ts, summarise=None, extra_params=None):
+        """
+        Fetch all the targets concurrently. Returns list of series in order
+        of given targets. If `summarise` callback is given, responses are
+        streamed and list of its results for every series is returned instead.
+        `extra_params` (e.g. maxDataPoints) are added to every request.
+        """
+        results = {}   # offset of the chunk in targets -> list of series
+        pending = {}   # future -> offset of the chunk in targets
+        offset = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            while offset < len(targets) or pending:
+                while offset < len(targets) and len(pending) < self.parallel:
+                    targets_chunk = targets[offset:offset+self.chunk_size]
+                    future = executor.submit(self._render_chunk, targets_chunk, from_ts, to_ts, summarise, extra_params)
+                    pending[future] = offset
+                    offset += len(targets_chunk)
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    chunk_offset = pending.pop(future)
+                    data, latency = future.result()
+                    self._adapt_chunk_size(latency)
+                    results[chunk_offset] = data
+        out = []
+        for chunk_offset in sorted(results):
+            out += results[chunk_offset]
+        return out
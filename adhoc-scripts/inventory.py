@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Read monitored hosts from Ansible inventory (conf/hosts.ini style) and turn
+them into node names used in Graphite.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ansible', 'filter_plugins'))
+from satellite_install_filters import hosts_to_dictionary
+
+
+def read_group(path, group):
+    """
+    Return list of hosts in given group of INI inventory (including hosts
+    of its ":children" groups).
+    """
+    sections = {}
+    section = None
+    with open(path, 'r') as fp:
+        for line in fp:
+            line = line.strip()
+            if not line or line.startswith(('#', ';')):
+                continue
+            if line.startswith('[') and line.endswith(']'):
+                section = line[1:-1]
+                sections.setdefault(section, [])
+                continue
+            if section is not None:
+                sections[section].append(line.split()[0])
+
+    def hosts(name, seen):
+        out = []
+        for item in sections.get("%s:children" % name, []):
+            if item not in seen:
+                out += hosts(item, seen | set([item]))
+        return sections.get(name, []) + out
+
+    if group not in sections and "%s:children" % group not in sections:
+        raise ValueError("Group %s not found in %s" % (group, path))
+    out = []
+    for host in hosts(group, set([group])):
+        if host not in out:
+            out.append(host)
+    return out
+
+
+def order_hosts(hosts):
+    """
+    Order hosts by index in their short name suffix (capsule-2 before
+    capsule-10) the same way `hosts_to_dictionary` filter numbers them.
+    Hosts are kept in given order when they can not be numbered.
+    """
+    short = [h.split('.')[0] for h in hosts]
+    try:
+        indexed = hosts_to_dictionary(short)
+    except ValueError:
+        return hosts
+    if len(indexed) != len(hosts):
+        return hosts
+    return [hosts[short.index(indexed[i])] for i in sorted(indexed)]
+
+
+def node_name(host):
+    """
+    Node name in Graphite as collectd write_graphite plugin creates it
+    (with EscapeCharacter "_").
+    """
+    return host.replace('.', '_')
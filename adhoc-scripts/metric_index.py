@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Expansion of wildcard targets from metric yaml files.
+
+Target with glob pattern in its metric path (`*`, `?`, `[...]`, `{a,b}`)
+whose alias refers to wildcards with `{1}`, `{2}`, ... placeholders is
+expanded into one target per matching metric, e.g.
+
+    - $Cloud.$Node.processes-*.ps_rss
+    - Satellite6 Process Memory -> Summerized -> {1} RSS
+
+gives one target for every process with alias holding text matched by the
+first wildcard. Targets without placeholders are left to Graphite as before
+(e.g. `sum($Cloud.$Node.*.disk_octets.read)`).
+
+Patterns are resolved by one `/metrics/find` call each (Graphite matches
+whole pattern, the tree is not walked level by level), calls run
+concurrently and their results are kept in a JSON cache file for `ttl`
+seconds so repeated runs do not ask again.
+"""
+
+import os
+import re
+import time
+import json
+import logging
+import tempfile
+import concurrent.futures
+import yaml
+import derived_series
+
+_path_re = re.compile(r'(?:[\w\-.*?\[\]]|\{[^{}]*\})+')
+_wildcard_re = re.compile(r'\*|\?|\[[^\]]*\]|\{[^{}]*\}')
+_placeholder_re = re.compile(r'\{(\d+)\}')
+
+
+def read_metric_files(files):
+    """
+    Read metric yaml files (open file objects) into list of [target, alias]
+    pairs. Optional third item "counter" marks cumulative counters, their
+    target is turned into per second rate.
+    """
+    targets = []
+    for fp in files:
+        for entry in yaml.load(fp, Loader=yaml.SafeLoader):
+            if len(entry) > 2:
+                if entry[2:] != ['counter']:
+                    raise ValueError('unknown flags %s of metric %s in %s' % (entry[2:], entry[1], fp.name))
+                entry = [derived_series.counter_target(entry[0]), entry[1]]
+            targets.append(entry)
+    return targets
+
+
+def wildcard_path(expression):
+    """
+    Return (start, end) of first metric path with wildcards in the target
+    expression, None if there is none.
+    """
+    for match in _path_re.finditer(expression):
+        if '.' in match.group(0) and _wildcard_re.search(match.group(0)):
+            return match.start(), match.end()
+    return None
+
+
+def metric_paths(expression):
+    """
+    Return list of all metric paths (with or without wildcards) in the
+    target expression. Quoted arguments and numbers are skipped.
+    """
+    expression = re.sub(r"'[^']*'|\"[^\"]*\"", "''", expression)
+    out = []
+    for match in _path_re.finditer(expression):
+        path = match.group(0)
+        if '.' not in path:
+            continue
+        try:
+            float(path)
+        except ValueError:
+            out.append(path)
+    return out
+
+
+def pattern_regex(pattern):
+    """
+    Compile Graphite glob pattern into regular expression with one group
+    per wildcard.
+    """
+    out = ''
+    pos = 0
+    for match in _wildcard_re.finditer(pattern):
+        out += re.escape(pattern[pos:match.start()])
+        wildcard = match.group(0)
+        if wildcard == '*':
+            out += '([^.]*)'
+        elif wildcard == '?':
+            out += '([^.])'
+        elif wildcard.startswith('['):
+            out += '(%s)' % wildcard
+        else:
+            out += '(%s)' % '|'.join(re.escape(i) for i in wildcard[1:-1].split(','))
+        pos = match.end()
+    return re.compile(out + re.escape(pattern[pos:]) + '$')
+
+
+def is_template(target, alias):
+    return wildcard_path(target) is not None and _placeholder_re.search(alias) is not None
+
+
+class MetricIndex(object):
+
+    def __init__(self, find, cache_file=None, ttl=3600, parallel=4, cache_key=''):
+        self.find = find   # callable pattern -> list of metric paths
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.parallel = max(1, parallel)
+        self.cache_key = cache_key   # e.g. URL of the datasource, so caches of different servers do not mix
+        self.cache = {}
+        if cache_file is not None and os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'r') as fp:
+                    self.cache = json.load(fp)
+            except ValueError:
+                logging.warning("Ignoring corrupted find cache %s" % cache_file)
+
+    def _save(self):
+        if self.cache_file is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.cache_file))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(self.cache, fp)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, self.cache_file)
+
+    def lookup(self, patterns):
+        """
+        Return dict pattern -> sorted list of matching metric paths. Patterns
+        not in the cache (or expired) are looked up concurrently.
+        """
+        now = time.time()
+        keys = {pattern: "%s|%s" % (self.cache_key, pattern) for pattern in patterns}
+        for key in [k for k, v in self.cache.items() if v['time'] < now - self.ttl]:
+            del self.cache[key]
+        missing = sorted(set(p for p in patterns if keys[p] not in self.cache))
+        if missing:
+            logging.debug("Looking up %s patterns: %s" % (len(missing), missing))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel) as executor:
+                for pattern, metrics in zip(missing, executor.map(self.find, missing)):
+                    self.cache[keys[pattern]] = {'time': now, 'metrics': sorted(metrics)}
+            self._save()
+        return {pattern: self.cache[keys[pattern]]['metrics'] for pattern in patterns}
+
+    def expand(self, targets):
+        """
+        Expand list of (target, alias) pairs with sanitized targets. Templates
+        (see module docstring) are replaced by one pair per matching metric,
+        other pairs are kept as they are.
+        """
+        templates = [(target, alias) for target, alias in targets if is_template(target, alias)]
+        found = self.lookup([target[slice(*wildcard_path(target))] for target, alias in templates])
+        out = []
+        for target, alias in targets:
+            if not is_template(target, alias):
+                out.append((target, alias))
+                continue
+            start, end = wildcard_path(target)
+            regex = pattern_regex(target[start:end])
+            metrics = found[target[start:end]]
+            if not metrics:
+                logging.warning("Pattern %s does not match any metric" % target[start:end])
+            for metric in metrics:
+                match = regex.match(metric)
+                if match is None:
+                    continue
+                groups = match.groups()
+                out.append((
+                    target[:start] + metric + target[end:],
+                    _placeholder_re.sub(lambda m: groups[int(m.group(1)) - 1] if 0 < int(m.group(1)) <= len(groups) else m.group(0), alias)))
+        return out
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Read series from CSV exports of PCP archives (pmrep -o csv, pmdumptext -d,)
+for hosts which record PCP and not collectd, so their stats can be computed,
+compared and checked the same way.
+
+PCP metrics and instances in the header are mapped to collectd metric paths
+used in metric yaml files by rules of a map file (see pcp_map.yaml), so
+e.g. hotproc RSS of all httpd processes becomes
+`$Cloud.$Node.processes-httpd.ps_rss`. Header columns can be written as
+`metric-instance` (pmrep) or `[host:]metric["instance"]` (pmdumptext).
+
+Files are memory-mapped and never read whole: start of the interval is
+found by bisection over the rows (exports are chronological) and rows are
+parsed in chunks, keeping only columns the targets need, so multi-gigabyte
+exports take memory of just the fetched series. Time column can be a Unix
+timestamp or "YYYY-MM-DD HH:MM:SS[.fff]" (export with `-Z UTC`, times are
+taken as UTC), other formats need `time_format` (strptime format).
+
+Target expressions are evaluated as by whisper backend (alias, scale, sum).
+"""
+
+import re
+import csv
+import mmap
+import logging
+import datetime
+import numpy
+import yaml
+import metric_index
+import whisper_backend
+
+FIRST_CHUNK_SIZE = 256 * 1024   # grows up to CHUNK_SIZE, short intervals need few rows
+CHUNK_SIZE = 32 * 1024 * 1024
+MISSING = (b'', b'?', b'N/A', b'-')
+
+_column_re = re.compile(r'^(?:[^:\[\]"]+:)?([A-Za-z_][\w.]*)(?:\["?(.*?)"?\]|-(.*))?$')
+
+
+class PcpError(Exception):
+    pass
+
+
+def parse_column(name):
+    """
+    Return (metric, instance or None) of CSV header column.
+    """
+    match = _column_re.match(name.strip())
+    if match is None:
+        return None, None
+    return match.group(1), match.group(2) if match.group(2) is not None else match.group(3)
+
+
+def read_map(fp):
+    """
+    Read map file into list of rules (dicts with 'pcp', compiled 'instance'
+    or None, 'path', 'scale' and 'aggregate'). Process metrics are expanded
+    into one rule per process group.
+    """
+    data = yaml.load(fp, Loader=yaml.SafeLoader)
+    entries = []
+    for group, regex in data.get('processes', {}).items():
+        for metric in data.get('process_metrics', []):
+            entries.append(dict(metric, instance=regex, path="processes-%s.%s" % (group, metric['path'])))
+    entries += data.get('metrics', [])
+    rules = []
+    for entry in entries:
+        if entry.get('aggregate', 'sum') not in ('sum', 'count'):
+            raise PcpError("Unknown aggregate %s of %s" % (entry['aggregate'], entry['path']))
+        rules.append({
+            'pcp': entry['pcp'],
+            'instance': re.compile(entry['instance']) if 'instance' in entry else None,
+            'path': entry['path'],
+            'scale': float(entry.get('scale', 1)),
+            'aggregate': entry.get('aggregate', 'sum'),
+        })
+    return rules
+
+
+def parse_times(cells, time_format=None):
+    """
+    Convert list of time cells (bytes) into array of Unix timestamps.
+    """
+    if time_format is not None:
+        return numpy.array([datetime.datetime.strptime(c.decode(), time_format).replace(tzinfo=datetime.timezone.utc).timestamp()
+                            for c in cells], dtype=float)
+    cells = numpy.array(cells)
+    try:
+        return cells.astype(float)
+    except ValueError:
+        pass
+    try:
+        return cells.astype('U').astype('datetime64[ms]').astype(numpy.int64) / 1000.0
+    except ValueError:
+        raise PcpError("Unknown time format of %s, use time format option" % cells[0].decode())
+
+
+def parse_values(cells):
+    """
+    Convert 2-D list of value cells (bytes) into float array, missing values
+    become NaN.
+    """
+    cells = numpy.array(cells, dtype=bytes).reshape(len(cells), -1)
+    cells[numpy.isin(cells, MISSING)] = b'nan'
+    try:
+        return cells.astype(float)
+    except ValueError:
+        out = numpy.full(cells.shape, numpy.nan)
+        for index, cell in numpy.ndenumerate(cells):
+            try:
+                out[index] = float(cell)
+            except ValueError:
+                pass
+        return out
+
+
+class PcpExport(object):
+    """
+    One memory-mapped CSV export.
+    """
+
+    def __init__(self, path, time_format=None):
+        self.path = path
+        self.time_format = time_format
+        with open(path, 'rb') as fp:
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(self.mm, 'madvise'):
+            self.mm.madvise(mmap.MADV_SEQUENTIAL)
+        end = self.mm.find(b'\n')
+        if end < 0:
+            raise PcpError("%s has no data" % path)
+        self.columns = next(csv.reader([self.mm[:end].decode()]))
+        self.header_time = self.columns[0].encode()
+        # Skip other header lines (e.g. units of pmdumptext)
+        self.data_start = end + 1
+        while self.data_start < len(self.mm) and self._line_time(self.data_start) is None:
+            self.data_start = self.mm.find(b'\n', self.data_start) + 1 or len(self.mm)
+
+    def close(self):
+        self.mm.close()
+
+    def _line_time(self, start):
+        end = self.mm.find(b',', start)
+        if end < 0:
+            return None
+        try:
+            return float(parse_times([self.mm[start:end]], self.time_format)[0])
+        except (PcpError, ValueError):
+            return None
+
+    def seek(self, ts):
+        """
+        Byte offset of a line at or before the first row with time >= `ts`
+        (rows are chronological).
+        """
+        lo, hi = self.data_start, len(self.mm)
+        while hi - lo > 65536:
+            mid = (lo + hi) // 2
+            start = self.mm.find(b'\n', mid) + 1
+            if start == 0 or start >= hi:
+                hi = mid
+                continue
+            t = self._line_time(start)
+            if t is not None and t < ts:
+                lo = start
+            else:
+                hi = mid
+        return lo
+
+    def read(self, columns, from_ts, until_ts):
+        """
+        Return (timestamps, values) arrays of rows with from_ts < time <=
+        until_ts, values has one column per given column index.
+        """
+        times = []
+        values = []
+        position = self.seek(from_ts)
+        width = len(self.columns)
+        done = False
+        size = FIRST_CHUNK_SIZE
+        while position < len(self.mm) and not done:
+            end = self.mm.rfind(b'\n', position, position + size)
+            if end < 0 or position + size >= len(self.mm):
+                end = len(self.mm)
+            size = min(size * 2, CHUNK_SIZE)
+            chunk = self.mm[position:end]
+            position = end + 1
+            if b'"' in chunk:
+                rows = list(csv.reader(chunk.decode().splitlines()))
+                rows = [[c.encode() for c in row] for row in rows if len(row) == width]
+            else:
+                rows = [row for row in (line.split(b',') for line in chunk.split(b'\n')) if len(row) == width]
+            rows = [row for row in rows if row[0] != self.header_time]   # repeated header lines
+            if not rows:
+                continue
+            chunk_times = parse_times([row[0] for row in rows], self.time_format)
+            if chunk_times[-1] > until_ts:
+                done = True
+            keep = (chunk_times > from_ts) & (chunk_times <= until_ts)
+            if not keep.any():
+                continue
+            rows = [row for row, k in zip(rows, keep) if k]
+            times.append(chunk_times[keep])
+            values.append(parse_values([[row[c] for c in columns] for row in rows]))
+            logging.debug("Read %s rows of %s up to %s" % (len(rows), self.path, position))
+        if not times:
+            return numpy.zeros(0), numpy.zeros((0, len(columns)))
+        return numpy.concatenate(times), numpy.concatenate(values)
+
+
+class PcpStorage(whisper_backend.WhisperStorage):
+    """
+    Series of mapped metrics in CSV exports, with the same interface as
+    WhisperStorage. Metric paths are `root` (e.g. "satellite62.node")
+    followed by the mapped path.
+    """
+
+    def __init__(self, files, rules, root, time_format=None):
+        self.exports = [PcpExport(f, time_format) for f in files]
+        self.paths = {}   # metric path -> list of (export index, column, scale, aggregate)
+        for e, export in enumerate(self.exports):
+            for c, column in enumerate(export.columns[1:], start=1):
+                metric, instance = parse_column(column)
+                for rule in rules:
+                    if rule['pcp'] != metric:
+                        continue
+                    if rule['instance'] is None:
+                        groups = ()
+                    else:
+                        match = rule['instance'].fullmatch(instance or '')
+                        if match is None:
+                            continue
+                        groups = match.groups()
+                    path = re.sub(r'\{(\d+)\}', lambda m: groups[int(m.group(1)) - 1], rule['path'])
+                    self.paths.setdefault("%s.%s" % (root, path), []).append((e, c, rule['scale'], rule['aggregate']))
+        logging.debug("Mapped %s metric paths from %s" % (len(self.paths), files))
+        self.loaded = {}   # (export index, column, from_ts, until_ts) -> (timestamps, values)
+
+    def close(self):
+        for export in self.exports:
+            export.close()
+
+    def find(self, path):
+        """
+        Return sorted list of (metric path, columns) matching given Graphite
+        path pattern.
+        """
+        regex = metric_index.pattern_regex(path)
+        return sorted((metric, columns) for metric, columns in self.paths.items() if regex.match(metric))
+
+    def load(self, paths, from_ts, until_ts):
+        """
+        Read columns of all given path patterns in one pass over every file.
+        """
+        wanted = {}
+        for path in paths:
+            for metric, columns in self.find(path):
+                for e, c, scale, aggregate in columns:
+                    if (e, c, from_ts, until_ts) not in self.loaded:
+                        wanted.setdefault(e, set()).add(c)
+        for e, columns in wanted.items():
+            columns = sorted(columns)
+            timestamps, values = self.exports[e].read(columns, from_ts, until_ts)
+            for i, c in enumerate(columns):
+                self.loaded[(e, c, from_ts, until_ts)] = (timestamps, values[:, i])
+
+    def fetch(self, path, from_ts, until_ts):
+        self.load([path], from_ts, until_ts)
+        out = []
+        for metric, columns in self.find(path):
+            parts = []
+            for e, c, scale, aggregate in columns:
+                timestamps, values = self.loaded[(e, c, from_ts, until_ts)]
+                parts.append((timestamps, (~numpy.isnan(values)).astype(float) if aggregate == 'count' else values * scale))
+            timestamps = numpy.unique(numpy.concatenate([p[0] for p in parts]))
+            if len(timestamps) == 0:
+                continue
+            step = float(numpy.median(numpy.diff(timestamps))) if len(timestamps) > 1 else 1.0
+            length = int(numpy.rint((timestamps[-1] - timestamps[0]) / step)) + 1
+            stacked = numpy.full((len(parts), length), numpy.nan)
+            for row, (t, v) in enumerate(parts):
+                stacked[row, numpy.rint((t - timestamps[0]) / step).astype(int)] = v
+            values = numpy.nansum(stacked, axis=0)
+            values[numpy.isnan(stacked).all(axis=0)] = numpy.nan
+            out.append({'name': metric, 'start': float(timestamps[0]), 'step': step, 'values': values})
+        return out
+
+    def render(self, targets, from_ts, until_ts):
+        self.load([p for target in targets for p in metric_index.metric_paths(target)], from_ts, until_ts)
+        return super(PcpStorage, self).render(targets, from_ts, until_ts)
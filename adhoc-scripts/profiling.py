@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Lightweight instrumentation of the stats pipeline.
+
+Stages (fetch, statistics, output, ...) record wall and CPU time and peak
+RSS of the process when they finish, render client records every request
+(latency, response size, decode time, number of series). The profile is
+saved as JSON and can be sent to carbon (plaintext protocol over TCP) or
+statsd (e.g. collectd statsd plugin, UDP) so the tooling itself shows up
+on monitoring dashboards.
+"""
+
+import sys
+import math
+import time
+import json
+import socket
+import logging
+import resource
+import threading
+import contextlib
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def parse_address(address, default_port):
+    host, _, port = address.rpartition(':')
+    if not host:
+        return port, default_port
+    return host, int(port)
+
+
+class Profile(object):
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = []
+        self.requests = []
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall = time.monotonic()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.stages.append({
+                'name': name,
+                'wall': time.monotonic() - wall,
+                'cpu': time.process_time() - cpu,
+                'peak_rss_mb': peak_rss_mb(),
+            })
+
+    def request(self, kind, latency, size, series=None, decode=None):
+        """
+        Record one request (called from worker threads).
+        """
+        with self.lock:
+            self.requests.append({'kind': kind, 'latency': latency, 'bytes': size, 'series': series, 'decode': decode})
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        """
+        Flat dict of metric name -> value for the whole run.
+        """
+        out = {'peak_rss_mb': peak_rss_mb(), 'wall': time.time() - self.started}
+        for stage in self.stages:
+            key = stage['name'].replace(' ', '_')
+            out["stages.%s.wall" % key] = out.get("stages.%s.wall" % key, 0.0) + stage['wall']
+            out["stages.%s.cpu" % key] = out.get("stages.%s.cpu" % key, 0.0) + stage['cpu']
+        for kind in sorted(set(r['kind'] for r in self.requests)):
+            requests = [r for r in self.requests if r['kind'] == kind]
+            latencies = sorted(r['latency'] for r in requests)
+            out["requests.%s.count" % kind] = len(requests)
+            out["requests.%s.bytes" % kind] = sum(r['bytes'] or 0 for r in requests)
+            out["requests.%s.series" % kind] = sum(r['series'] or 0 for r in requests)
+            out["requests.%s.decode" % kind] = sum(r['decode'] or 0.0 for r in requests)
+            out["requests.%s.latency_mean" % kind] = sum(latencies) / len(latencies)
+            out["requests.%s.latency_max" % kind] = latencies[-1]
+            out["requests.%s.latency_p95" % kind] = latencies[math.ceil(0.95 * len(latencies)) - 1]   # nearest rank
+        for name, value in self.counters.items():
+            out["counters.%s" % name] = value
+        return out
+
+    def to_doc(self):
+        return {
+            'started': self.started,
+            'argv': sys.argv,
+            'summary': self.summary(),
+            'stages': self.stages,
+            'requests': self.requests,
+            'counters': self.counters,
+        }
+
+    def save(self, path):
+        with open(path, 'w') as fp:
+            json.dump(self.to_doc(), fp, indent=4)
+        logging.info("Profile saved into %s" % path)
+
+    def send_carbon(self, address, prefix):
+        host, port = parse_address(address, 2003)
+        now = int(time.time())
+        lines = ["%s.%s %s %s\n" % (prefix, name, value, now) for name, value in sorted(self.summary().items())]
+        try:
+            with socket.create_connection((host, port), timeout=10) as s:
+                s.sendall(''.join(lines).encode('utf-8'))
+        except OSError as e:
+            logging.warning("Failed to send profile to carbon %s:%s: %s" % (host, port, e))
+            return
+        logging.info("Profile sent to carbon %s:%s" % (host, port))
+
+    def send_statsd(self, address, prefix):
+        host, port = parse_address(address, 8125)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            for name, value in sorted(self.summary().items()):
+                try:
+                    s.sendto(("%s.%s:%s|g" % (prefix, name, value)).encode('utf-8'), (host, port))
+                except OSError as e:
+                    logging.warning("Failed to send profile to statsd %s:%s: %s" % (host, port, e))
+                    return
+        logging.info("Profile sent to statsd %s:%s" % (host, port))
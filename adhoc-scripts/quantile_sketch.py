@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Mergeable quantile sketch with relative accuracy guarantee (DDSketch).
+
+Values are counted in logarithmically sized buckets: bucket `i` holds
+values from gamma^(i-1) to gamma^i where gamma = (1 + alpha) / (1 - alpha),
+so any quantile is returned with relative error at most `alpha`. Negative
+values have their own buckets (by absolute value) and values closer to zero
+than MIN_VALUE are just counted. Bucket boundaries do not depend on data,
+so sketches of different runs or phases are merged by adding bucket counts.
+Sketch also tracks the smallest and the biggest value and quantiles are
+clamped to them (bucket midpoint of a constant series is not its value).
+
+In stats JSON a sketch is stored as:
+
+    {"alpha": 0.01, "zero": 0, "positive": {"<bucket>": <count>, ...}, "negative": {...},
+     "min": <value>, "max": <value>}
+
+(sketches stored without "min" and "max" are read as well, just without
+clamping).
+"""
+
+import math
+import numpy
+
+ALPHA = 0.01
+MIN_VALUE = 1e-9
+
+# Quantile columns of the stats table
+QUANTILES = {'p90': 0.90, 'p95': 0.95, 'p99': 0.99}
+
+
+def quantile_of_factor(factor):
+    """
+    Return quantile (0 - 1) for factor name like "p99" or "p99.9", None if
+    factor is not a quantile.
+    """
+    if not factor.startswith('p'):
+        return None
+    try:
+        q = float(factor[1:]) / 100
+    except ValueError:
+        return None
+    return q if 0 <= q <= 1 else None
+
+
+class QuantileSketch(object):
+
+    def __init__(self, alpha=ALPHA, zero=0, positive=None, negative=None, min=None, max=None):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.zero = zero
+        self.positive = positive if positive is not None else {}   # bucket -> count
+        self.negative = negative if negative is not None else {}
+        self.min = min   # observed extremes, None if not known
+        self.max = max
+
+    @property
+    def count(self):
+        return self.zero + sum(self.positive.values()) + sum(self.negative.values())
+
+    def _value(self, bucket):
+        return 2 * self.gamma ** bucket / (self.gamma + 1)
+
+    def add(self, value):
+        if math.isnan(value):
+            return
+        if self.min is not None or self.count == 0:
+            self._update_extremes(value, value)
+        if abs(value) < MIN_VALUE:
+            self.zero += 1
+            return
+        buckets = self.positive if value > 0 else self.negative
+        bucket = int(math.ceil(math.log(abs(value)) / math.log(self.gamma)))
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+
+    def _update_extremes(self, low, high):
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+
+    def merge(self, other):
+        """
+        Add counts of other sketch into this one.
+        """
+        if other.alpha != self.alpha:
+            raise ValueError("Can not merge sketches with different accuracy %s and %s" % (self.alpha, other.alpha))
+        if other.count > 0:
+            if other.min is None or (self.count > 0 and self.min is None):
+                self.min = self.max = None   # extremes of some values are not known
+            else:
+                self._update_extremes(other.min, other.max)
+        self.zero += other.zero
+        for buckets, other_buckets in ((self.positive, other.positive), (self.negative, other.negative)):
+            for bucket, count in other_buckets.items():
+                buckets[bucket] = buckets.get(bucket, 0) + count
+        return self
+
+    def quantiles(self, qs):
+        """
+        Return list of values for given quantiles (0 - 1), NaN if the sketch
+        is empty. Values are clamped to the observed extremes when known.
+        """
+        count = self.count
+        if count == 0:
+            return [numpy.nan for q in qs]
+        values = [-self._value(b) for b in sorted(self.negative, reverse=True)] + [0.0] \
+            + [self._value(b) for b in sorted(self.positive)]
+        counts = [self.negative[b] for b in sorted(self.negative, reverse=True)] + [self.zero] \
+            + [self.positive[b] for b in sorted(self.positive)]
+        cumulative = numpy.cumsum(counts)
+        ranks = numpy.asarray(qs, dtype=float) * (count - 1)
+        out = [values[i] for i in numpy.searchsorted(cumulative, ranks, side='right')]
+        if self.min is not None:
+            out = [min(max(v, self.min), self.max) for v in out]
+        return out
+
+    def quantile(self, q):
+        return self.quantiles([q])[0]
+
+    def to_json(self):
+        out = {
+            'alpha': self.alpha,
+            'zero': self.zero,
+            'positive': {str(k): v for k, v in sorted(self.positive.items())},
+            'negative': {str(k): v for k, v in sorted(self.negative.items())},
+        }
+        if self.min is not None:
+            out['min'] = self.min
+            out['max'] = self.max
+        return out
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            alpha=data['alpha'], zero=data['zero'],
+            positive={int(k): v for k, v in data['positive'].items()},
+            negative={int(k): v for k, v in data['negative'].items()},
+            min=data.get('min'), max=data.get('max'))
+
+
+def merged(sketches):
+    """
+    Merge list of sketches (None items are skipped) into new sketch, None if
+    there is nothing to merge.
+    """
+    out = None
+    for sketch in sketches:
+        if sketch is None:
+            continue
+        if out is None:
+            out = QuantileSketch(alpha=sketch.alpha)
+        out.merge(sketch)
+    return out
+
+
+def sketch_rows(values, alpha=ALPHA):
+    """
+    Build one sketch per row of 2-D array (NaN for missing values). Bucket
+    indices of all the values are computed in one pass and counted with
+    `numpy.unique`.
+    """
+    rows, cols = numpy.nonzero(~numpy.isnan(values))
+    v = values[rows, cols]
+    has_data = numpy.bincount(rows, minlength=values.shape[0]) > 0
+    is_zero = numpy.abs(v) < MIN_VALUE
+    zeros = numpy.bincount(rows[is_zero], minlength=values.shape[0])
+    rows = rows[~is_zero]
+    v = v[~is_zero]
+    buckets = numpy.ceil(numpy.log(numpy.abs(v)) / math.log((1 + alpha) / (1 - alpha))).astype(numpy.int64)
+    keys, counts = numpy.unique(numpy.stack([rows, (v < 0).astype(numpy.int64), buckets]), axis=1, return_counts=True)
+
+    with numpy.errstate(invalid='ignore'):
+        filled = numpy.where(has_data[:, None], values, 0.0)   # avoid all-NaN warnings
+        mins = numpy.nanmin(filled, axis=1).tolist() if values.shape[1] else []
+        maxs = numpy.nanmax(filled, axis=1).tolist() if values.shape[1] else []
+
+    out = [QuantileSketch(alpha=alpha, zero=int(zeros[row]),
+                          min=mins[row] if has_data[row] else None, max=maxs[row] if has_data[row] else None)
+           for row in range(values.shape[0])]
+    for (row, negative, bucket), count in zip(keys.T.tolist(), counts.tolist()):
+        (out[row].negative if negative else out[row].positive)[bucket] = count
+    return out
+
+
+def quantile_matrix(sketches, qs):
+    """
+    For nested lists (e.g. runs x metrics) of sketches (or None) return
+    array of shape (runs, metrics, len(qs)) with quantiles, NaN where there
+    is no sketch.
+    """
+    out = numpy.full((len(sketches), len(sketches[0]) if sketches else 0, len(qs)), numpy.nan)
+    for r, row in enumerate(sketches):
+        for m, sketch in enumerate(row):
+            if sketch is not None:
+                out[r, m] = sketch.quantiles(qs)
+    return out
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+On-disk cache of raw series returned by Graphite render API.
+
+Every entry is keyed by sanitized target (without alias) and resolution
+(extra render parameters like maxDataPoints, "raw" without them) and
+remembers which time ranges it already holds. When asked for an interval,
+only the missing parts are fetched, merged into the stored series and saved
+back. Series of an entry are kept by their Graphite name, so series of
+wildcard targets are merged right even when the set of matching metrics
+changes between fetched ranges. Entries are evicted when they were not used
+for too long or when the cache grows over the size limit (least recently
+used first).
+"""
+
+import os
+import math
+import time
+import json
+import hashlib
+import logging
+import tempfile
+
+
+def is_missing(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+class RenderCache(object):
+
+    def __init__(self, directory, max_size=1024*1024*1024, max_age=30*24*3600, fresh_margin=300):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.fresh_margin = fresh_margin   # do not mark this recent data as cached, it might still change
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _key(self, target, resolution):
+        return hashlib.sha1(("%s|%s" % (target, resolution)).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def resolution(params):
+        """
+        Part of the cache key describing render parameters which change
+        returned datapoints.
+        """
+        if not params:
+            return 'raw'
+        return '&'.join("%s=%s" % (k, params[k]) for k in sorted(params))
+
+    def _path(self, key):
+        return os.path.join(self.directory, "%s.json" % key)
+
+    def load(self, target, resolution):
+        path = self._path(self._key(target, resolution))
+        try:
+            with open(path, 'r') as fp:
+                entry = json.load(fp)
+        except (IOError, ValueError):
+            entry = None
+        if entry is None or not isinstance(entry.get('series'), dict):   # missing or with series not keyed by name
+            return {'target': target, 'resolution': resolution, 'ranges': [], 'series': {}}
+        os.utime(path)   # mark as recently used for eviction
+        return entry
+
+    def save(self, entry):
+        path = self._path(self._key(entry['target'], entry['resolution']))
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(entry, fp)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def missing_ranges(ranges, from_ts, to_ts):
+        """
+        Given sorted list of covered (from, to) ranges, return list of
+        (from, to) ranges of the interval which are not covered yet.
+        """
+        missing = []
+        start = from_ts
+        for r_from, r_to in ranges:
+            if r_to <= start:
+                continue
+            if r_from >= to_ts:
+                break
+            if r_from > start:
+                missing.append((start, r_from))
+            start = max(start, r_to)
+        if start < to_ts:
+            missing.append((start, to_ts))
+        return missing
+
+    @staticmethod
+    def add_range(ranges, from_ts, to_ts):
+        """
+        Add (from, to) into the list of covered ranges, merging overlaps.
+        """
+        out = []
+        for r_from, r_to in sorted(ranges + [[from_ts, to_ts]]):
+            if out and r_from <= out[-1][1]:
+                out[-1][1] = max(out[-1][1], r_to)
+            else:
+                out.append([r_from, r_to])
+        return out
+
+    @staticmethod
+    def merge_series(series, new_series):
+        """
+        Merge dicts of series (name -> list of [value, ts] datapoints) by
+        name and timestamp. Newly fetched values win, but missing ones (null
+        or NaN) never replace values already stored.
+        """
+        out = dict(series)
+        for name, new in new_series.items():
+            points = {ts: value for value, ts in series.get(name, [])}
+            for value, ts in new:
+                if not is_missing(value) or ts not in points:
+                    points[ts] = value
+            out[name] = [[points[ts], ts] for ts in sorted(points)]
+        return out
+
+    def render(self, client, targets, from_ts, to_ts, params=None):
+        """
+        Return series for given (sanitized target, alias) pairs in given
+        interval, fetching only what is not in the cache yet. `params` are
+        extra render parameters (e.g. maxDataPoints), passed to the client
+        and part of the cache key.
+        """
+        resolution = self.resolution(params)
+        cacheable_to = min(to_ts, int(time.time()) - self.fresh_margin)
+        entries = [self.load(target, resolution) for target, _ in targets]
+
+        # Group targets by the missing range so they can be fetched together
+        to_fetch = {}
+        for i, entry in enumerate(entries):
+            for missing in self.missing_ranges(entry['ranges'], from_ts, to_ts):
+                to_fetch.setdefault(missing, []).append(i)
+        logging.debug("Ranges to fetch: %s" % {k: len(v) for k, v in to_fetch.items()})
+
+        for (m_from, m_to), indexes in to_fetch.items():
+            # Series keep their name, prefixed by "<index of entry>:"
+            data = client.render(
+                ["aliasSub(%s, '^', '%s:')" % (entries[i]['target'], i) for i in indexes],
+                m_from, m_to, extra_params=params)
+            fetched = {}
+            for d in data:
+                i, name = d['target'].split(':', 1)
+                fetched.setdefault(int(i), {})[name] = d['datapoints']
+            for i in indexes:
+                entry = entries[i]
+                entry['series'] = self.merge_series(entry['series'], fetched.get(i, {}))
+                if min(m_to, cacheable_to) > m_from:
+                    entry['ranges'] = self.add_range(entry['ranges'], m_from, min(m_to, cacheable_to))
+        for i in set(i for indexes in to_fetch.values() for i in indexes):
+            self.save(entries[i])
+        self.evict()
+
+        out = []
+        for (target, alias), entry in zip(targets, entries):
+            for series in entry['series'].values():
+                datapoints = [p for p in series if from_ts < p[1] <= to_ts]
+                if datapoints:   # metrics not returned for this interval are left out
+                    out.append({'target': alias, 'datapoints': datapoints})
+        return out
+
+    def evict(self):
+        """
+        Remove entries not used for longer than max age and then least
+        recently used entries until cache fits into max size.
+        """
+        now = time.time()
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            st = os.stat(path)
+            if now - st.st_mtime > self.max_age:
+                logging.debug("Evicting %s from cache as too old" % path)
+                os.remove(path)
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+        total = sum(f[1] for f in files)
+        for mtime, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+            logging.debug("Evicting %s from cache to save space" % path)
+            os.remove(path)
+            total -= size
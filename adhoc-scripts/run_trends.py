@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Trends of stats across many runs, for show_stats_from_grafana_progress.py.
+
+Both functions take runs x N array (one column per metric -> factor, runs
+in chronological order, NaN where run does not have the value) and compute
+all the columns at once:
+
+    slopes          least squares slope of value per run
+    change_points   best single mean shift: run where the values change
+                    level, by how much, and how much of the variance the
+                    shift explains
+
+Missing values are skipped, so metrics added in later runs get trends of
+the runs they are in.
+"""
+
+import numpy
+
+
+def slopes(values):
+    """
+    Return (slope per run, mean, count of valid runs) arrays, slope is NaN
+    with less than 3 valid runs.
+    """
+    valid = ~numpy.isnan(values)
+    count = valid.sum(axis=0)
+    x = numpy.where(valid, numpy.arange(values.shape[0])[:, None], 0.0)
+    y = numpy.where(valid, values, 0.0)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        x_mean = x.sum(axis=0) / count
+        y_mean = y.sum(axis=0) / count
+        dx = numpy.where(valid, x - x_mean, 0.0)
+        slope = (dx * (y - y_mean)).sum(axis=0) / (dx * dx).sum(axis=0)
+    slope[count < 3] = numpy.nan
+    return slope, y_mean, count
+
+
+def change_points(values, min_segment=2):
+    """
+    For every column find split of the runs into before and after with the
+    biggest between-segment sum of squares (each segment at least
+    `min_segment` valid runs). Return (index of first run after the change,
+    mean before, mean after, fraction of variance explained by the shift)
+    arrays, index is -1 and others NaN if there are not enough runs.
+    """
+    valid = ~numpy.isnan(values)
+    y = numpy.where(valid, values, 0.0)
+    count_left = numpy.cumsum(valid, axis=0)[:-1]   # valid runs up to and including split row
+    sum_left = numpy.cumsum(y, axis=0)[:-1]
+    count = valid.sum(axis=0)
+    total = y.sum(axis=0)
+    count_right = count - count_left
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean_left = sum_left / count_left
+        mean_right = (total - sum_left) / count_right
+        score = count_left * count_right / count * (mean_left - mean_right) ** 2
+        ss_total = (numpy.where(valid, values - total / count, 0.0) ** 2).sum(axis=0)
+    score[(count_left < min_segment) | (count_right < min_segment) | numpy.isnan(score)] = -numpy.inf
+    if score.shape[0] == 0:
+        nothing = numpy.full(values.shape[1], numpy.nan)
+        return numpy.full(values.shape[1], -1), nothing, nothing, nothing
+    best = numpy.argmax(score, axis=0)
+    columns = numpy.arange(values.shape[1])
+    found = numpy.isfinite(score[best, columns])
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        explained = numpy.where(ss_total > 0, score[best, columns] / ss_total, 0.0)
+    before = numpy.where(found, mean_left[best, columns], numpy.nan)
+    after = numpy.where(found, mean_right[best, columns], numpy.nan)
+    return numpy.where(found, best + 1, -1), before, after, numpy.where(found, explained, numpy.nan)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+One entry point for the stats scripts:
+
+    satmon.py fetch ...      get_stats_from_grafana.py
+    satmon.py compare ...    compare_stats_from_grafana.py
+    satmon.py bounds ...     get_safe_bounds.py
+    satmon.py check ...      check_safe_bounds.py
+    satmon.py progress ...   show_stats_from_grafana_progress.py
+
+Arguments after the subcommand are passed to the script as they are. Only
+the script of the subcommand is loaded, and scripts import slow modules
+(SciPy, tabulate, requests) only on paths which use them.
+
+`satmon.py batch FILE` runs many subcommands in one process, one per line
+of the file ("-" for stdin), e.g.
+
+    # comment
+    bounds --csv --file /tmp/bounds.json store/
+    check --stats store/#run-42 --bounds /tmp/bounds.json > /tmp/check-42.txt
+
+Line can end with "> FILE" to save its output there. Modules are imported
+only once and loaded stats files are shared by all the commands (see
+stats_store.share_loaded). Exit status is the highest status of the
+commands.
+"""
+
+import os
+import sys
+import time
+import shlex
+import logging
+import argparse
+import contextlib
+
+COMMANDS = {
+    'fetch': 'get_stats_from_grafana',
+    'compare': 'compare_stats_from_grafana',
+    'bounds': 'get_safe_bounds',
+    'check': 'check_safe_bounds',
+    'progress': 'show_stats_from_grafana_progress',
+}
+
+
+def run_command(command, argv):
+    """
+    Run script of the subcommand with given arguments in this process,
+    return its exit status.
+    """
+    import runpy
+    saved_argv = sys.argv
+    sys.argv = ["%s %s" % (os.path.basename(saved_argv[0]), command)] + argv
+    try:
+        runpy.run_module(COMMANDS[command], run_name='__main__')
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        if isinstance(e.code, int):
+            return e.code
+        print(e.code, file=sys.stderr)
+        return 1
+    finally:
+        sys.argv = saved_argv
+    return 0
+
+
+def parse_batch_line(line):
+    """
+    Return (command, arguments, output file or None) of batch file line,
+    None for empty lines and comments.
+    """
+    words = shlex.split(line, comments=True)
+    if not words:
+        return None
+    output = None
+    if len(words) >= 2 and words[-2] == '>':
+        output = words[-1]
+        words = words[:-2]
+    if not words or words[0] not in COMMANDS:
+        raise ValueError("Unknown command in batch line: %s" % line.strip())
+    return words[0], words[1:], output
+
+
+def run_batch(fp, fail_fast=False):
+    """
+    Run commands from batch file, return the highest exit status.
+    """
+    import stats_store
+    stats_store.share_loaded()
+    commands = []
+    for number, line in enumerate(fp, start=1):
+        parsed = parse_batch_line(line)
+        if parsed is not None:
+            commands.append((number, parsed))
+    worst = 0
+    for number, (command, argv, output) in commands:
+        started = time.monotonic()
+        try:
+            if output is None:
+                status = run_command(command, argv)
+            else:
+                with open(output, 'w') as out, contextlib.redirect_stdout(out):
+                    status = run_command(command, argv)
+        except Exception:
+            logging.exception("Line %s (%s) crashed" % (number, command))
+            status = 1
+        sys.stdout.flush()
+        logging.debug("Line %s (%s) finished with status %s in %.3f s" % (number, command, status, time.monotonic() - started))
+        if status != 0:
+            logging.warning("Line %s (%s) failed with status %s" % (number, command, status))
+            worst = max(worst, status)
+            if fail_fast:
+                break
+    return worst
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        # Arguments belong to the script (including --help), do not parse them here
+        sys.exit(run_command(sys.argv[1], sys.argv[2:]))
+
+    parser = argparse.ArgumentParser(description='Get, compare and check stats from Graphite/Grafana')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command, module in sorted(COMMANDS.items()):
+        subparsers.add_parser(command, help='Run %s.py' % module)
+    parser_batch = subparsers.add_parser('batch', help='Run subcommands listed in a file in one process')
+    parser_batch.add_argument('file', type=argparse.FileType('r'),
+                              help='File with one subcommand with its arguments per line ("-" for stdin)')
+    parser_batch.add_argument('--fail-fast', action='store_true',
+                              help='Stop at the first failed subcommand')
+    parser_batch.add_argument('--debug', action='store_true',
+                              help='Debug mode')
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    logging.debug("Arguments: %s" % args)
+
+    try:
+        status = run_batch(args.file, args.fail_fast)
+    except ValueError as e:
+        parser.error(str(e))
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
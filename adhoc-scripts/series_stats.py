@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Vectorized statistics over many Graphite series at once.
+
+Series are loaded into one 2-D array (series x time) where missing values
+(nulls in Graphite response and padding of shorter series) are NaN, and all
+the columns of the stats table are computed for all series by batched
+numpy passes instead of walking Python lists series by series.
+"""
+
+import numpy
+import quantile_sketch
+
+HIST_BINS = 10
+
+
+def series_matrix(data):
+    """
+    Convert list of Graphite series (dicts with 'datapoints' list of
+    [value, ts] pairs, or already with 'values' and 'timestamps' arrays)
+    into (values, timestamps) 2-D float arrays with NaN for missing values.
+    """
+    length = max([len(d['values']) if 'values' in d else len(d['datapoints']) for d in data] + [0])
+    values = numpy.full((len(data), length), numpy.nan)
+    timestamps = numpy.full((len(data), length), numpy.nan)
+    for row, d in enumerate(data):
+        if 'values' in d:
+            values[row, :len(d['values'])] = d['values']
+            timestamps[row, :len(d['timestamps'])] = d['timestamps']
+            continue
+        if not d['datapoints']:
+            continue
+        points = numpy.array(d['datapoints'], dtype=float)   # None becomes NaN
+        values[row, :len(points)] = points[:, 0]
+        timestamps[row, :len(points)] = points[:, 1]
+    return values, timestamps
+
+
+def compact(values, timestamps):
+    """
+    Move not-NaN values to the beginning of each row (keeping their order)
+    so row `i` holds its `counts[i]` valid points in first columns.
+    """
+    order = numpy.argsort(numpy.isnan(values), axis=1, kind='stable')
+    return numpy.take_along_axis(values, order, axis=1), numpy.take_along_axis(timestamps, order, axis=1)
+
+
+def integrals(values, timestamps, counts):
+    """
+    Simpson integral of each row over its timestamps. Rows are grouped by
+    number of valid points so each group is integrated in one call.
+    """
+    import scipy.integrate   # slow to import, only needed here
+    # `simps` was renamed to `simpson` and later removed from SciPy
+    simpson = getattr(scipy.integrate, 'simpson', None) or scipy.integrate.simps
+    out = numpy.zeros(values.shape[0])
+    for count in numpy.unique(counts):
+        if count == 0:
+            continue
+        rows = counts == count
+        out[rows] = simpson(values[rows, :count], x=timestamps[rows, :count], axis=1)
+    return out
+
+
+def histograms(values, mins, maxs, counts, bins=HIST_BINS):
+    """
+    Equivalent of `numpy.histogram(row, bins)` for every row. Returns
+    (hist_counts, hist_edges) arrays with one row per series.
+    """
+    first = numpy.where(mins == maxs, mins - 0.5, mins)
+    last = numpy.where(mins == maxs, maxs + 0.5, maxs)
+    first[counts == 0] = 0.0
+    last[counts == 0] = 1.0
+    edges = numpy.linspace(first, last, bins + 1, axis=1)
+
+    rows, cols = numpy.nonzero(~numpy.isnan(values))
+    v = values[rows, cols]
+    norm = bins / (last - first)
+    indices = ((v - first[rows]) * norm[rows]).astype(numpy.intp)
+    indices[indices == bins] -= 1
+    # Same rounding corrections numpy.histogram does
+    indices[v < edges[rows, indices]] -= 1
+    increment = (v >= edges[rows, indices + 1]) & (indices != bins - 1)
+    indices[increment] += 1
+    hist = numpy.bincount(rows * bins + indices, minlength=values.shape[0] * bins)
+    return hist.reshape(values.shape[0], bins).astype(float), edges
+
+
+def compute_stats(values, timestamps, duration):
+    """
+    Compute the stats table columns for all the rows. Returns dict of
+    arrays (one item per row) keyed by column name, 'histogram' holds list
+    of ((from, to), count) tuples per row and 'sketch' list of quantile
+    sketches (quantile columns are read from them).
+    """
+    if values.shape[1] == 0:   # no series has any datapoint
+        values = numpy.full((values.shape[0], 1), numpy.nan)
+        timestamps = numpy.full((values.shape[0], 1), numpy.nan)
+    values, timestamps = compact(values, timestamps)
+    counts = numpy.count_nonzero(~numpy.isnan(values), axis=1)
+    has_data = counts > 0
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        filled = numpy.where(has_data[:, None], values, 0.0)   # avoid all-NaN warnings
+        mins = numpy.nanmin(filled, axis=1)
+        maxs = numpy.nanmax(filled, axis=1)
+        means = numpy.nanmean(filled, axis=1)
+        medians = numpy.nanmedian(filled, axis=1)
+        pvariances = numpy.nanvar(filled, axis=1)
+    out = {
+        'min': mins,
+        'max': maxs,
+        'mean': means,
+        'median': medians,
+        'int_per_dur': integrals(values, timestamps, counts) / duration,
+        'pstdev': numpy.sqrt(pvariances),
+        'pvariance': pvariances,
+        'datapoints': counts,
+    }
+    sketches = quantile_sketch.sketch_rows(values)
+    quantiles = quantile_sketch.quantile_matrix([sketches], list(quantile_sketch.QUANTILES.values()))[0]
+    for i, column in enumerate(quantile_sketch.QUANTILES):
+        out[column] = quantiles[:, i]
+    for key in out:
+        if key != 'datapoints':
+            out[key][~has_data] = 0
+    out['sketch'] = sketches
+    hist_counts, hist_edges = histograms(values, mins, maxs, counts)
+    out['histogram'] = []
+    for row in range(values.shape[0]):
+        if has_data[row]:
+            out['histogram'].append([((float(hist_edges[row, i]), float(hist_edges[row, i+1])), float(hist_counts[row, i])) for i in range(HIST_BINS)])
+        else:
+            out['histogram'].append({(0, 0): 0})
+    return out
+
+
+def compute_phase_stats(values, timestamps, phases):
+    """
+    Compute the stats table columns for every (from_ts, to_ts) phase from
+    one matrix of series covering all of them. Phase holds points with
+    `from_ts < timestamp <= to_ts` (as Graphite returns them for the
+    interval) and only the slice of columns with such points is reduced.
+    Returns list of dicts as returned by `compute_stats`, one per phase.
+    """
+    out = []
+    for from_ts, to_ts in phases:
+        with numpy.errstate(invalid='ignore'):
+            inside = (timestamps > from_ts) & (timestamps <= to_ts)
+        columns = numpy.nonzero(inside.any(axis=0))[0]
+        start, end = (columns[0], columns[-1] + 1) if len(columns) else (0, 0)
+        phase_values = numpy.where(inside[:, start:end], values[:, start:end], numpy.nan)
+        out.append(compute_stats(phase_values, timestamps[:, start:end], to_ts - from_ts))
+    return out
+
+
+def split_stats(stats):
+    """
+    Split dict of per-row arrays returned by `compute_stats` into list of
+    dicts, one per row.
+    """
+    return [{key: stats[key][row] for key in stats} for row in range(len(stats['datapoints']))]
+
+
+def summarise_series(values, timestamps, duration):
+    """
+    Stats of just one series given as 1-D buffers of values (NaN for nulls)
+    and timestamps. Returns dict of values keyed by column name.
+    """
+    values = numpy.frombuffer(values, dtype=float).reshape(1, -1)
+    timestamps = numpy.frombuffer(timestamps, dtype=float).reshape(1, -1)
+    return split_stats(compute_stats(values, timestamps, duration))[0]
+
+
+def summarise_series_phases(values, timestamps, phases):
+    """
+    Same as `summarise_series`, but returns list of stats dicts, one for
+    every (from_ts, to_ts) phase.
+    """
+    values = numpy.frombuffer(values, dtype=float).reshape(1, -1)
+    timestamps = numpy.frombuffer(timestamps, dtype=float).reshape(1, -1)
+    return [split_stats(stats)[0] for stats in compute_phase_stats(values, timestamps, phases)]
@@ -1,16 +1,30 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
+import re
 import sys
 import argparse
 import logging
-import tabulate
-import json
 import csv
+import numpy
+import stats_store
+import run_trends
 
 parser = argparse.ArgumentParser(description='Show table of how stats from stats files from Graphite/Grafana are progressing')
-parser.add_argument('files', type=argparse.FileType('r'), nargs='+',
-                    help='List of files to load stats from')
+parser.add_argument('files', nargs='+',
+                    help='List of files to load stats from (JSON stats files, FILE#PHASE, stats store directories or STORE_DIR#RUN)')
+parser.add_argument('--metrics', default=None,
+                    help='Only load metrics matching this regular expression (only their values are read from stats stores)')
+parser.add_argument('--trend', action='store_true',
+                    help='Instead of table of all runs show metrics ranked by how fast they drift across runs (regression slope and change-point)')
+parser.add_argument('--factors', default='mean,max',
+                    help='Coma separated factors to compute trends of')
+parser.add_argument('--by-time', action='store_true',
+                    help='Order runs by their time in stats store run index instead of order given')
+parser.add_argument('--rank', choices=['slope', 'shift'], default='slope',
+                    help='Rank trends by relative slope per run or by relative shift at the change-point')
+parser.add_argument('--top', type=int, default=20,
+                    help='Show this many fastest drifting metrics->factors with --trend (0 for all)')
 parser.add_argument('--csv', action='store_true',
                     help='Output table to stdout in csv (defauts to table)')
 parser.add_argument('--debug', action='store_true',
@@ -22,37 +36,85 @@ if args.debug:
 
 logging.debug("Arguments: %s" % args)
 
-data = {}
-for f in args.files:
-    data[f.name] = json.load(f)
+metrics = None
+if args.metrics is not None:
+    metrics = [m for m in stats_store.metric_names(args.files[0]) if re.search(args.metrics, m)]
+    if not metrics:
+        parser.error('no metric in %s matches %s' % (args.files[0], args.metrics))
+runs, metrics, factors, values = stats_store.load_values(args.files, metrics)
+logging.debug("Metrics loaded from %s: %s" % (runs[0], metrics))
+
+index = stats_store.load_index(args.files)
+if args.by_time:
+    missing = [r['name'] for r in index if r['time'] is None]
+    if missing:
+        parser.error('runs without time in run index: %s' % ', '.join(missing))
+    order = sorted(range(len(runs)), key=lambda r: index[r]['time'])
+    runs = [runs[r] for r in order]
+    index = [index[r] for r in order]
+    values = values[order]
+
+
+def output(table_header, table_data, floatfmt):
+    if args.csv:
+        spamwriter = csv.writer(sys.stdout)
+        spamwriter.writerow(table_header)
+        spamwriter.writerows(table_data)
+    else:
+        import tabulate   # slow to import, not needed for csv
+        print(tabulate.tabulate(table_data, headers=table_header, floatfmt=floatfmt))
+
+
+if args.trend:
+    trend_factors = args.factors.split(',')
+    for factor in trend_factors:
+        if factor not in factors:
+            parser.error('unknown factor %s, use some of %s' % (factor, ','.join(factors)))
+    # runs x (metrics * factors) columns, metric-major
+    columns = numpy.asarray(values)[:, :, [factors.index(f) for f in trend_factors]].reshape(len(runs), -1)
+    slope, mean, count = run_trends.slopes(columns)
+    split, before, after, explained = run_trends.change_points(columns)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        slope_pct = slope / numpy.abs(mean) * 100
+        shift_pct = (after - before) / numpy.abs(before) * 100
+    rank = numpy.abs(slope_pct if args.rank == 'slope' else shift_pct)
+    ranked = numpy.argsort(numpy.where(numpy.isnan(rank), -numpy.inf, -rank), kind='stable')
+    if args.top > 0:
+        ranked = ranked[:args.top]
+
+    table_header = ['metric', 'factor', 'runs', 'mean', 'slope per run', 'slope [%/run]', 'change at', 'shift [%]', 'explained [%]']
+    table_data = []
+    for c in ranked:
+        change_at = None
+        if split[c] >= 0:
+            change_at = runs[split[c]]
+            if index[split[c]]['version'] is not None:
+                change_at += " (%s)" % index[split[c]]['version']
+        table_data.append([metrics[c // len(trend_factors)], trend_factors[c % len(trend_factors)], int(count[c]),
+                           mean[c], slope[c], slope_pct[c], change_at, shift_pct[c], explained[c] * 100])
+    output(table_header, table_data, '.2f')
+    sys.exit(0)
 
 # Some stats are useless
 ###table_header = ['metric', 'min', 'max', 'mean', 'median', 'int_per_dur', 'pstdev', 'pvariance', 'duration']
 table_header_file = ['stat file']
 table_header_items = ['max', 'mean', 'median', 'duration']
 
-metrics_name = next(iter(data))
-metrics = data[metrics_name].keys()
-logging.debug("Metrics loaded from %s: %s" % (metrics_name, metrics))
-
 table_header = table_header_file
 for metric in metrics:
     for factor in table_header_items:
         table_header.append("%s: %s" % (metric, factor))
 
+factors_index = [factors.index(factor) for factor in table_header_items]
 table_data = []
-for snap_name, snap_data in data.items():
+for r, snap_name in enumerate(runs):
     table_row = [snap_name]
-    for metric in metrics:
-        for factor in table_header_items:
-            value = snap_data[metric][factor]
+    snap_values = values[r][:, factors_index]
+    for m, metric in enumerate(metrics):
+        for f, factor in enumerate(table_header_items):
+            value = snap_values[m, f]
             logging.debug("Processing %s -> %s -> %s: %s" % (snap_name, metric, factor, value))
             table_row.append("%.1f" % value)
     table_data.append(table_row)
 
-if args.csv:
-    spamwriter = csv.writer(sys.stdout)
-    spamwriter.writerow(table_header)
-    spamwriter.writerows(table_data)
-else:
-    print(tabulate.tabulate(table_data, headers=table_header, floatfmt='.1f'))
+output(table_header, table_data, '.1f')
@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Compact columnar store of stats files produced by get_stats_from_grafana.py.
+
+Store is a directory with:
+
+    meta.json        metrics, factors, columns order and list of runs (run
+                     index with name and optionally time and Satellite
+                     version of every run)
+    values.f8        float64 array runs x metrics x factors
+    hist_counts.f8   float64 array runs x metrics x bins
+    hist_edges.f8    float64 array runs x metrics x (bins + 1)
+    sketches.jsonl   quantile sketches, one JSON line {metric: sketch} per run
+
+Runs are appended at the end of the arrays, so adding a run does not touch
+existing data (unless it brings new metrics, then arrays are re-laid out).
+Arrays are memory-mapped for reading. Missing values are NaN.
+
+Can be also used as a script to import JSON stats files into a store and
+export runs back to JSON.
+
+When `share_loaded()` is enabled (satmon batch mode runs many commands in
+one process), parsed JSON stats files, their value arrays and sketches of
+stores are kept and reused by later loads of the same unchanged file.
+"""
+
+import os
+import sys
+import json
+import logging
+import argparse
+import tempfile
+import numpy
+import quantile_sketch
+
+DTYPE = numpy.dtype('<f8')
+
+# Columns of stats documents which are not stored as numeric factors
+NON_NUMERIC = ('metric', 'histogram', 'sketch')
+
+# (kind, path, mtime, size) -> loaded object, None when sharing is disabled
+_shared = None
+
+
+def share_loaded(enabled=True):
+    """
+    Keep loaded files for later loads in this process. Shared objects must
+    not be modified (value arrays are made read-only).
+    """
+    global _shared
+    _shared = {} if enabled else None
+
+
+def _load_shared(kind, path, load):
+    if _shared is None:
+        return load()
+    st = os.stat(path)
+    key = (kind, os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    if key not in _shared:
+        _shared[key] = load()
+    return _shared[key]
+
+
+def _read_json(path):
+    with open(path, 'r') as fp:
+        return json.load(fp)
+
+
+def hist_from_json(hist):
+    """
+    Convert histogram as stored in stats JSON ({"from - to": "count"}) into
+    (edges, counts) lists.
+    """
+    bins = sorted((tuple(float(i) for i in k.split(' - ')), float(v)) for k, v in hist.items())
+    edges = [b[0][0] for b in bins] + [bins[-1][0][1]] if bins else []
+    counts = [b[1] for b in bins]
+    return edges, counts
+
+
+def hist_to_json(edges, counts):
+    return {"%s - %s" % (edges[i], edges[i+1]): "%.02f" % counts[i] for i in range(len(counts))}
+
+
+class StatsStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as fp:
+                self.meta = json.load(fp)
+        else:
+            self.meta = {'version': 1, 'metrics': [], 'factors': [], 'int_factors': [], 'columns': [], 'bins': 0, 'runs': []}
+
+    @staticmethod
+    def is_store(path):
+        return os.path.isfile(os.path.join(path, 'meta.json'))
+
+    @property
+    def metrics(self):
+        return self.meta['metrics']
+
+    @property
+    def factors(self):
+        return self.meta['factors']
+
+    @property
+    def runs(self):
+        return [r['name'] for r in self.meta['runs']]
+
+    def index(self):
+        """
+        Run index: list of dicts with 'id' (position of the run), 'name',
+        'time' and 'version' (None if not recorded) and 'offset' of the run
+        in values.f8 (bytes).
+        """
+        stride = len(self.metrics) * len(self.factors) * DTYPE.itemsize
+        return [{'id': i, 'name': r['name'], 'time': r.get('time'), 'version': r.get('version'), 'offset': i * stride}
+                for i, r in enumerate(self.meta['runs'])]
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _shapes(self, runs=None):
+        runs = len(self.meta['runs']) if runs is None else runs
+        metrics = len(self.metrics)
+        return {
+            'values.f8': (runs, metrics, len(self.factors)),
+            'hist_counts.f8': (runs, metrics, self.meta['bins']),
+            'hist_edges.f8': (runs, metrics, self.meta['bins'] + 1),
+        }
+
+    def _open(self, name):
+        shape = self._shapes()[name]
+        if 0 in shape:
+            return numpy.zeros(shape, dtype=DTYPE)
+        return numpy.memmap(self._file(name), dtype=DTYPE, mode='r', shape=shape)
+
+    def values(self):
+        """
+        Memory-mapped runs x metrics x factors array.
+        """
+        return self._open('values.f8')
+
+    def histograms(self):
+        """
+        Memory-mapped (counts, edges) arrays, runs x metrics x bins(+1).
+        """
+        return self._open('hist_counts.f8'), self._open('hist_edges.f8')
+
+    def sketches(self):
+        """
+        List of dicts metric -> QuantileSketch, one per run.
+        """
+        out = []
+        if os.path.exists(self._file('sketches.jsonl')):
+            out = _load_shared('sketches', self._file('sketches.jsonl'), self._read_sketches)
+        return out + [{} for _ in range(len(self.meta['runs']) - len(out))]
+
+    def _read_sketches(self):
+        out = []
+        with open(self._file('sketches.jsonl'), 'r') as fp:
+            for line in fp:
+                out.append({k: quantile_sketch.QuantileSketch.from_json(v) for k, v in json.loads(line).items()})
+        return out
+
+    def _save_meta(self):
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(self.meta, fp, indent=4)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, self.meta_path)
+
+    def _relayout(self, metrics, factors, bins):
+        """
+        Rewrite arrays to have given (super)set of metrics, factors and bins.
+        """
+        old_values = numpy.array(self.values())
+        old_counts, old_edges = [numpy.array(i) for i in self.histograms()]
+        runs = old_values.shape[0]
+        position = {m: i for i, m in enumerate(metrics)}
+        m_index = [position[m] for m in self.metrics]
+        f_index = [factors.index(f) for f in self.factors]
+        values = numpy.full((runs, len(metrics), len(factors)), numpy.nan)
+        values[numpy.ix_(numpy.arange(runs), m_index, f_index)] = old_values
+        counts = numpy.full((runs, len(metrics), bins), numpy.nan)
+        edges = numpy.full((runs, len(metrics), bins + 1), numpy.nan)
+        counts[:, m_index, :old_counts.shape[2]] = old_counts
+        edges[:, m_index, :old_edges.shape[2]] = old_edges
+        self.meta['metrics'] = metrics
+        self.meta['factors'] = factors
+        self.meta['bins'] = bins
+        for name, array in (('values.f8', values), ('hist_counts.f8', counts), ('hist_edges.f8', edges)):
+            array.astype(DTYPE).tofile(self._file(name))
+
+    def _truncate_sketches(self):
+        """
+        Keep just one line per complete run in sketches file (older stores
+        do not have it at all, so fill missing runs with empty lines).
+        """
+        lines = []
+        if os.path.exists(self._file('sketches.jsonl')):
+            with open(self._file('sketches.jsonl'), 'r') as fp:
+                lines = [line for line in fp if line.endswith('\n')]
+        if len(lines) == len(self.meta['runs']):
+            return
+        lines = lines[:len(self.meta['runs'])]
+        lines += ['{}\n' for _ in range(len(self.meta['runs']) - len(lines))]
+        with open(self._file('sketches.jsonl'), 'w') as fp:
+            fp.writelines(lines)
+
+    def append(self, name, doc, time=None, version=None):
+        """
+        Append one run given as stats document (as stored in JSON stats file).
+        Optional time (e.g. start of the run) and Satellite version are kept
+        in the run index.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        for metric_data in doc.values():
+            for k, v in metric_data.items():
+                if k not in self.meta['columns']:
+                    self.meta['columns'].append(k)
+                    if isinstance(v, int) and not isinstance(v, bool):
+                        self.meta['int_factors'].append(k)
+
+        known = set(self.metrics)
+        metrics = self.metrics + [m for m in doc if m not in known]
+        factors = self.factors[:]
+        bins = self.meta['bins']
+        for metric_data in doc.values():
+            factors += [f for f in metric_data if f not in NON_NUMERIC and f not in factors]
+            if 'histogram' in metric_data:
+                bins = max(bins, len(metric_data['histogram']))
+        if metrics != self.metrics or factors != self.factors or bins != self.meta['bins']:
+            self._relayout(metrics, factors, bins)
+
+        # Drop anything written after last complete run (e.g. interrupted append)
+        for file_name, shape in self._shapes().items():
+            with open(self._file(file_name), 'ab') as fp:
+                fp.truncate(int(numpy.prod(shape)) * DTYPE.itemsize)
+        self._truncate_sketches()
+
+        values = numpy.full((len(self.metrics), len(self.factors)), numpy.nan)
+        counts = numpy.full((len(self.metrics), bins), numpy.nan)
+        edges = numpy.full((len(self.metrics), bins + 1), numpy.nan)
+        for m, metric in enumerate(self.metrics):
+            if metric not in doc:
+                continue
+            for f, factor in enumerate(self.factors):
+                if factor in doc[metric]:
+                    values[m, f] = doc[metric][factor]
+            if 'histogram' in doc[metric]:
+                h_edges, h_counts = hist_from_json(doc[metric]['histogram'])
+                counts[m, :len(h_counts)] = h_counts
+                edges[m, :len(h_edges)] = h_edges
+        for file_name, array in (('values.f8', values), ('hist_counts.f8', counts), ('hist_edges.f8', edges)):
+            with open(self._file(file_name), 'ab') as fp:
+                fp.write(array.astype(DTYPE).tobytes())
+        with open(self._file('sketches.jsonl'), 'a') as fp:
+            fp.write(json.dumps({m: doc[m]['sketch'] for m in doc if 'sketch' in doc[m]}) + '\n')
+        run = {'name': name}
+        if time is not None:
+            run['time'] = time
+        if version is not None:
+            run['version'] = version
+        self.meta['runs'].append(run)
+        self._save_meta()
+
+    def to_doc(self, run):
+        """
+        Export run (name or index) as stats document in JSON stats file format.
+        """
+        index = self.runs.index(run) if not isinstance(run, int) else run
+        values = self.values()[index]
+        counts, edges = [numpy.array(i[index]) for i in self.histograms()]
+        sketches = self.sketches()[index]
+        doc = {}
+        for m, metric in enumerate(self.metrics):
+            if numpy.isnan(values[m]).all():
+                continue
+            doc[metric] = {}
+            for column in self.meta['columns']:
+                if column == 'metric':
+                    doc[metric][column] = metric
+                elif column == 'histogram':
+                    valid = ~numpy.isnan(counts[m])
+                    doc[metric][column] = hist_to_json(edges[m][:valid.sum() + 1].tolist(), counts[m][valid].tolist())
+                elif column == 'sketch':
+                    if metric in sketches:
+                        doc[metric][column] = sketches[metric].to_json()
+                elif column in self.factors:
+                    value = float(values[m, self.factors.index(column)])
+                    doc[metric][column] = int(value) if column in self.meta['int_factors'] else value
+        return doc
+
+
+def is_phases_doc(doc):
+    """
+    Stats document with phases is keyed by phase name and then by metric.
+    """
+    return bool(doc) and all(isinstance(v, dict) and all(isinstance(i, dict) for i in v.values()) for v in doc.values())
+
+
+def load_json(path, phase=None):
+    """
+    Load JSON stats file. Returns list of (name, stats document), file with
+    phases gives one item named "FILE#PHASE" per phase (or just given one).
+    """
+    doc = _load_shared('json', path, lambda: _read_json(path))
+    if not is_phases_doc(doc):
+        if phase:
+            raise ValueError("%s does not contain phases" % path)
+        return [(path, doc)]
+    return [("%s#%s" % (path, name), doc[name]) for name in ([phase] if phase else doc)]
+
+
+def load_stats(paths):
+    """
+    Load stats documents from list of paths. Path can be JSON stats file
+    (all its phases are loaded if it has them), "FILE#PHASE", store
+    directory (all its runs are loaded) or "STORE_DIR#RUN" for one run of a
+    store. Returns dict name -> stats document.
+    """
+    data = {}
+    for path in paths:
+        store_path, _, run = path.partition('#')
+        if StatsStore.is_store(store_path):
+            store = StatsStore(store_path)
+            for name in ([run] if run else store.runs):
+                data["%s#%s" % (store_path, name)] = store.to_doc(name)
+        else:
+            for name, doc in load_json(store_path, run):
+                data[name] = doc
+    return data
+
+
+def load_one(path):
+    """
+    Load exactly one stats document (JSON stats file, "FILE#PHASE" or
+    "STORE_DIR#RUN").
+    """
+    data = load_stats([path])
+    if len(data) != 1:
+        raise ValueError("%s contains %s runs, use STORE_DIR#RUN to pick one" % (path, len(data)))
+    return next(iter(data.values()))
+
+
+def _json_values(path, phase):
+    """
+    Parts of `load_values` for JSON stats file, one per (selected) phase.
+    """
+    parts = []
+    for name, doc in load_json(path, phase):
+        metrics = list(doc.keys())
+        factors = [f for f in doc[metrics[0]] if f not in NON_NUMERIC] if metrics else []
+        values = numpy.array([[[doc[m].get(f, numpy.nan) for f in factors] for m in metrics]], dtype=float)
+        values.flags.writeable = False
+        parts.append(([name], metrics, factors, values))
+    return parts
+
+
+def metric_names(path):
+    """
+    Metrics of stats file or store (without loading values of a store).
+    """
+    store_path, _, run = path.partition('#')
+    if StatsStore.is_store(store_path):
+        return StatsStore(store_path).metrics
+    return list(load_json(store_path, run)[0][1].keys())
+
+
+def load_index(paths):
+    """
+    Run index (see `StatsStore.index`) of runs in list of paths (same as
+    for `load_stats`), with names as returned by `load_values`. Runs from
+    JSON stats files have no time, version and offset.
+    """
+    out = []
+    for path in paths:
+        store_path, _, run = path.partition('#')
+        if StatsStore.is_store(store_path):
+            index = StatsStore(store_path).index()
+            out += [dict(r, name="%s#%s" % (store_path, r['name'])) for r in index if not run or r['name'] == run]
+        else:
+            out += [{'id': None, 'name': name, 'time': None, 'version': None, 'offset': None}
+                    for name, doc in load_json(store_path, run)]
+    return out
+
+
+def load_values(paths, metrics=None):
+    """
+    Load numeric factors (no histograms) from list of paths (same as for
+    `load_stats`). Returns (runs, metrics, factors, values) where values is
+    runs x metrics x factors array. Metrics (unless given) and factors are
+    taken from the first path, missing values are NaN. Single store is
+    memory-mapped, with given metrics only their values are read from it.
+    """
+    parts = []
+    for path in paths:
+        store_path, _, run = path.partition('#')
+        if StatsStore.is_store(store_path):
+            store = StatsStore(store_path)
+            values = store.values()
+            names = store.runs
+            if run:
+                index = names.index(run)
+                names = [run]
+                values = values[index:index+1]
+            parts.append((["%s#%s" % (store_path, name) for name in names], store.metrics, store.factors, values))
+        else:
+            parts += _load_shared('values#%s' % run, store_path, lambda: _json_values(store_path, run))
+
+    if len(parts) == 1 and metrics is None:
+        return parts[0]
+    runs = [name for part in parts for name in part[0]]
+    metrics = parts[0][1] if metrics is None else list(metrics)
+    factors = parts[0][2]
+    values = numpy.full((len(runs), len(metrics), len(factors)), numpy.nan)
+    position = {m: i for i, m in enumerate(metrics)}
+    offset = 0
+    for p_runs, p_metrics, p_factors, p_values in parts:
+        m_pairs = [(position[m], i) for i, m in enumerate(p_metrics) if m in position]
+        f_pairs = [(factors.index(f), i) for i, f in enumerate(p_factors) if f in factors]
+        if m_pairs and f_pairs:
+            values[numpy.ix_(numpy.arange(offset, offset + len(p_runs)), [i[0] for i in m_pairs], [i[0] for i in f_pairs])] = \
+                numpy.asarray(p_values)[numpy.ix_(numpy.arange(len(p_runs)), [i[1] for i in m_pairs], [i[1] for i in f_pairs])]
+        offset += len(p_runs)
+    return runs, metrics, factors, values
+
+
+def load_histograms(paths, metrics):
+    """
+    Load histograms of given metrics from list of paths (same as for
+    `load_stats`). Returns (counts, edges) arrays runs x metrics x bins and
+    runs x metrics x (bins + 1), NaN where missing.
+    """
+    parts = []
+    for path in paths:
+        store_path, _, run = path.partition('#')
+        if StatsStore.is_store(store_path):
+            store = StatsStore(store_path)
+            counts, edges = store.histograms()
+            if run:
+                index = store.runs.index(run)
+                counts = counts[index:index+1]
+                edges = edges[index:index+1]
+            parts.append((store.metrics, counts, edges))
+        else:
+            for name, doc in load_json(store_path, run):
+                hists = [hist_from_json(doc[m].get('histogram', {})) for m in doc]
+                bins = max([len(h[1]) for h in hists] + [0])
+                counts = numpy.full((1, len(hists), bins), numpy.nan)
+                edges = numpy.full((1, len(hists), bins + 1), numpy.nan)
+                for m, (h_edges, h_counts) in enumerate(hists):
+                    counts[0, m, :len(h_counts)] = h_counts
+                    edges[0, m, :len(h_edges)] = h_edges
+                parts.append((list(doc.keys()), counts, edges))
+
+    runs = sum(p[1].shape[0] for p in parts)
+    bins = max([p[1].shape[2] for p in parts] + [0])
+    counts = numpy.full((runs, len(metrics), bins), numpy.nan)
+    edges = numpy.full((runs, len(metrics), bins + 1), numpy.nan)
+    position = {m: i for i, m in enumerate(metrics)}
+    offset = 0
+    for p_metrics, p_counts, p_edges in parts:
+        pairs = [(position[m], i) for i, m in enumerate(p_metrics) if m in position]
+        p_runs = p_counts.shape[0]
+        if pairs:
+            index = [i[1] for i in pairs]
+            counts[offset:offset+p_runs, [i[0] for i in pairs], :p_counts.shape[2]] = numpy.asarray(p_counts)[:, index, :]
+            edges[offset:offset+p_runs, [i[0] for i in pairs], :p_edges.shape[2]] = numpy.asarray(p_edges)[:, index, :]
+        offset += p_runs
+    return counts, edges
+
+
+def load_sketches(paths, metrics):
+    """
+    Load quantile sketches of given metrics from list of paths (same as for
+    `load_stats`). Returns list (one item per run) of lists (one item per
+    metric) of QuantileSketch objects, None where missing.
+    """
+    out = []
+    for path in paths:
+        store_path, _, run = path.partition('#')
+        if StatsStore.is_store(store_path):
+            store = StatsStore(store_path)
+            sketches = store.sketches()
+            if run:
+                sketches = [sketches[store.runs.index(run)]]
+            out += [[s.get(m) for m in metrics] for s in sketches]
+        else:
+            for name, doc in load_json(store_path, run):
+                out.append([quantile_sketch.QuantileSketch.from_json(doc[m]['sketch'])
+                            if m in doc and 'sketch' in doc[m] else None for m in metrics])
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import stats files into columnar stats store and export them back')
+    parser.add_argument('--debug', action='store_true',
+                        help='Debug mode')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_import = subparsers.add_parser('import', help='Append JSON stats files as runs into the store')
+    parser_import.add_argument('store', help='Store directory')
+    parser_import.add_argument('files', nargs='+', help='JSON stats files, file name (and "#PHASE" for files with phases) is used as run name')
+    parser_import.add_argument('--time', type=int, default=None, help='Time of the runs for the run index (defaults to modification time of the files)')
+    parser_import.add_argument('--version', default=None, help='Satellite version of the runs for the run index')
+    parser_export = subparsers.add_parser('export', help='Export run from the store as JSON stats file')
+    parser_export.add_argument('store', help='Store directory')
+    parser_export.add_argument('run', help='Run name')
+    parser_export.add_argument('--file', default=None, help='Save to this file instead of stdout')
+    parser_list = subparsers.add_parser('list', help='List runs in the store')
+    parser_list.add_argument('store', help='Store directory')
+    parser_list.add_argument('--index', action='store_true', help='Show run index (id, name, time, version and offset in values file)')
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    logging.debug("Arguments: %s" % args)
+
+    store = StatsStore(args.store)
+    if args.command == 'import':
+        for f in args.files:
+            for name, doc in load_json(f):
+                store.append(name, doc, time=args.time if args.time is not None else int(os.path.getmtime(f)), version=args.version)
+                logging.info("Imported %s" % name)
+    elif args.command == 'export':
+        doc = store.to_doc(args.run)
+        if args.file is None:
+            json.dump(doc, sys.stdout, indent=4)
+        else:
+            with open(args.file, 'w') as fp:
+                json.dump(doc, fp, indent=4)
+    elif args.command == 'list':
+        if args.index:
+            for r in store.index():
+                print("%s\t%s\t%s\t%s\t%s" % (r['id'], r['name'], r['time'], r['version'], r['offset']))
+        else:
+            for run in store.runs:
+                print(run)
+
+
+if __name__ == '__main__':
+    main()
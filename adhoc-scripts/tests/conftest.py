@@ -0,0 +1,38 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Scripts and their modules live in adhoc-scripts/ and are imported as top
+level modules, tests run them against local fixtures (fake Graphite server,
+generated Whisper files and PCP exports).
+"""
+
+import os
+import sys
+import threading
+import http.server
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fake_graphite   # noqa: E402
+
+
+@pytest.fixture
+def generator():
+    return fake_graphite.SeriesGenerator(step=10, nulls=0.05, series=20, prefix='bench', node='node')
+
+
+@pytest.fixture
+def fake_server(generator):
+    """
+    Fake Graphite render API serving `generator` series, yields its port.
+    """
+    handler = type('Handler', (fake_graphite.Handler,), {'generator': generator, 'latency': 0.0})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
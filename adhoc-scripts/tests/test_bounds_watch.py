@@ -0,0 +1,123 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Watch mode of check_safe_bounds.py against the fake render API: a nominal
+run (same generator as the finished runs bounds were learned from) is
+streamed poll by poll and must not be reported, a broken one must.
+"""
+
+import numpy
+import pytest
+
+import bounds_watch
+import graphite_render
+import series_stats
+
+RUN = 3600
+INTERVAL = 60
+PERIOD = 22620   # of the sine in generated series, finished runs are in the same phase as the watched one
+START = 1600000000
+TARGETS = [('bench.node.series-%s.value' % i, 'metric %s' % i) for i in range(1, 6)]
+
+
+@pytest.fixture
+def client(fake_server):
+    c = graphite_render.RenderClient('127.0.0.1', fake_server, 1, parallel=1)
+    yield c
+    c.close()
+
+
+def render(client):
+    return lambda pairs, from_ts, to_ts: client.render(["alias(%s, '%s')" % (k, v) for k, v in pairs], from_ts, to_ts)
+
+
+def learn_bounds(client, runs=5, margin=0.5):
+    """
+    Bounds from stats of `runs` finished runs before START, widened by
+    `margin` of their spread (like get_safe_bounds, just simpler).
+    """
+    per_run = []
+    for r in range(runs):
+        from_ts = START - (r + 1) * PERIOD
+        data = render(client)(TARGETS, from_ts, from_ts + RUN)
+        stats = series_stats.compute_stats(*series_stats.series_matrix(data), RUN)
+        per_run.append({d['target']: {f: float(stats[f][i]) for f in bounds_watch.WATCHED} for i, d in enumerate(data)})
+    bounds = {}
+    for target, alias in TARGETS:
+        bounds[alias] = {'duration': [RUN, RUN]}
+        for factor in bounds_watch.WATCHED:
+            values = [run[alias][factor] for run in per_run]
+            spread = max(values) - min(values) + abs(numpy.mean(values)) * 0.02
+            bounds[alias][factor] = [min(values) - margin * spread, max(values) + margin * spread]
+    return bounds
+
+
+def watch(client, bounds, final=True):
+    watcher = bounds_watch.BoundsWatcher(render(client), TARGETS, bounds, START, interval=INTERVAL, max_lookback=300)
+    changes = []
+    for now in range(START + INTERVAL, START + RUN + 1, INTERVAL):
+        changes += [(now,) + c for c in watcher.poll(now)]
+    if final:
+        changes += [(START + RUN,) + c for c in watcher.check(START + RUN, final=True)]
+    return watcher, changes
+
+
+def test_nominal_run_is_not_reported(client):
+    watcher, changes = watch(client, learn_bounds(client))
+    assert changes == []
+    assert watcher.violations == 0
+    assert all(s.count > 300 for s in watcher.stats.values())
+
+
+def test_growing_factors_are_not_checked_against_low_bound_early(client):
+    bounds = learn_bounds(client)
+    watcher = bounds_watch.BoundsWatcher(render(client), TARGETS, bounds, START, interval=INTERVAL)
+    assert watcher.poll(START + 120) == []
+    stats = watcher.stats['metric 1']
+    # Early in the run max is below what finished runs reach
+    assert stats.factor('max', 120) < bounds['metric 1']['max'][0]
+
+
+def test_broken_run_is_reported(client):
+    bounds = learn_bounds(client)
+    bounds['metric 2']['max'][1] = bounds['metric 2']['mean'][0]   # max is soon over this
+    bounds['metric 3']['mean'] = [0.0, 1.0]                        # checked once run is complete
+    watcher, changes = watch(client, bounds)
+    reported = {(metric, factor) for now, metric, factor, zone, value, is_safe in changes if not is_safe}
+    assert reported == {('metric 2', 'max'), ('metric 3', 'mean')}
+    first_max = min(now for now, metric, factor, zone, value, is_safe in changes if factor == 'max')
+    assert first_max < START + 600
+    assert watcher.violations == 2
+
+
+def test_target_with_several_series_is_dropped(client, caplog):
+    targets = TARGETS + [('bench.node.series-{6,7}.value', 'several')]
+    watcher = bounds_watch.BoundsWatcher(render(client), targets, {}, START, interval=INTERVAL)
+    watcher.poll(START + 600)
+    assert 'several' not in watcher.stats
+    assert 'Not watching several, it returned 2 series' in caplog.text
+    watcher.poll(START + 660)
+    assert set(watcher.stats) == set(alias for target, alias in TARGETS)
+    assert all(s.count > 50 for s in watcher.stats.values())
+
+
+def test_lagging_metric_is_logged(client, caplog):
+    delay = {'metric 1': 900}
+
+    def lagging_render(pairs, from_ts, to_ts):
+        out = []
+        for series in render(client)(pairs, from_ts, to_ts):
+            lag = delay.get(series['target'], 0)
+            out.append(dict(series, datapoints=[p for p in series['datapoints'] if p[1] <= to_ts - lag]))
+        return out
+
+    watcher = bounds_watch.BoundsWatcher(lagging_render, TARGETS, {}, START, interval=INTERVAL, max_lookback=300)
+    watcher.poll(START + 1200)
+    assert watcher.seen['metric 1'] == START + 300
+    watcher.poll(START + 1260)
+    watcher.poll(START + 1320)
+    warnings = [r.getMessage() for r in caplog.records if 'lags' in r.getMessage()]
+    assert warnings == ["metric 1 lags more than 300 s behind (last point at %s, fetching from %s), its points before are skipped"
+                        % (START + 300, START + 960)]
+    assert watcher.lagging == {'metric 1'}
+    assert watcher.seen['metric 2'] == START + 1320
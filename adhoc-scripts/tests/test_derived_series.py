@@ -0,0 +1,43 @@
+# -*- coding: UTF-8 -*-
+
+import numpy
+
+import derived_series
+
+nan = numpy.nan
+
+
+def test_counter_rates_like_graphite_per_second():
+    timestamps = numpy.arange(0, 100, 10, dtype=float)
+    values = numpy.array([0, 10, 30, nan, nan, 100, 110, 5, 25, 45], dtype=float)
+    rates = derived_series.counter_rates(values, timestamps)
+    # Nothing before the first point, nulls and the first point after them,
+    # reset (decrease) give NaN
+    numpy.testing.assert_array_equal(rates, [nan, 1, 2, nan, nan, nan, 1, nan, 2, 2])
+
+
+def test_counter_rates_wrap_over_max_value():
+    timestamps = numpy.array([0, 10, 20], dtype=float)
+    values = numpy.array([250, 5, 15], dtype=float)
+    rates = derived_series.counter_rates(values, timestamps, max_value=255)
+    numpy.testing.assert_array_equal(rates, [nan, 1.1, 1])
+
+
+def test_align_buckets_labelled_by_start():
+    fine = {'values': numpy.arange(1, 16, dtype=float), 'timestamps': numpy.arange(10, 160, 10, dtype=float)}
+    coarse = {'values': numpy.array([1.0, 2.0]), 'timestamps': numpy.array([60.0, 120.0])}
+    timestamps, values = derived_series.align([fine, coarse])
+    numpy.testing.assert_array_equal(timestamps, [60, 120])
+    # Points 60 .. 110 fall into bucket 60 and 120 .. 170 into bucket 120,
+    # points before the first bucket are left out
+    numpy.testing.assert_array_equal(values, [[8.5, 13.5], [1, 2]])
+
+
+def test_divide_series_of_mixed_resolution():
+    leaves = {
+        'a': [{'name': 'a', 'values': numpy.array([2, 4, nan, 6, 8, 10], dtype=float), 'timestamps': numpy.arange(0, 60, 10, dtype=float)}],
+        'b': [{'name': 'b', 'values': numpy.array([1.0, 2.0]), 'timestamps': numpy.array([0.0, 30.0])}],
+    }
+    out = derived_series.evaluate(derived_series.parse('divideSeries(a, b)'), leaves, {})
+    numpy.testing.assert_array_equal(out[0]['timestamps'], [0, 30])
+    numpy.testing.assert_array_equal(out[0]['values'], [3, 4])
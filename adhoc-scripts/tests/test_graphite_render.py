@@ -0,0 +1,81 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Retries of render client against fake render API answering first requests
+with HTTP 503.
+"""
+
+import threading
+import http.server
+
+import pytest
+
+import fake_graphite
+import graphite_render
+import profiling
+
+TARGETS = ["alias(bench.node.series-%s.value, 'metric %s')" % (i, i) for i in range(4)]
+
+
+class FailingHandler(fake_graphite.Handler):
+    """
+    Fails first `failures` render requests, remembers client ports.
+    """
+
+    failures = 0
+    ports = None
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            self.ports.add(self.client_address[1])
+            failing = '/render' in self.path and FailingHandler.failures > 0
+            if failing:
+                FailingHandler.failures -= 1
+        if failing:
+            self._send(503, '{"message": "Try again"}')
+            return
+        super().do_GET()
+
+
+@pytest.fixture
+def failing_server(generator):
+    FailingHandler.generator = generator
+    FailingHandler.ports = set()
+    FailingHandler.failures = 0
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FailingHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_retry_reuses_connection(failing_server, stream):
+    FailingHandler.failures = 2
+    profile = profiling.Profile()
+    client = graphite_render.RenderClient('127.0.0.1', failing_server, 1, parallel=1, chunk_size=4,
+                                          backoff=0.01, profile=profile)
+    try:
+        data = client.render(TARGETS, 1600000000, 1600003600, summarise=(lambda s: s['target']) if stream else None)
+    finally:
+        client.close()
+    assert [d if stream else d['target'] for d in data] == ['metric %s' % i for i in range(4)]
+    assert profile.counters['retries'] == 2
+    # Failed responses were closed, so their connection was used again
+    assert len(FailingHandler.ports) == 1
+
+
+def test_backoff_not_counted_in_latency(failing_server):
+    FailingHandler.failures = 1
+    client = graphite_render.RenderClient('127.0.0.1', failing_server, 1, parallel=1, chunk_size=2,
+                                          target_latency=0.5, backoff=0.6)
+    try:
+        data = client.render(TARGETS[:2], 1600000000, 1600003600)
+    finally:
+        client.close()
+    assert len(data) == 2
+    # Chunk was answered quickly once retried, so it grows instead of halving
+    assert client.chunk_size == 3
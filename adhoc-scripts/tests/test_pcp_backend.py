@@ -0,0 +1,127 @@
+# -*- coding: UTF-8 -*-
+
+"""
+PCP backend on small pmrep and pmdumptext exports in tests/data, mapped by
+the shipped pcp_map.yaml.
+"""
+
+import os
+
+import numpy
+import pytest
+
+import pcp_backend
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PMREP = os.path.join(HERE, 'data', 'pcp-pmrep.csv')
+PMDUMPTEXT = os.path.join(HERE, 'data', 'pcp-pmdumptext.csv')
+MAP = os.path.join(HERE, '..', 'pcp_map.yaml')
+
+nan = numpy.nan
+
+
+@pytest.fixture
+def storage():
+    with open(MAP) as fp:
+        rules = pcp_backend.read_map(fp)
+    s = pcp_backend.PcpStorage([PMREP, PMDUMPTEXT], rules, 'sat.node')
+    yield s
+    s.close()
+
+
+def series(storage, path, from_ts=1600000000, until_ts=1600000100):
+    out = storage.fetch(path, from_ts, until_ts)
+    assert len(out) == 1, out
+    return out[0]
+
+
+@pytest.mark.parametrize('column, expected', [
+    ('hotproc.psinfo.rss-1234 /usr/sbin/httpd -DFOREGROUND', ('hotproc.psinfo.rss', '1234 /usr/sbin/httpd -DFOREGROUND')),
+    ('hotproc.psinfo.rss-2000 postgres: foreman foreman [local] idle', ('hotproc.psinfo.rss', '2000 postgres: foreman foreman [local] idle')),
+    ('sat:kernel.all.load["15 minute"]', ('kernel.all.load', '15 minute')),
+    ('kernel.all.load["1 minute"]', ('kernel.all.load', '1 minute')),
+    ('swap.used', ('swap.used', None)),
+])
+def test_parse_column(column, expected):
+    assert pcp_backend.parse_column(column) == expected
+
+
+def test_instance_matching(storage):
+    paths = sorted(storage.paths)
+    # Process groups match hotproc instances by regex, "{1}" is the group
+    # of matched instance, instances not matching any rule are not mapped
+    assert 'sat.node.processes-httpd.ps_rss' in paths
+    assert 'sat.node.processes-postgres.ps_rss' in paths
+    assert 'sat.node.processes-ruby.ps_rss' not in paths
+    assert 'sat.node.postgresql-foreman.pg_n_tup_c-ins' in paths
+    assert 'sat.node.postgresql-candlepin.pg_n_tup_c-ins' in paths
+    assert not any('template1' in p for p in paths)
+    assert 'sat.node.disk-sda.disk_octets.read' in paths
+    assert 'sat.node.interface-eth0.if_octets.rx' in paths
+    assert 'sat.node.interface-lo.if_octets.rx' in paths
+    assert 'sat.node.load.load.shortterm' in paths
+    assert 'sat.node.load.load.longterm' in paths
+    assert 'sat.node.load.load.midterm' not in paths
+    assert [m for m, c in storage.find('sat.node.postgresql-*.pg_n_tup_c-ins')] == [
+        'sat.node.postgresql-candlepin.pg_n_tup_c-ins', 'sat.node.postgresql-foreman.pg_n_tup_c-ins']
+
+
+def test_scale_and_sum(storage):
+    # kB RSS of both httpd processes summed into bytes, missing values skipped
+    rss = series(storage, 'sat.node.processes-httpd.ps_rss')
+    assert (rss['start'], rss['step']) == (1600000010, 10)
+    numpy.testing.assert_array_equal(rss['values'], numpy.array([3000, 1000, 3200, 3200]) * 1024)
+    # ms/s of CPU into us/s
+    numpy.testing.assert_array_equal(series(storage, 'sat.node.processes-httpd.ps_cputime.user')['values'],
+                                     [2000, 1500, 4000, 4000])
+    numpy.testing.assert_array_equal(series(storage, 'sat.node.disk-sda.disk_octets.read')['values'],
+                                     [4096, 8192, nan, 16384])
+    numpy.testing.assert_array_equal(series(storage, 'sat.node.postgresql-foreman.pg_n_tup_c-ins')['values'],
+                                     [10, 20, 30, 40])
+
+
+def test_count_aggregate(storage):
+    numpy.testing.assert_array_equal(series(storage, 'sat.node.processes-httpd.ps_count.processes')['values'],
+                                     [2, 1, 2, 2])
+    numpy.testing.assert_array_equal(series(storage, 'sat.node.processes-postgres.ps_count.processes')['values'],
+                                     [1, 1, 0, 1])
+
+
+def test_interval_bounds(storage):
+    # Points with from_ts < time <= until_ts, as Graphite returns them
+    rss = series(storage, 'sat.node.processes-httpd.ps_rss', 1600000010, 1600000030)
+    assert rss['start'] == 1600000020
+    numpy.testing.assert_array_equal(rss['values'], numpy.array([1000, 3200]) * 1024)
+    assert storage.fetch('sat.node.processes-httpd.ps_rss', 1600000040, 1600000100) == []
+
+
+def test_pmdumptext_iso_time_and_missing_values(storage):
+    start = 1600000010   # 2020-09-13 12:26:50 UTC
+    load = series(storage, 'sat.node.load.load.longterm', start - 10, start + 20)
+    assert (load['start'], load['step']) == (start, 10)
+    numpy.testing.assert_array_equal(load['values'], [0.25, 0.25, 0.25])
+    numpy.testing.assert_array_equal(series(storage, 'sat.node.interface-eth0.if_octets.rx', start - 10, start + 20)['values'],
+                                     [1000, nan, 3000])
+
+
+def test_render_expressions(storage):
+    data = storage.render(["alias(scale(sat.node.processes-httpd.ps_rss, 0.0009765625), 'rss')",
+                           "alias(sumSeries(sat.node.postgresql-*.pg_n_tup_c-ins), 'ins')"], 1600000000, 1600000100)
+    assert [d['target'] for d in data] == ['rss', 'ins']
+    numpy.testing.assert_array_equal(data[0]['values'], [3000, 1000, 3200, 3200])
+    numpy.testing.assert_array_equal(data[1]['values'], [11, 22, 33, 44])
+    numpy.testing.assert_array_equal(data[1]['timestamps'], [1600000010, 1600000020, 1600000030, 1600000040])
+
+
+def test_time_format(tmp_path):
+    path = os.path.join(str(tmp_path), 'export.csv')
+    with open(path, 'w') as fp:
+        fp.write('Time,swap.used\n13/09/2020 12:26:50,1\n13/09/2020 12:27:00,2\n')
+    rules = [{'pcp': 'swap.used', 'instance': None, 'path': 'swap.swap-used', 'scale': 1.0, 'aggregate': 'sum'}]
+    s = pcp_backend.PcpStorage([path], rules, 'sat.node', time_format='%d/%m/%Y %H:%M:%S')
+    try:
+        out = s.fetch('sat.node.swap.swap-used', 1600000000, 1600000100)
+    finally:
+        s.close()
+    assert out[0]['start'] == 1600000010
+    numpy.testing.assert_array_equal(out[0]['values'], [1, 2])
@@ -0,0 +1,27 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Request summary of the profile.
+"""
+
+import pytest
+
+import profiling
+
+
+@pytest.mark.parametrize('latencies, p95', [
+    ([0.001, 0.0184], 0.0184),
+    ([0.5], 0.5),
+    (list(range(1, 101)), 95),
+    (list(range(1, 21)), 19),
+    (list(range(1, 22)), 20),
+])
+def test_latency_p95_nearest_rank(latencies, p95):
+    profile = profiling.Profile()
+    for latency in reversed(latencies):
+        profile.request('render', latency, 100, series=1)
+    summary = profile.summary()
+    assert summary['requests.render.latency_p95'] == p95
+    assert summary['requests.render.latency_max'] == max(latencies)
+    assert summary['requests.render.count'] == len(latencies)
+    assert summary['requests.render.bytes'] == 100 * len(latencies)
@@ -0,0 +1,44 @@
+# -*- coding: UTF-8 -*-
+
+import numpy
+import pytest
+
+import quantile_sketch
+
+
+@pytest.mark.parametrize('value', [0.5, 2.0, -3.0, 1e6])
+def test_constant_series_quantiles_are_exact(value):
+    values = numpy.full((1, 100), value)
+    sketch = quantile_sketch.sketch_rows(values)[0]
+    assert sketch.quantiles([0.0, 0.5, 0.9, 0.99, 1.0]) == [value] * 5
+
+
+def test_quantiles_stay_within_extremes():
+    rng = numpy.random.default_rng(0)
+    values = rng.lognormal(3, 1, size=(50, 200))
+    values[rng.random(values.shape) < 0.1] = numpy.nan
+    sketches = quantile_sketch.sketch_rows(values)
+    quantiles = quantile_sketch.quantile_matrix([sketches], [0.0, 0.9, 0.99, 1.0])[0]
+    assert (quantiles >= numpy.nanmin(values, axis=1)[:, None]).all()
+    assert (quantiles <= numpy.nanmax(values, axis=1)[:, None]).all()
+    numpy.testing.assert_allclose(quantiles[:, 2], numpy.nanquantile(values, 0.99, axis=1, method='lower'), rtol=0.02)
+
+
+def test_merge_keeps_extremes():
+    first = quantile_sketch.sketch_rows(numpy.array([[1.0, 2.0]]))[0]
+    second = quantile_sketch.sketch_rows(numpy.array([[5.0, 7.0]]))[0]
+    merged = quantile_sketch.merged([first, None, second])
+    assert (merged.min, merged.max) == (1.0, 7.0)
+    assert merged.quantile(1.0) == 7.0
+
+    restored = quantile_sketch.QuantileSketch.from_json(merged.to_json())
+    assert (restored.min, restored.max) == (1.0, 7.0)
+
+
+def test_sketch_without_extremes():
+    stored = quantile_sketch.sketch_rows(numpy.array([[1.0, 2.0]]))[0].to_json()
+    del stored['min'], stored['max']   # as written before extremes were tracked
+    old = quantile_sketch.QuantileSketch.from_json(stored)
+    merged = quantile_sketch.merged([quantile_sketch.sketch_rows(numpy.array([[5.0]]))[0], old])
+    assert merged.min is None and merged.max is None
+    assert merged.quantile(1.0) == pytest.approx(5.0, rel=0.01)
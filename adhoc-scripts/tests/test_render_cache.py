@@ -0,0 +1,69 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Render cache against the fake render API: ranges fetched later are merged
+into cached series by their Graphite name.
+"""
+
+import numpy
+import pytest
+
+import graphite_render
+import render_cache
+
+START = 1600000000
+HOUR = 3600
+
+
+@pytest.fixture
+def client(fake_server):
+    c = graphite_render.RenderClient('127.0.0.1', fake_server, 1, parallel=1)
+    yield c
+    c.close()
+
+
+def expected(generator, path, from_ts, to_ts):
+    timestamps, values = generator.fetch(path, from_ts, to_ts)
+    return [[None if numpy.isnan(v) else v, t] for v, t in zip(values.tolist(), timestamps.tolist())]
+
+
+def test_wildcard_series_merged_by_name(tmp_path, client, generator, monkeypatch):
+    cache = render_cache.RenderCache(str(tmp_path))
+    target = 'bench.node.series-*.value'
+    first = cache.render(client, [(target, 'all')], START, START + HOUR)
+    assert len(first) == 20
+
+    # series-0 is gone and series-20 appeared since the first range was cached
+    metrics = ["bench.node.series-%s.value" % i for i in range(1, 21)]
+    monkeypatch.setattr(generator, 'metrics', lambda: metrics)
+    data = cache.render(client, [(target, 'all')], START, START + 2 * HOUR)
+    assert [d['target'] for d in data] == ['all'] * 21
+
+    by_first_point = {tuple(d['datapoints'][0]): d['datapoints'] for d in data}
+    for i in range(21):
+        path = "bench.node.series-%s.value" % i
+        from_ts = START + HOUR if i == 20 else START
+        to_ts = START + HOUR if i == 0 else START + 2 * HOUR
+        points = expected(generator, path, from_ts, to_ts)
+        assert by_first_point[tuple(points[0])] == points
+
+
+def test_cached_range_not_fetched_again(tmp_path, client, generator, monkeypatch):
+    cache = render_cache.RenderCache(str(tmp_path))
+    targets = [('bench.node.series-1.value', 'one'), ('sumSeries(bench.node.series-{2,3}.value)', 'sum')]
+    first = cache.render(client, targets, START, START + HOUR)
+    monkeypatch.setattr(client, 'render', lambda *args, **kwargs: pytest.fail('cached range fetched again'))
+    assert cache.render(client, targets, START + 600, START + HOUR) == \
+        [dict(d, datapoints=[p for p in d['datapoints'] if p[1] > START + 600]) for d in first]
+    assert [d['target'] for d in first] == ['one', 'sum']
+    assert first[0]['datapoints'] == expected(generator, 'bench.node.series-1.value', START, START + HOUR)
+
+
+def test_missing_values_do_not_replace_stored():
+    merged = render_cache.RenderCache.merge_series(
+        {'a': [[1.0, 10], [2.0, 20]], 'b': [[5.0, 10]]},
+        {'a': [[None, 20], [float('nan'), 30], [4.0, 10]], 'c': [[7.0, 10]]})
+    assert merged['a'][:2] == [[4.0, 10], [2.0, 20]]
+    assert merged['a'][2][1] == 30 and numpy.isnan(merged['a'][2][0])
+    assert merged['b'] == [[5.0, 10]]
+    assert merged['c'] == [[7.0, 10]]
@@ -0,0 +1,187 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Whisper backend against the render API path: series generated by the fake
+Graphite server are written into multi-archive .wsp files and reading them
+through whisper_backend has to give the same points and stats as fetching
+them over HTTP.
+"""
+
+import os
+import struct
+import warnings
+
+import numpy
+import pytest
+
+import graphite_render
+import series_stats
+import whisper_backend
+
+NOW = 1600000000
+ARCHIVES = [(10, 8640), (60, 10080), (600, 4320)]   # 1 day, 7 days, 30 days
+METRICS = ['bench.node.series-1.value', 'bench.node.series-2.value']
+
+
+def archive_points(generator, path, step, points):
+    """
+    Timestamps and values of archive as whisper propagates them (average of
+    the finest points in [ts, ts + step)), NaN where there is nothing.
+    """
+    last = NOW - NOW % step
+    timestamps = last - step * numpy.arange(points - 1, -1, -1, dtype=numpy.int64)
+    fine_step = generator.step
+    fine_ts, fine_values = generator.fetch(path, timestamps[0] - fine_step, timestamps[-1] + step - fine_step)
+    fine = numpy.full(len(timestamps) * (step // fine_step), numpy.nan)
+    fine[:len(fine_values)] = fine_values
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)   # mean of empty buckets
+        values = numpy.nanmean(fine.reshape(len(timestamps), -1), axis=1)
+    return timestamps, values
+
+
+def write_whisper(file_path, archives):
+    """
+    Write .wsp file with given list of (step, timestamps, values) archives.
+    Points are stored rotated in the ring buffer (as after wrapping around)
+    and missing values are not written at all.
+    """
+    header = whisper_backend.METADATA.size + whisper_backend.ARCHIVE_INFO.size * len(archives)
+    max_retention = max(step * len(timestamps) for step, timestamps, values in archives)
+    out = [whisper_backend.METADATA.pack(1, max_retention, 0.5, len(archives))]
+    offset = header
+    for step, timestamps, values in archives:
+        out.append(whisper_backend.ARCHIVE_INFO.pack(offset, step, len(timestamps)))
+        offset += whisper_backend.POINT_DTYPE.itemsize * len(timestamps)
+    for step, timestamps, values in archives:
+        points = numpy.zeros(len(timestamps), dtype=whisper_backend.POINT_DTYPE)
+        # First slot has to hold a point, whisper takes its timestamp as base
+        base = [i for i in range(len(timestamps) // 3, len(timestamps)) if not numpy.isnan(values[i])][0]
+        slots = (numpy.arange(len(timestamps)) - base) % len(timestamps)
+        valid = ~numpy.isnan(values)
+        points['timestamp'][slots[valid]] = timestamps[valid]
+        points['value'][slots[valid]] = values[valid]
+        out.append(points.tobytes())
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'wb') as fp:
+        fp.write(b''.join(out))
+
+
+@pytest.fixture
+def stored(generator, tmp_path):
+    """
+    Whisper files of METRICS, returns (storage, dict path -> archives).
+    """
+    written = {}
+    for path in METRICS:
+        archives = [(step,) + archive_points(generator, path, step, points) for step, points in ARCHIVES]
+        write_whisper(os.path.join(str(tmp_path), *path.split('.')) + '.wsp', archives)
+        written[path] = archives
+    return whisper_backend.WhisperStorage(str(tmp_path), now=NOW), written
+
+
+@pytest.fixture
+def client(fake_server):
+    c = graphite_render.RenderClient('127.0.0.1', fake_server, 1, parallel=1)
+    yield c
+    c.close()
+
+
+def assert_same_series(local, remote):
+    assert [s['target'] for s in local] == [s['target'] for s in remote]
+    local_values, local_ts = series_stats.series_matrix(local)
+    remote_values, remote_ts = series_stats.series_matrix(remote)
+    numpy.testing.assert_array_equal(local_ts, remote_ts)
+    numpy.testing.assert_allclose(local_values, remote_values, rtol=1e-12)
+
+
+@pytest.mark.parametrize('targets', [
+    ["alias(bench.node.series-1.value, 'one')"],
+    ["alias(scale(bench.node.series-2.value, 8), 'scaled')"],
+    ["alias(sumSeries(bench.node.series-{1,2}.value), 'sum')"],
+    ["alias(bench.node.series-{1,2}.value, 'both')"],
+])
+def test_matches_render_path(stored, client, targets):
+    storage, _ = stored
+    from_ts, until_ts = NOW - 6 * 3600 + 5, NOW - 600
+    local = storage.render(targets, from_ts, until_ts)
+    remote = client.render(targets, from_ts, until_ts)
+    assert local
+    assert_same_series(local, remote)
+
+    duration = until_ts - from_ts
+    local_stats = series_stats.split_stats(series_stats.compute_stats(*series_stats.series_matrix(local), duration))
+    remote_stats = series_stats.split_stats(series_stats.compute_stats(*series_stats.series_matrix(remote), duration))
+    for a, b in zip(local_stats, remote_stats):
+        for column in ('min', 'max', 'mean', 'median', 'p90', 'p95', 'p99', 'int_per_dur', 'pstdev', 'pvariance', 'datapoints'):
+            assert a[column] == pytest.approx(b[column], rel=1e-9), column
+        assert a['histogram'] == b['histogram']
+
+
+@pytest.mark.parametrize('age, step', [
+    (3600, 10),
+    (ARCHIVES[0][0] * ARCHIVES[0][1], 10),        # exactly the retention of the finest archive
+    (ARCHIVES[0][0] * ARCHIVES[0][1] + 1, 60),
+    (3 * 86400, 60),
+    (ARCHIVES[1][0] * ARCHIVES[1][1] + 1, 600),
+    (20 * 86400, 600),
+])
+def test_archive_selection(stored, age, step):
+    storage, written = stored
+    path = METRICS[0]
+    from_ts, until_ts = NOW - age, NOW - age + 50 * step
+    series = storage.fetch(path, from_ts, until_ts)
+    assert len(series) == 1
+    assert series[0]['step'] == step
+    timestamps = series[0]['start'] + step * numpy.arange(len(series[0]['values']))
+    assert timestamps[0] > from_ts and timestamps[0] - step <= from_ts
+    expected = [a for a in written[path] if a[0] == step][0]
+    index = numpy.searchsorted(expected[1], timestamps)
+    numpy.testing.assert_array_equal(expected[1][index], timestamps)
+    numpy.testing.assert_allclose(series[0]['values'], expected[2][index], rtol=1e-12)
+
+
+def test_retention_boundaries(stored):
+    storage, written = stored
+    path = METRICS[0]
+    max_retention = ARCHIVES[-1][0] * ARCHIVES[-1][1]
+    oldest = NOW - max_retention
+
+    # Interval older than the whole retention or in the future has no series
+    assert storage.fetch(path, oldest - 7200, oldest - 3600) == []
+    assert storage.fetch(path, NOW + 60, NOW + 3600) == []
+
+    # Start before the retention is clipped to its beginning
+    series = storage.fetch(path, oldest - 86400, oldest + 86400)[0]
+    assert series['step'] == 600
+    assert series['start'] == oldest - oldest % 600 + 600
+
+    # End after now is clipped to now
+    series = storage.fetch(path, NOW - 600, NOW + 3600)[0]
+    assert series['step'] == 10
+    assert series['start'] + series['step'] * (len(series['values']) - 1) == NOW - NOW % 10
+
+
+def test_wrapped_ring_buffer(tmp_path):
+    """
+    Points are found by their slot relative to the first point, whatever
+    the rotation of the ring buffer is, and stale slots are missing.
+    """
+    step, points = 60, 100
+    timestamps = NOW - NOW % step - step * numpy.arange(points - 1, -1, -1, dtype=numpy.int64)
+    values = numpy.arange(points, dtype=float)
+    values[[10, 50]] = numpy.nan
+    file_path = os.path.join(str(tmp_path), 'a', 'b.wsp')
+    write_whisper(file_path, [(step, timestamps, values)])
+    with whisper_backend.WhisperFile(file_path) as wsp:
+        start, fetched_step, fetched = wsp.fetch(NOW - step * points, NOW, now=NOW)
+    assert (start, fetched_step) == (timestamps[0], step)
+    numpy.testing.assert_array_equal(fetched, values)
+
+
+def test_broken_header(tmp_path):
+    file_path = os.path.join(str(tmp_path), 'broken.wsp')
+    with open(file_path, 'wb') as fp:
+        fp.write(struct.pack('!L', 1))
+    with pytest.raises(whisper_backend.WhisperError):
+        whisper_backend.WhisperFile(file_path)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Read series directly from Whisper files on the Graphite host instead of
+going through Grafana datasource proxy and graphite-web.
+
+Files are memory-mapped, archive headers are decoded and the archive which
+covers the interval is picked the same way whisper does it. Points are
+viewed as numpy structured array without copying the file. Simple wrappers
+used in metric yaml files (`alias()`, `scale()`, `sum()`/`sumSeries()`) are
+evaluated locally.
+
+Whisper file layout (all big-endian):
+
+    metadata:      aggregationType (L), maxRetention (L), xFilesFactor (f), archiveCount (L)
+    archive info:  offset (L), secondsPerPoint (L), points (L)    x archiveCount
+    archive data:  timestamp (L), value (d)                        x points, for every archive
+"""
+
+import os
+import re
+import glob
+import mmap
+import time
+import struct
+import numpy
+
+METADATA = struct.Struct('!2LfL')
+ARCHIVE_INFO = struct.Struct('!3L')
+POINT_DTYPE = numpy.dtype([('timestamp', '>u4'), ('value', '>f8')])
+
+
+class WhisperError(Exception):
+    pass
+
+
+class WhisperFile(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fp:
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            _, self.max_retention, _, archive_count = METADATA.unpack_from(self.mm, 0)
+            self.archives = []
+            for i in range(archive_count):
+                offset, step, points = ARCHIVE_INFO.unpack_from(self.mm, METADATA.size + i * ARCHIVE_INFO.size)
+                self.archives.append({'offset': offset, 'step': step, 'points': points, 'retention': step * points})
+        except struct.error:
+            self.close()
+            raise WhisperError("Unable to read header of %s" % path)
+
+    def close(self):
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def fetch(self, from_ts, until_ts, now=None):
+        """
+        Return (start, step, values) where values is float array with NaN for
+        missing points, or None if interval is out of retention.
+        """
+        if now is None:
+            now = int(time.time())
+        from_ts = int(from_ts)
+        until_ts = int(until_ts)
+        if from_ts > until_ts:
+            raise WhisperError("Invalid time interval %s - %s" % (from_ts, until_ts))
+        oldest = now - self.max_retention
+        if from_ts > now or until_ts < oldest:
+            return None
+        from_ts = max(from_ts, oldest)
+        until_ts = min(until_ts, now)
+
+        diff = now - from_ts
+        for archive in self.archives:
+            if archive['retention'] >= diff:
+                break
+
+        step = archive['step']
+        from_interval = from_ts - (from_ts % step) + step
+        until_interval = until_ts - (until_ts % step) + step
+        if from_interval == until_interval:
+            until_interval += step
+        count = ((until_interval - from_interval) // step) % archive['points'] or archive['points']
+
+        points = numpy.frombuffer(self.mm, dtype=POINT_DTYPE, count=archive['points'], offset=archive['offset'])
+        base = int(points[0]['timestamp'])
+        if base == 0:
+            values = numpy.full((until_interval - from_interval) // step, numpy.nan)
+        else:
+            expected = from_interval + step * numpy.arange(count, dtype=numpy.int64)
+            slots = ((from_interval - base) // step + numpy.arange(count, dtype=numpy.int64)) % archive['points']
+            selected = points[slots]   # fancy indexing copies just the selected points
+            values = numpy.where(selected['timestamp'] == expected, selected['value'], numpy.nan).astype(float)
+        del points   # release view of the mmap so it can be closed
+        return from_interval, step, values
+
+
+def split_args(text):
+    """
+    Split function arguments on top level commas.
+    """
+    out = []
+    depth = 0
+    quote = None
+    current = ''
+    for char in text:
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '\'"':
+            quote = char
+        elif char in '({':
+            depth += 1
+        elif char in ')}':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            out.append(current.strip())
+            current = ''
+            continue
+        current += char
+    if current.strip():
+        out.append(current.strip())
+    return out
+
+
+def _expand_braces(pattern):
+    """
+    Expand Graphite "{a,b}" alternatives, glob handles the rest.
+    """
+    match = re.search(r'\{([^{}]*)\}', pattern)
+    if match is None:
+        return [pattern]
+    out = []
+    for alternative in match.group(1).split(','):
+        out += _expand_braces(pattern[:match.start()] + alternative + pattern[match.end():])
+    return out
+
+
+class WhisperStorage(object):
+
+    def __init__(self, storage_dir, now=None):
+        self.storage_dir = storage_dir
+        self.now = now
+
+    def find(self, path):
+        """
+        Return sorted list of (metric path, file path) matching given
+        Graphite path pattern.
+        """
+        out = {}
+        for pattern in _expand_braces(path):
+            file_pattern = os.path.join(self.storage_dir, *pattern.split('.')) + '.wsp'
+            for file_path in glob.glob(file_pattern):
+                metric = os.path.relpath(file_path, self.storage_dir)[:-len('.wsp')].replace(os.sep, '.')
+                out[metric] = file_path
+        return sorted(out.items())
+
+    def fetch(self, path, from_ts, until_ts):
+        """
+        Return list of series dicts with 'name', 'start', 'step' and
+        'values' of metrics matching path pattern.
+        """
+        out = []
+        for metric, file_path in self.find(path):
+            with WhisperFile(file_path) as wsp:
+                fetched = wsp.fetch(from_ts, until_ts, now=self.now)
+            if fetched is not None:
+                start, step, values = fetched
+                out.append({'name': metric, 'start': start, 'step': step, 'values': values})
+        return out
+
+    def evaluate(self, expression, from_ts, until_ts):
+        """
+        Evaluate target expression, return list of series dicts with 'name',
+        'start', 'step' and 'values'.
+        """
+        expression = expression.strip()
+        match = re.match(r'^(\w+)\((.*)\)$', expression, re.S)
+        if match is None:
+            return self.fetch(expression, from_ts, until_ts)
+
+        function, args = match.group(1), split_args(match.group(2))
+        if function == 'alias':
+            series = self.evaluate(args[0], from_ts, until_ts)
+            for s in series:
+                s['name'] = args[1].strip('\'"')
+            return series
+        if function == 'scale':
+            series = self.evaluate(args[0], from_ts, until_ts)
+            for s in series:
+                s['values'] = s['values'] * float(args[1])
+                s['name'] = "scale(%s,%s)" % (s['name'], args[1])
+            return series
+        if function in ('sum', 'sumSeries'):
+            series = []
+            for arg in args:
+                series += self.evaluate(arg, from_ts, until_ts)
+            if not series:
+                return []
+            if len(set((s['start'], s['step'], len(s['values'])) for s in series)) != 1:
+                raise WhisperError("Series in %s have different resolution" % expression)
+            stacked = numpy.vstack([s['values'] for s in series])
+            values = numpy.nansum(stacked, axis=0)
+            values[numpy.isnan(stacked).all(axis=0)] = numpy.nan   # all None gives None as in Graphite
+            return [{'name': "sumSeries(%s)" % ','.join(args), 'start': series[0]['start'], 'step': series[0]['step'], 'values': values}]
+        raise WhisperError("Function %s is not supported by whisper backend" % function)
+
+    def render(self, targets, from_ts, until_ts):
+        """
+        Equivalent of render API call for list of target expressions. Returns
+        list of series dicts with 'target', 'values' and 'timestamps' arrays.
+        """
+        out = []
+        for target in targets:
+            for s in self.evaluate(target, from_ts, until_ts):
+                out.append({
+                    'target': s['name'],
+                    'values': s['values'],
+                    'timestamps': (s['start'] + s['step'] * numpy.arange(len(s['values']))).astype(float),
+                })
+        return out